@@ -0,0 +1,77 @@
+# coding: utf-8
+# vim: set fenc=utf-8 ft=python ts=4 sts=4 sw=4 ai et
+"""
+Measures DKIM signing throughput of :class:`send_mail.DKIMSigner`.
+
+Mails are built and serialized up front, so only signing is timed: the
+body hash, the header canonicalization and the signature itself. Personal
+mails each get their body hashed, while a mail merge sharing one body
+reuses its hash and only signs the headers of each mail.
+
+Usage::
+
+    python benchmarks/bench_dkim.py --mails 500 --body-size 16 --key-type rsa
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from send_mail import DKIMSigner, MailTemplate, _build_mail, _serialize_mail  # noqa: E402
+
+
+def make_private_key(key_type):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+    if key_type == 'rsa':
+        key = rsa.generate_private_key(65537, 2048)
+    else:
+        key = ed25519.Ed25519PrivateKey.generate()
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+
+def personal_mails(count, body):
+    for i in range(count):
+        mail, _, _ = _build_mail('Report %d' % i, message='Hello user %d,\n%s' % (i, body),
+                                 sender='app@example.com', to='user%d@example.com' % i)
+        yield list(_serialize_mail(mail))
+
+
+def merged_mails(count, body):
+    template = MailTemplate('Newsletter', message=body, sender='app@example.com')
+    for i in range(count):
+        yield template.render(to='user%d@example.com' % i)[0]
+
+
+def run(signer, mails):
+    started_at = time.time()
+    for msg in mails:
+        signer.sign(msg)
+    return len(mails) / (time.time() - started_at)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mails', type=int, default=500, help='mails signed per run')
+    parser.add_argument('--body-size', type=int, default=16, help='body size in KiB')
+    parser.add_argument('--key-type', choices=('rsa', 'ed25519'), default='rsa', help='signing key type')
+    args = parser.parse_args()
+
+    body = ('Line of the report, with  some   spaces \n' * (args.body_size * 1024 // 42 + 1))
+    private_key = make_private_key(args.key_type)
+
+    print('%-10s %-18s %10s %12s' % ('mails', 'canonicalization', 'mails/s', 'body hashes'))
+    for name, mails in (('personal', list(personal_mails(args.mails, body))),
+                        ('merge', list(merged_mails(args.mails, body)))):
+        for canonicalization in ('simple/simple', 'relaxed/relaxed'):
+            signer = DKIMSigner('example.com', 'bench', private_key, canonicalization=canonicalization)
+            print('%-10s %-18s %10.1f %12d' % (name, canonicalization, run(signer, mails), signer.body_hashes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# coding: utf-8
+# vim: set fenc=utf-8 ft=python ts=4 sts=4 sw=4 ai et
+"""
+Measures the cold import cost of send_mail with ``python -X importtime``.
+
+Each run imports the module in a fresh interpreter, after one warm-up run
+writing the bytecode caches, and the median cumulative import time is
+reported along with the heaviest modules it pulled in.
+
+Usage::
+
+    python benchmarks/bench_import.py --runs 20 --top 10
+"""
+from __future__ import print_function
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times(module):
+    """Imports ``module`` in a fresh interpreter, returning each module's cumulative microseconds"""
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=ROOT, env=env, stderr=subprocess.STDOUT
+    ).decode('utf-8')
+
+    times = {}
+    for line in output.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--module', default='send_mail', help='module to import')
+    parser.add_argument('--runs', type=int, default=20, help='fresh interpreters to import in')
+    parser.add_argument('--top', type=int, default=10, help='heaviest imported modules to list')
+    args = parser.parse_args()
+
+    import_times(args.module)  # warm up bytecode caches
+    runs = [import_times(args.module) for _ in range(args.runs)]
+
+    print('%s: %.1fms median cumulative import time over %d runs' % (
+        args.module, median([run[args.module] for run in runs]) / 1000.0, args.runs
+    ))
+    heaviest = sorted(
+        ((median([run.get(name, 0) for run in runs]), name) for name in runs[0] if name != args.module),
+        reverse=True
+    )
+    for elapsed, name in heaviest[:args.top]:
+        print('%10.1fms %s' % (elapsed / 1000.0, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# coding: utf-8
+# vim: set fenc=utf-8 ft=python ts=4 sts=4 sw=4 ai et
+"""
+Compares rendering mails from a compiled :class:`send_mail.MailTemplate`
+against building each of them from scratch like :func:`send_mail.send_mail`.
+
+Both produce the DATA bytes of a personalized HTML report with a shared
+attachment; the benchmark reports the CPU time spent per mail.
+
+Usage::
+
+    python benchmarks/bench_merge.py --mails 500 --attachment-size 512
+"""
+from __future__ import print_function
+import argparse
+import os
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from send_mail import MailTemplate, _build_mail, _StreamedMail  # noqa: E402
+
+SUBJECT = 'Daily report for $name'
+HTML = '<html><body><h1>Hello $name</h1>' + '<p>Row $row of the report, all good.</p>' * 200 + '</body></html>'
+
+
+def from_scratch(attachment, contexts):
+    for context in contexts:
+        mail, _, _ = _build_mail(
+            string.Template(SUBJECT).substitute(context),
+            html_message=string.Template(HTML).substitute(context),
+            to='you@example.com', sender='app@example.com', attachments=[attachment]
+        )
+        for _ in _StreamedMail(mail):
+            pass
+
+
+def from_template(attachment, contexts):
+    template = MailTemplate(SUBJECT, html_message=HTML, sender='app@example.com', attachments=[attachment])
+    for context in contexts:
+        template.render(context, to='you@example.com')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mails', type=int, default=500, help='number of mails to render')
+    parser.add_argument('--attachment-size', type=int, default=512, help='shared attachment size in KiB')
+    args = parser.parse_args()
+
+    contexts = [{'name': 'Recipient %d' % i, 'row': i} for i in range(args.mails)]
+
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as f:
+        f.write(os.urandom(args.attachment_size * 1024))
+        f.flush()
+
+        print('%-14s %12s %14s' % ('path', 'total', 'per mail'))
+        for name, path in (('from scratch', from_scratch), ('from template', from_template)):
+            started_at = time.process_time()
+            path(f.name, contexts)
+            elapsed = time.process_time() - started_at
+            print('%-14s %10.1fms %12.3fms' % (name, elapsed * 1000, elapsed * 1000 / args.mails))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# coding: utf-8
+# vim: set fenc=utf-8 ft=python ts=4 sts=4 sw=4 ai et
+"""
+Measures how :class:`send_mail.Dispatcher` throughput scales when mails are
+built in worker processes instead of the sending threads.
+
+A batch of personalized HTML-only mails with an attachment is dispatched to
+a local SMTP sink, first building in the sending threads and then with a
+growing number of build processes, up to the machine's core count.
+
+Usage::
+
+    python benchmarks/bench_pipeline.py --mails 400 --workers 4 --attachment-size 256
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from send_mail import Dispatcher, _html_text_cache  # noqa: E402
+from test_send_mail import FakeSMTPServer  # noqa: E402
+
+HTML = '<html><body><h1>Hello %s</h1>' + '<p>Row %%d of the report, <b>all</b> good.</p>' * 200 + '</body></html>'
+
+
+def messages(count, attachment):
+    for i in range(count):
+        name = 'user%d' % i
+        yield {
+            'subject': 'Daily report for %s' % name,
+            'html_message': HTML % name % tuple(range(200)),
+            'to': '%s@example.com' % name,
+            'attachments': [attachment],
+        }
+
+
+def run(server, args, attachment, build_processes):
+    _html_text_cache.clear()
+    dispatcher = Dispatcher(
+        workers=args.workers, build_processes=build_processes, host='127.0.0.1', port=server.port
+    )
+    try:
+        report = dispatcher.dispatch(messages(args.mails, attachment))
+    finally:
+        dispatcher.close()
+    assert report.sent == args.mails, report.results[0]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mails', type=int, default=400, help='mails per run')
+    parser.add_argument('--workers', type=int, default=4, help='sending threads')
+    parser.add_argument('--attachment-size', type=int, default=256, help='attachment size in KiB')
+    parser.add_argument('--max-processes', type=int, default=multiprocessing.cpu_count(),
+                        help='largest number of build processes tried')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.bin') as f, FakeSMTPServer(keep_data=False) as server:
+        f.write(os.urandom(args.attachment_size * 1024))
+        f.flush()
+
+        baseline = run(server, args, f.name, None)
+        print('%-18s %10s %8s' % ('build in', 'mails/s', 'speedup'))
+        print('%-18s %10.1f %7.2fx' % ('sending threads', baseline.messages_per_second, 1))
+
+        processes = 1
+        while processes <= args.max_processes:
+            report = run(server, args, f.name, processes)
+            print('%-18s %10.1f %7.2fx' % (
+                '%d processes' % processes, report.messages_per_second,
+                report.messages_per_second / baseline.messages_per_second
+            ))
+            processes *= 2
+
+
+if __name__ == '__main__':
+    main()
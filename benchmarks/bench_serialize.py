@@ -0,0 +1,87 @@
+# coding: utf-8
+# vim: set fenc=utf-8 ft=python ts=4 sts=4 sw=4 ai et
+"""
+Compares the single-pass chunked serializer against rendering with
+``as_string`` and encoding the way :meth:`smtplib.SMTP.sendmail` does.
+
+Both paths produce the same DATA bytes; the benchmark reports the time
+each takes and its peak traced memory for messages of growing size.
+
+Usage::
+
+    python benchmarks/bench_serialize.py --sizes 1 8 32 --repeat 5
+"""
+from __future__ import print_function
+import argparse
+import os
+import smtplib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from send_mail import _build_mail, _StreamedMail  # noqa: E402
+
+
+def as_string_path(mail, sink):
+    """What sending used to do: render, fix line endings, encode, dot-stuff, terminate"""
+    msg = smtplib._fix_eols(mail.as_string()).encode('utf-8')
+    data = smtplib._quote_periods(msg)
+    if data[-2:] != b'\r\n':
+        data += b'\r\n'
+    data += b'.\r\n'
+    sink(data)
+
+
+def chunked_path(mail, sink):
+    for chunk in _StreamedMail(mail):
+        sink(chunk)
+    sink(b'.\r\n')
+
+
+def measure(path, mail, repeat):
+    def sink(data):
+        pass
+
+    best = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        path(mail, sink)
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    path(mail, sink)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 8, 32], help='attachment sizes in MiB')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the best is kept')
+    args = parser.parse_args()
+
+    print('%8s %-10s %12s %14s' % ('size', 'path', 'best time', 'peak memory'))
+    for size in args.sizes:
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            row = b'2018-01-02,report,42,.5,"some text"\n'
+            f.write(row * (size * 1024 * 1024 // len(row)))
+            f.flush()
+
+            mail, _, _ = _build_mail(
+                'Benchmark', message='.Report attached\n' * 100, html_message='<p>Report attached</p>' * 100,
+                to='you@example.com', attachments=[f.name]
+            )
+
+            for name, path in (('as_string', as_string_path), ('chunked', chunked_path)):
+                best, peak = measure(path, mail, args.repeat)
+                print('%6dMiB %-10s %10.1fms %12.1fMiB' % (size, name, best * 1000, peak / 1024.0 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+# coding: utf-8
+# vim: set fenc=utf-8 ft=python ts=4 sts=4 sw=4 ai et
+"""
+Runs the send_mail benchmark scenarios against a local SMTP sink.
+
+Each scenario sends its mails one after the other over a :class:`send_mail.Mailer`
+in a fresh interpreter, so peak RSS is measured for that scenario alone. It
+reports mails per second, p50/p99 latency of each send, peak RSS and the
+peak of memory traced while sending a few more mails. Results are written
+as JSON, and a previous results file can be given to compare against.
+
+Usage::
+
+    python benchmarks/bench_suite.py --latency 0.002 --pipelining --output results.json
+    python benchmarks/bench_suite.py --compare results.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from smtp_sink import SMTPSink  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+SCENARIOS = {
+    # name: (mails sent, description)
+    'small_plain': (500, 'short plain text mail to one recipient'),
+    'large_attachment': (20, 'plain text mail with a 4MiB attachment'),
+    'many_recipients': (50, 'plain text mail to 500 recipients'),
+    'html_only': (100, '60KiB HTML-only report converted to plain text'),
+}
+
+TRACED_MAILS = 3
+
+HTML_ROW = '<tr><td>%d</td><td><a href="https://example.com/items/%d">item %d</a></td><td>in stock</td></tr>'
+
+
+def make_messages(scenario, count, directory):
+    """Yields the details of each mail of a scenario"""
+    if scenario == 'large_attachment':
+        attachment = os.path.join(directory, 'report.bin')
+        with open(attachment, 'wb') as f:
+            f.write(os.urandom(4 * 1024 * 1024))
+
+    for i in range(count):
+        details = {'subject': 'Benchmark %s %d' % (scenario, i), 'sender': 'bench@example.com'}
+        if scenario == 'small_plain':
+            details.update(message='Hello,\nyour order %d shipped.\n' % i, to='you@example.com')
+        elif scenario == 'large_attachment':
+            details.update(message='Report attached.\n', to='you@example.com', attachments=[attachment])
+        elif scenario == 'many_recipients':
+            details.update(
+                message='Hello all,\nthe newsletter %d.\n' % i,
+                to='list@example.com',
+                bcc=['member%d@example.com' % member for member in range(500)]
+            )
+        elif scenario == 'html_only':
+            # a different body for every mail, so no conversion is cached
+            rows = ''.join(HTML_ROW % (i * 1000 + row, row, row) for row in range(600))
+            details.update(html_message='<html><body><h1>Stock</h1><table>%s</table></body></html>' % rows,
+                           to='you@example.com')
+        yield details
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_scenario(args):
+    """Runs one scenario in this interpreter, printing its results as JSON"""
+    from send_mail import Mailer, MailerConfig
+
+    count = args.mails or SCENARIOS[args.scenario][0]
+    config = MailerConfig(host='127.0.0.1', port=args.port, username='bench', password='secret',
+                          use_tls=args.tls, environ={})
+    directory = tempfile.mkdtemp()
+    latencies = []
+
+    with Mailer(config) as mailer:
+        messages = list(make_messages(args.scenario, count + TRACED_MAILS, directory))
+
+        started_at = time.time()
+        for details in messages[:count]:
+            sent_at = time.time()
+            result = mailer.send(**details)
+            latencies.append(time.time() - sent_at)
+            assert result.ok, result
+        elapsed = time.time() - started_at
+
+        tracemalloc.start()
+        for details in messages[count:]:
+            mailer.send(**details)
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+    print(json.dumps({
+        'scenario': args.scenario,
+        'mails': count,
+        'mails_per_second': count / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        # kilobytes on Linux
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        'traced_peak_kib': traced_peak / 1024.0,
+    }))
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=devnull).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Prints how each scenario changed from the baseline results"""
+    previous = dict((result['scenario'], result) for result in baseline['results'])
+    print('\ncompared to %s:' % (baseline['meta'].get('commit') or 'baseline'))
+    for result in results:
+        before = previous.get(result['scenario'])
+        if before is None:
+            continue
+        changes = []
+        for key in ('mails_per_second', 'p50_ms', 'p99_ms', 'peak_rss_kib', 'traced_peak_kib'):
+            if before.get(key) and result.get(key) is not None:
+                changes.append('%s %+.1f%%' % (key, (result[key] - before[key]) * 100.0 / before[key]))
+        print('%-18s %s' % (result['scenario'], ', '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument('--mails', type=int, help='mails per scenario, instead of each one\'s default')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds each round trip to the sink takes')
+    parser.add_argument('--pipelining', action='store_true', help='sink advertises PIPELINING')
+    parser.add_argument('--chunking', action='store_true', help='sink advertises CHUNKING')
+    parser.add_argument('--tls', action='store_true', help='send over STARTTLS')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        return run_scenario(args)
+
+    sink = SMTPSink(latency=args.latency, pipelining=args.pipelining, chunking=args.chunking, tls=args.tls)
+    results = []
+    with sink:
+        print('%-18s %6s %10s %9s %9s %12s %14s' % (
+            'scenario', 'mails', 'mails/s', 'p50', 'p99', 'peak RSS', 'traced peak'
+        ))
+        for scenario in args.scenarios:
+            command = [sys.executable, os.path.abspath(__file__), '--scenario', scenario, '--port', str(sink.port)]
+            if args.mails:
+                command += ['--mails', str(args.mails)]
+            if args.tls:
+                command.append('--tls')
+            result = json.loads(subprocess.check_output(command).decode('utf-8').strip().splitlines()[-1])
+            results.append(result)
+            print('%-18s %6d %10.1f %7.2fms %7.2fms %9sKiB %11.1fKiB' % (
+                scenario, result['mails'], result['mails_per_second'], result['p50_ms'], result['p99_ms'],
+                result['peak_rss_kib'], result['traced_peak_kib']
+            ))
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'sink': {
+                'latency': args.latency, 'pipelining': args.pipelining, 'chunking': args.chunking, 'tls': args.tls,
+            },
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
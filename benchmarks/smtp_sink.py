@@ -0,0 +1,198 @@
+# coding: utf-8
+# vim: set fenc=utf-8 ft=python ts=4 sts=4 sw=4 ai et
+"""
+In-process SMTP sink for benchmarks.
+
+It accepts any login and any recipient and throws the mails away, only
+counting them. Replies are held back until the client waits for them,
+then sent after ``latency`` seconds, so each round trip costs what it
+would over a slow link while pipelined commands share one.
+
+Usage::
+
+    with SMTPSink(latency=0.005, pipelining=True, tls=True) as sink:
+        send_mail('Hi', message='...', to='you@example.com', host='127.0.0.1', port=sink.port, use_tls=True)
+"""
+from __future__ import print_function
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+from six.moves import socketserver
+
+
+def make_server_ssl_context():
+    """Creates a self-signed certificate for 127.0.0.1, returning a server SSL context using it"""
+    directory = tempfile.mkdtemp()
+    try:
+        key_file, cert_file = os.path.join(directory, 'key.pem'), os.path.join(directory, 'cert.pem')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                [
+                    'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', key_file, '-out', cert_file, '-subj', '/CN=127.0.0.1',
+                ],
+                stdout=devnull, stderr=devnull
+            )
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+        return context
+    finally:
+        shutil.rmtree(directory)
+
+
+class SMTPSinkHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.buffer = b''
+        self.replies = []
+
+    def reply(self, line):
+        self.replies.append(line.encode('ascii') + b'\r\n')
+
+    def flush(self):
+        if self.replies:
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            self.request.sendall(b''.join(self.replies))
+            self.replies = []
+
+    def fill(self):
+        """Reads more input, first sending the replies the client may be waiting for"""
+        self.flush()
+        data = self.request.recv(256 * 1024)
+        if not data:
+            raise EOFError()
+        self.buffer += data
+
+    def readline(self):
+        while True:
+            end = self.buffer.find(b'\r\n')
+            if end >= 0:
+                line, self.buffer = self.buffer[:end], self.buffer[end + 2:]
+                return line.decode('utf-8', 'replace')
+            self.fill()
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            self.fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_data(self):
+        """Reads a dot terminated mail, returning its size"""
+        size = 0
+        while True:
+            end = self.buffer.find(b'\r\n.\r\n')
+            if end >= 0:
+                size += end + 2
+                self.buffer = self.buffer[end + 5:]
+                return size
+            # keep what may be the start of the terminator
+            keep = min(len(self.buffer), 4)
+            size += len(self.buffer) - keep
+            self.buffer = self.buffer[len(self.buffer) - keep:]
+            self.fill()
+
+    def handle(self):
+        server = self.server
+        chunked = 0
+        try:
+            self.reply('220 sink.example.com ESMTP')
+            while True:
+                verb, _, arg = self.readline().partition(' ')
+                verb = verb.upper()
+                if verb == 'EHLO':
+                    extensions = ['sink.example.com', 'AUTH PLAIN LOGIN']
+                    if server.pipelining:
+                        extensions.append('PIPELINING')
+                    if server.chunking:
+                        extensions.append('CHUNKING')
+                    if server.ssl_context is not None and not isinstance(self.request, ssl.SSLSocket):
+                        extensions.append('STARTTLS')
+                    for extension in extensions[:-1]:
+                        self.reply('250-' + extension)
+                    self.reply('250 ' + extensions[-1])
+                elif verb == 'STARTTLS' and server.ssl_context is not None:
+                    self.reply('220 Ready to start TLS')
+                    self.flush()
+                    self.request = server.ssl_context.wrap_socket(self.request, server_side=True)
+                elif verb == 'AUTH':
+                    mechanism, _, initial = arg.partition(' ')
+                    if not initial:
+                        self.reply('334 ')
+                        self.readline()
+                    if mechanism.upper() == 'LOGIN':
+                        self.reply('334 ')
+                        self.readline()
+                    self.reply('235 Authentication successful')
+                elif verb == 'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    server.received(self.read_data())
+                    self.reply('250 OK queued')
+                elif verb == 'BDAT' and server.chunking:
+                    size, _, last = arg.partition(' ')
+                    chunked += len(self.read(int(size)))
+                    if last.upper() == 'LAST':
+                        server.received(chunked)
+                        chunked = 0
+                    self.reply('250 OK')
+                elif verb in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                    self.reply('250 OK')
+                elif verb == 'QUIT':
+                    self.reply('221 Bye')
+                    self.flush()
+                    break
+                else:
+                    self.reply('502 Command not implemented')
+        except (EOFError, socket.error, ssl.SSLError):
+            pass
+
+
+class SMTPSink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """SMTP server on localhost discarding the mails it receives.
+
+    Args:
+        latency (:obj:`float`): seconds each round trip takes.
+        pipelining (:obj:`bool`): advertise PIPELINING.
+        chunking (:obj:`bool`): advertise CHUNKING and accept BDAT.
+        tls (:obj:`bool`): advertise STARTTLS with a self-signed certificate.
+            Requires the openssl command line tool.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, pipelining=False, chunking=False, tls=False):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), SMTPSinkHandler)
+        self.latency = latency
+        self.pipelining = pipelining
+        self.chunking = chunking
+        self.ssl_context = make_server_ssl_context() if tls else None
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def received(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
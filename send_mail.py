@@ -12,11 +12,25 @@
 from __future__ import unicode_literals, print_function
 import os
 import re
+import mmap
+import base64
+import hashlib
+import itertools
+import json
+import string
+import socket
 import smtplib
+import sys
+import threading
+import time
+import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
+from email.message import Message
 from email.utils import COMMASPACE, formatdate, formataddr, make_msgid
 
 import six
-import html2text
+from six.moves import queue
 
 if six.PY2:
     from email.MIMEMultipart import MIMEMultipart
@@ -24,14 +38,260 @@ if six.PY2:
     from email.MIMEText import MIMEText
     from email import Encoders as encoders
     from email import charset
+    from email.generator import Generator, _make_boundary
+    from base64 import encodestring as encodebytes
 if six.PY3:
     from email.mime.multipart import MIMEMultipart
     from email.mime.base import MIMEBase
     from email.mime.text import MIMEText
     from email import encoders
     from email import charset
+    from email.generator import _make_boundary
+    from base64 import encodebytes
 
 
+# Add missing charset email charset and email encodings
+# https://stackoverflow.com/questions/9403265/how-do-i-use-python-3-2-email-module-to-send-unicode-messages-encoded-in-utf-8-w
+charset.add_charset('utf-8', charset.QP, charset.QP)
+_UTF8_CHARSET = charset.Charset('utf-8')
+
+if six.PY2:
+    def _move_to_end(ordered_dict, key):
+        ordered_dict[key] = ordered_dict.pop(key)
+else:
+    def _move_to_end(ordered_dict, key):
+        ordered_dict.move_to_end(key)
+
+
+class _LRUCache(object):
+    """Thread-safe least recently used cache bounded by the total weight of its values.
+
+    Args:
+        max_weight: Maximum total weight of the cached values.
+        weigh: Function giving a value's weight. Defaults to 1 for every
+            value, bounding the number of entries.
+    """
+
+    def __init__(self, max_weight, weigh=None):
+        self.max_weight = max_weight
+        self.weigh = weigh or (lambda value: 1)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        return self.get_many([key], default)[0]
+
+    def get_many(self, keys, default=None):
+        """Looks up several keys at once, unhashable ones being misses"""
+        values = []
+        hits = 0
+        entries = self._entries
+        with self._lock:
+            for key in keys:
+                try:
+                    entry = entries.get(key)
+                except TypeError:
+                    entry = None
+
+                if entry is None:
+                    values.append(default)
+                    continue
+
+                _move_to_end(entries, key)
+                values.append(entry[0])
+                hits += 1
+
+            self.hits += hits
+            self.misses += len(values) - hits
+
+        return values
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        with self._lock:
+            for key, value in items:
+                weight = self.weigh(value)
+                if weight > self.max_weight:
+                    continue
+
+                if key in self._entries:
+                    self.weight -= self._entries.pop(key)[1]
+
+                self._entries[key] = (value, weight)
+                self.weight += weight
+
+            while self.weight > self.max_weight:
+                _, (_, evicted_weight) = self._entries.popitem(last=False)
+                self.weight -= evicted_weight
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+
+class Instrumentation(object):
+    """Receives timings and counts of what sending mails involves.
+
+    Enable it with :func:`set_instrumentation`. Subclasses override
+    :meth:`timing` and :meth:`count`, or :meth:`phase` for tracing systems
+    which need to know when phases start and end. They may be called from
+    several threads at once. Phases may nest, e.g. ``html_to_text`` runs
+    within ``build``.
+
+    Phases:
+        ``parse``: parsing and validating the addresses.
+        ``build``: building the MIME tree.
+        ``html_to_text``: converting an HTML-only message to plain text.
+        ``attachments``: reading and encoding the attachments.
+        ``sign``: hashing and signing the mail with DKIM.
+        ``compress``: compressing an attachment, in a background thread.
+        ``connect``: connecting to the mail server.
+        ``ehlo``: greeting the mail server, learning its extensions.
+        ``tls``: upgrading the connection with STARTTLS.
+        ``auth``: logging in.
+        ``envelope``: the MAIL and RCPT commands.
+        ``data``: serializing and transferring the mail.
+
+    Counts:
+        ``bytes_sent``: bytes of mail data written to the server.
+        ``recipients_accepted``, ``recipients_refused``: per mail transaction.
+        ``pool_hits``, ``pool_misses``: sessions taken from a
+        :class:`SMTPConnectionPool` and new connections it had to make.
+        ``relay_failovers``: mails a :class:`RelayPool` sent to another
+        relay after one failed.
+    """
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager timing the phase run within it"""
+        started_at = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.timing(name, timeit.default_timer() - started_at)
+
+    def timing(self, phase, seconds):
+        """Records how long a phase took"""
+
+    def count(self, name, value=1):
+        """Records an occurrence of a counted event"""
+
+
+class _NoPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+# shared by every phase while instrumentation is off, so it costs no more
+# than a global lookup and an attribute check
+_NO_PHASE = _NoPhase()
+_instrumentation = None
+
+
+def set_instrumentation(instrumentation):
+    """Sets the :class:`Instrumentation` receiving timings and counts, or None to turn it off.
+
+    Returns:
+        The previous instrumentation.
+    """
+    global _instrumentation
+    previous, _instrumentation = _instrumentation, instrumentation
+    return previous
+
+
+def _phase(name):
+    instrumentation = _instrumentation
+    if instrumentation is None:
+        return _NO_PHASE
+    return instrumentation.phase(name)
+
+
+def _count(name, value=1):
+    instrumentation = _instrumentation
+    if instrumentation is not None:
+        instrumentation.count(name, value)
+
+
+_COUNTS = (
+    ('bytes_sent', 'Bytes of mail data written to mail servers'),
+    ('recipients_accepted', 'Recipients accepted by mail servers'),
+    ('recipients_refused', 'Recipients refused by mail servers'),
+    ('pool_hits', 'Pooled sessions reused'),
+    ('pool_misses', 'Connections made by pools lacking a reusable session'),
+    ('relay_failovers', 'Mails sent to another relay after one failed'),
+)
+
+
+class PrometheusInstrumentation(Instrumentation):
+    """Exports phase timings as a histogram and counts as counters with prometheus_client.
+
+    Requires the ``prometheus_client`` package.
+
+    Args:
+        registry (:class:`prometheus_client.CollectorRegistry`, optional):
+            registry of the metrics. Defaults to the global one.
+        namespace (:obj:`str`): prefix of the metric names.
+    """
+
+    def __init__(self, registry=None, namespace='send_mail'):
+        from prometheus_client import REGISTRY, Counter, Histogram
+
+        registry = REGISTRY if registry is None else registry
+        self.phase_seconds = Histogram(
+            'phase_seconds', 'Time spent in each phase of sending mails', ['phase'],
+            namespace=namespace, registry=registry
+        )
+        self.counters = dict(
+            (name, Counter(name, documentation, namespace=namespace, registry=registry))
+            for name, documentation in _COUNTS
+        )
+
+    def timing(self, phase, seconds):
+        self.phase_seconds.labels(phase).observe(seconds)
+
+    def count(self, name, value=1):
+        counter = self.counters.get(name)
+        if counter is not None:
+            counter.inc(value)
+
+
+class OpenTelemetryInstrumentation(Instrumentation):
+    """Traces phases as OpenTelemetry spans, and counts as events of the current span.
+
+    Requires the ``opentelemetry-api`` package.
+
+    Args:
+        tracer (:class:`opentelemetry.trace.Tracer`, optional): tracer
+            creating the spans. Defaults to one named ``send_mail`` from the
+            global tracer provider.
+    """
+
+    def __init__(self, tracer=None):
+        from opentelemetry import trace
+
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer('send_mail')
+
+    def phase(self, name):
+        return self.tracer.start_as_current_span('send_mail.' + name)
+
+    def count(self, name, value=1):
+        span = self._trace.get_current_span()
+        if span.is_recording():
+            span.add_event('send_mail.' + name, {'value': value})
+
 
 # least buggy regex from http://www.regular-expressions.info/email.html
 MAIL_ADDRESS_RE = re.compile(r'\b[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,}\b', re.I)
@@ -71,233 +331,3906 @@ def _parse_mail_address(address):
         return address
 
 
-def _parse_multiple_mail_addresses(addresses):
-    """Parses multiple mail addresses into final format"""
-    addresses = addresses if isinstance(addresses, list) else list(map(six.text_type.strip, addresses.split(',')))
-    for key, mail_address in enumerate(addresses):
-        if not _is_valid_mail_address(mail_address):
-            raise Exception('Invalid Address: "%s"' % six.text_type(mail_address))
-        else:
-            addresses[key] = _parse_mail_address(mail_address)
+# parsed addresses with their header rendering, by the value they were given as
+_address_cache = _LRUCache(64 * 1024)
 
-    return addresses
 
+class _AddressList(object):
+    """Parsed and de-duplicated addresses, ready for the envelope and headers.
 
-def send_mail(
-        subject,
-        message='', html_message='',
-        to=None, cc=None, bcc=None,
-        sender=None, reply_to=None,
-        attachments=None,
-        custom_headers=None,
-        logger=None,
-        **kwargs
-):
-    """Sends an email.
+    Addresses are compared case-insensitively, and only the first of
+    several equal ones is kept.
 
-    Single emails addresses can be provided as strings like `'pphagula@gmail.com'`
-    or name-address tuples like `('Paulo Phagula', 'pphagula@gmail.com'')`
+    Attributes:
+        addresses (:obj:`list`): ``(name, address)`` tuples, where name is
+            False for bare addresses.
+    """
 
-    Multiple email addresses can be provided as CSV strings like `'email@example.com, email2@example.com'`
-    or lists mixing singular address style `['email@example.com', (Example, email@example.com)]`
+    __slots__ = ('addresses', '_formatted', '_seen')
 
-    Attachments can be passed as a CSV string with full paths to the
-    desired files.
+    def __init__(self):
+        self.addresses = []
+        self._formatted = []
+        self._seen = set()
 
-    Args:
-        subject (:obj:`str`): Subject line for this e-mail message.
-        message (:obj:`str`): Plain-text message body.
-        html_message (:obj:`str`): HTML message body.
-        to: Recipients address collection
-        cc: Carbon Copy (CC) recipients address collection
-        bcc: Blind Carbon Copy (BCC) recipients address collection
-        sender: Sender email address as it appears in the 'From' email line.
-        reply_to: List of addresses to reply to for the mail message.
-        attachments: Attachments collection used to store data
-            attached to this e-mail message.
-        custom_headers (:obj:`dict`, optional): Custom Headers to be added to the mail.
-        logger (:obj:`logging.Logger`,optional): Logger instance for logging
-            error and debug messages.
-        **kwargs: Arbitrary keywords arguments
+    def __len__(self):
+        return len(self.addresses)
 
-            If any of them is not provided they will be taken from
-            their environment variables equivalents (SMTP_<KEYWORD>) or
-            use default values.
+    def __iter__(self):
+        return iter(self.addresses)
 
-            - host (:obj:`str`, optional): mail server host. If not given uses :envvar:`SMTP_HOST`.
-            - port (:obj:`str` or :obj:`int`, optional): mail server port. If not given uses :envvar:`SMTP_PORT`.
-            - username (:obj:`str`, optional): mail server password. If not given uses :envvar:`SMTP_USERNAME`.
-            - password (:obj:`str`, optional): mail server password. If not given uses :envvar:`SMTP_PASSWORD`.
-            - use_tls (:obj:`bool`, optional): connect using TLS flag. If not given uses :envvar:`SMTP_USE_TLS`. Defaults to False
-            - use_ssl (:obj:`bool`, optional): connect using SSL flag. If not given uses :envvar:`SMTP_USE_SSL`.  Defaults to False
-            - debug (:obj:`bool`, optional): debug mode enabling flag. If not given uses :envvar:`SMTP_DEBUG`.Defaults to False
+    def _add(self, parsed, formatted):
+        key = parsed[1].lower()
+        if key not in self._seen:
+            self._seen.add(key)
+            self.addresses.append(parsed)
+            self._formatted.append(formatted)
 
-    Raises:
-        ValueError: if no recipient is given or no message is given.
+    def extend(self, other):
+        """Adds the addresses of another list which aren't here yet"""
+        for parsed, formatted in zip(other.addresses, other._formatted):
+            self._add(parsed, formatted)
 
-    .. envvar:: SMTP_HOST
-        Mail server host.
+    @property
+    def envelope(self):
+        """Bare addresses, as given to RCPT TO"""
+        return [parsed[1] for parsed in self.addresses]
 
-    .. envvar:: SMTP_PORT
-        Mail server port.
+    @property
+    def header(self):
+        """Addresses rendered for a To, Cc or Reply-To header"""
+        return COMMASPACE.join(self._formatted)
 
-    .. envvar:: SMTP_USERNAME
-        Mail server username for login.
 
-    .. envvar:: SMTP_PASSWORD
-        Mail server password for login.
+def _parse_address_list(addresses):
+    """Parses, validates and de-duplicates addresses in a single pass.
 
-    .. envvar:: SMTP_USE_TLS
-        Flag indicating if connection should be made using TLS.
+    Addresses are given as a CSV string or a list mixing strings and
+    name-address tuples. Each distinct value is validated and rendered
+    once, and remembered in a bounded cache for later calls.
 
-    .. envvar:: SMTP_USE_SSL
-        Flag indicating if connection to server should be made using SSL.
+    Returns:
+        :class:`_AddressList`: the parsed addresses.
 
-    .. envvar:: SMTP_DEBUG
-        Flag indicating if debug mode is enabled.abs
+    Raises:
+        Exception: if any address is invalid.
     """
+    if isinstance(addresses, six.string_types):
+        addresses = addresses.split(',')
 
-    # 1. Parse and Validate Email details
+    addresses = [
+        mail_address.strip() if isinstance(mail_address, six.string_types) else mail_address
+        for mail_address in addresses
+    ]
+    entries = _address_cache.get_many(addresses)
+    new_entries = []
+
+    for index, entry in enumerate(entries):
+        if entry is None:
+            mail_address = addresses[index]
+            is_string = isinstance(mail_address, six.string_types)
 
-    if sender:
-        sender = _parse_mail_address(sender)
+            if not (MAIL_ADDRESS_RE.match(mail_address) if is_string else _is_valid_mail_address(mail_address)):
+                raise Exception('Invalid Address: "%s"' % six.text_type(mail_address))
 
-    if reply_to:
-        reply_to = _parse_multiple_mail_addresses(reply_to)
+            parsed = (False, mail_address) if is_string else mail_address
+            entries[index] = entry = (parsed, formataddr(parsed))
+            new_entries.append((mail_address, entry))
 
-    all_destinations = []
+    if new_entries:
+        _address_cache.put_many(new_entries)
 
-    if to:
-        to = _parse_multiple_mail_addresses(to)
-        all_destinations.extend(to)
+    parsed_list = _AddressList()
+    seen, kept, formatted_kept = parsed_list._seen, parsed_list.addresses, parsed_list._formatted
+    for parsed, formatted in entries:
+        key = parsed[1].lower()
+        if key not in seen:
+            seen.add(key)
+            kept.append(parsed)
+            formatted_kept.append(formatted)
 
-    if cc:
-        cc = _parse_multiple_mail_addresses(cc)
-        all_destinations.extend(cc)
+    return parsed_list
 
-    if bcc:
-        bcc = _parse_multiple_mail_addresses(cc)
-        all_destinations.extend(bcc)
 
-    if len(all_destinations) == 0:
-        raise ValueError('At least one recipient must be specified')
+def _parse_bool(value):
+    """Parses flag values which may come from environment variables as strings"""
+    if value in ("False", "false", "0", ""):
+        return False
 
-    if message and not isinstance(message, six.text_type):
-        raise ValueError('message must be a string')
+    return bool(value)
 
-    if html_message and not isinstance(html_message, six.text_type):
-        raise ValueError('html_message must be a string')
 
-    # 2. Setup email object with basic details
+_CONNECTION_ARGUMENTS = ('host', 'port', 'username', 'password', 'use_tls', 'use_ssl', 'debug')
 
-    mail = MIMEMultipart()
-    body = MIMEMultipart('alternative')
 
-    html2text_converter = html2text.HTML2Text()
+class MailerConfig(object):
+    """Mail server connection settings, resolved and validated once.
 
-    if sender:
-        mail['From'] = formataddr(sender)
+    Each setting is taken from its keyword or, when that's not given, from
+    the matching ``SMTP_HOST``, ``SMTP_PORT``, ``SMTP_USERNAME``,
+    ``SMTP_PASSWORD``, ``SMTP_USE_TLS``, ``SMTP_USE_SSL`` or ``SMTP_DEBUG``
+    environment variable. Passing a config to :func:`send_mail` and friends
+    through the ``config`` keyword spares them resolving it on every call.
 
-    if to:
-        mail['To'] = COMMASPACE.join(list(map(formataddr, to)))
+    Example::
 
-    if cc:
-        mail['Cc'] = COMMASPACE.join(list(map(formataddr, cc)))
+        config = MailerConfig(port=587, use_tls=True)  # host and login from the environment
+        for report in reports:
+            send_mail(report.subject, message=report.body, to=report.to, config=config)
 
-    if reply_to:
-        mail['Reply-To'] = COMMASPACE.join(list(map(formataddr, reply_to)))
+    Args:
+        host (:obj:`str`, optional): mail server host.
+        port (:obj:`int`, optional): mail server port.
+        username (:obj:`str`, optional): login username.
+        password (:obj:`str`, optional): login password.
+        use_tls (:obj:`bool`, optional): upgrade the connection with STARTTLS.
+        use_ssl (:obj:`bool`, optional): connect over SSL.
+        debug (:obj:`bool`, optional): print the SMTP conversation.
+        environ (:obj:`dict`, optional): variables to fall back on. Defaults
+            to :data:`os.environ`.
 
-    mail['Date'] = formatdate(localtime=True)
-    mail['Message-ID'] = make_msgid()
-    mail['Subject'] = subject
-    mail.preamble = subject
+    Attributes:
+        settings (:obj:`dict`): the resolved settings, as keywords for
+            :meth:`SMTPConnectionPool.acquire`.
 
-    if html_message and not message:
-        message = html2text_converter.handle(message)
+    Raises:
+        ValueError: if the host or port are missing or invalid, or both TLS
+            and SSL are asked for.
+    """
 
-    # Add missing charset email charset and email encodings
-    # https://stackoverflow.com/questions/9403265/how-do-i-use-python-3-2-email-module-to-send-unicode-messages-encoded-in-utf-8-w
-    charset.add_charset('utf-8', charset.QP, charset.QP)
+    def __init__(self, host=None, port=None, username=None, password=None, use_tls=False, use_ssl=False,
+                 debug=False, environ=None):
+        self._keywords = {
+            'host': host,
+            'port': port,
+            'username': username,
+            'password': password,
+            'use_tls': use_tls,
+            'use_ssl': use_ssl,
+            'debug': debug,
+        }
+        self._environ = environ
+        self.settings = None
+        self.reload()
 
-    # NOTE: We must always attach plain text mail before html, otherwise we'll break Gmail
-    if message:
-        body.attach(MIMEText(message, 'plain', 'utf-8'))
+    def __getattr__(self, name):
+        if name in _CONNECTION_ARGUMENTS and self.settings is not None:
+            return self.settings[name]
+        raise AttributeError(name)
 
-    if html_message:
-        body.attach(MIMEText(html_message, 'html', 'utf-8'))
+    def __repr__(self):
+        return '<MailerConfig host=%r port=%r username=%r use_tls=%r use_ssl=%r>' % (
+            self.host, self.port, self.username, self.use_tls, self.use_ssl
+        )
 
-    mail.attach(body)
+    def reload(self):
+        """Resolves the settings again, picking up changed environment variables.
 
-    # 3. Add attachments to email
+        Raises:
+            ValueError: if the new settings are invalid, in which case the
+                current ones are kept.
+        """
+        environ = os.environ if self._environ is None else self._environ
+        keywords = self._keywords
 
-    if attachments:
-        attachments = attachments if isinstance(attachments, list) else list(map(six.text_type.strip, attachments.split(',')))
-        for file_path in attachments:
-            try:
-                if not os.path.isfile(file_path):
-                    raise ValueError('File for attachment "%s" not found in file system' % six.text_type(file_path))
+        host = keywords['host'] or environ.get('SMTP_HOST')
+        port = keywords['port'] or environ.get('SMTP_PORT')
+        username = keywords['username'] or environ.get('SMTP_USERNAME')
+        password = keywords['password'] or environ.get('SMTP_PASSWORD')
+        use_tls = _parse_bool(keywords['use_tls'] or environ.get('SMTP_USE_TLS', False))
+        use_ssl = _parse_bool(keywords['use_ssl'] or environ.get('SMTP_USE_SSL', False))
+        debug = _parse_bool(keywords['debug'] or environ.get('SMTP_DEBUG', False))
 
-                with open(file_path, 'rb') as f:
-                    attachment = MIMEBase('application', "octet-stream")
-                    attachment.set_payload(f.read())
-                    encoders.encode_base64(attachment)
-                    file_name = os.path.basename(file_path)
-                    attachment.add_header('Content-Disposition', 'attachment; filename="%s"' % file_name)
-                    mail.attach(attachment)
-            except Exception as ex:
-                if logger is not None:
-                    logger.error("Unable to open one of the attachments. Error: %s" % six.text_type(ex))
-                raise
+        if not host:
+            raise ValueError('No mail server host given nor set in SMTP_HOST')
 
-    # 4. Add custom headers to email
+        try:
+            port = int(port)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid mail server port: "%s"' % port)
 
-    if custom_headers:
-        for k, v in six.iteritems(custom_headers):
-            mail.add_header(k, v)
+        if not 0 < port < 65536:
+            raise ValueError('Invalid mail server port: "%s"' % port)
 
-    # 5. Connect to mail server and send email
+        if use_tls and use_ssl:
+            raise ValueError('use_tls and use_ssl are mutually exclusive')
 
-    host = kwargs.get('host', None) or os.getenv('SMTP_HOST')
-    port = kwargs.get('port', None) or os.getenv('SMTP_PORT')
-    port = int(port)
-    username = kwargs.get('username', None) or os.getenv('SMTP_USERNAME')
-    password = kwargs.get('password', None) or os.getenv('SMTP_PASSWORD')
-    use_tls = kwargs.get('use_tls', False) or os.getenv('SMTP_USE_TLS', False)
-    use_ssl = kwargs.get('use_ssl', False) or os.getenv('SMTP_USE_SSL', False)
-    debug = kwargs.get('debug', False) or os.getenv('SMTP_DEBUG', False)
+        if six.PY2 and password is not None:
+            password = six.binary_type(password)
 
-    if six.PY2:
-        password = six.binary_type(password)
+        # replaced whole, so threads sending meanwhile see either version
+        self.settings = {
+            'host': host,
+            'port': port,
+            'username': username,
+            'password': password,
+            'use_tls': use_tls,
+            'use_ssl': use_ssl,
+            'debug': debug,
+        }
 
-    if use_tls in ("False", "false"):
-        use_tls = False
+    def replace(self, **kwargs):
+        """Returns a copy of this config with some keywords changed"""
+        keywords = dict(self._keywords, **kwargs)
+        return MailerConfig(environ=self._environ, **keywords)
 
-    if use_ssl in ("False", "false"):
-        use_ssl = False
 
-    if debug in ("False", "false"):
-        debug = False
+def _get_connection_settings(kwargs):
+    """Resolves mail server connection details from keywords, a config or environment variables"""
+    # a transport's own settings stand in for missing ones
+    config = kwargs.get('config', None) or getattr(_get_transport(kwargs), 'config', None)
+    overrides = dict((name, kwargs[name]) for name in _CONNECTION_ARGUMENTS if kwargs.get(name, None))
 
-    try:
-        # this doesn't support `with` statement so we do `close` the old way.
+    if config is None:
+        return MailerConfig(**overrides).settings
+
+    if overrides:
+        return config.replace(**overrides).settings
+
+    return config.settings
+
+
+def _connect(host, port, username=None, password=None, use_tls=False, use_ssl=False, debug=False):
+    """Opens an identified and authenticated connection to the mail server"""
+    # this doesn't support `with` statement so we do `close` the old way.
+    with _phase('connect'):
         mail_server = smtplib.SMTP_SSL(host, port) if use_ssl else smtplib.SMTP(host, port)
 
+    try:
+        # commands and the end of the mail are small writes, which Nagle's
+        # algorithm would otherwise hold back until the server's delayed ACK
+        mail_server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
         if debug:
             mail_server.set_debuglevel(1)
 
-        mail_server.ehlo()  # identify ourselves, prompting server for supported features
+        with _phase('ehlo'):
+            mail_server.ehlo()  # identify ourselves, prompting server for supported features
 
         if use_tls:
-            mail_server.starttls()
-            mail_server.ehlo()  # re-identify ourselves over TLS connection
+            with _phase('tls'):
+                mail_server.starttls()
+                mail_server.ehlo()  # re-identify ourselves over TLS connection
 
         if username and password:
-            mail_server.login(username, password)
-
-        mail_server.sendmail(subject, list(map(lambda x: x[1], all_destinations)), mail.as_string())
-        # Should be mailServer.quit(), but that crashes...
+            with _phase('auth'):
+                mail_server.login(username, password)
+    except Exception:
         mail_server.close()
-    except Exception as ex:
-        if logger is not None:
-            logger.error("Unable to send the email. Error: %s" % str(ex))
         raise
+
+    return mail_server
+
+
+# envelope commands written at once before reading their replies, few enough
+# for the replies to fit in the socket buffers while the commands are written
+_PIPELINE_GROUP = 100
+
+
+def _send_envelope(mail_server, from_addr, to_addrs):
+    """Runs MAIL and RCPT one command at a time, returning the refused recipients"""
+    code, response = mail_server.mail(from_addr)
+    if code != 250:
+        mail_server.rset()
+        raise smtplib.SMTPSenderRefused(code, response, from_addr)
+
+    refused = {}
+    for to_addr in to_addrs:
+        code, response = mail_server.rcpt(to_addr)
+        if code not in (250, 251):
+            refused[to_addr] = (code, response)
+
+    return refused
+
+
+def _send_envelope_pipelined(mail_server, from_addr, to_addrs):
+    """Runs MAIL and RCPT in groups of commands (RFC 2920), returning the refused recipients"""
+    commands = ['MAIL FROM:%s\r\n' % smtplib.quoteaddr(from_addr)]
+    commands.extend('RCPT TO:%s\r\n' % smtplib.quoteaddr(to_addr) for to_addr in to_addrs)
+
+    replies = []
+    for start in range(0, len(commands), _PIPELINE_GROUP):
+        group = commands[start:start + _PIPELINE_GROUP]
+        mail_server.send(''.join(group))
+        replies.extend(mail_server.getreply() for _ in group)
+
+    code, response = replies[0]
+    if code != 250:
+        mail_server.rset()
+        raise smtplib.SMTPSenderRefused(code, response, from_addr)
+
+    return dict(
+        (to_addr, (code, response))
+        for to_addr, (code, response) in zip(to_addrs, replies[1:])
+        if code not in (250, 251)
+    )
+
+
+def _iter_unstuffed(chunks):
+    """Undoes the dot-stuffing of DATA-ready chunks, as BDAT takes the mail as is.
+
+    Every line starting with a dot was given another one, so the first dot
+    of each line is dropped. A chunk ending in CR is held back until the next
+    one, so a line break split between chunks is still seen.
+    """
+    at_line_start = True
+    carry = b''
+    for chunk in chunks:
+        chunk = carry + chunk
+        carry = b''
+        if chunk.endswith(b'\r'):
+            chunk, carry = chunk[:-1], b'\r'
+        if not chunk:
+            continue
+        if at_line_start and chunk.startswith(b'.'):
+            chunk = chunk[1:]
+        at_line_start = chunk.endswith(b'\r\n')
+        yield chunk.replace(b'\r\n.', b'\r\n')
+
+    if carry:
+        yield carry
+
+
+class MailReadError(Exception):
+    """Raised when the mail, e.g. one of its attachments, can't be read while it's being sent.
+
+    The mail server isn't at fault, so neither pools nor relays retry the
+    mail or count it against the server. The original error is chained as
+    the cause.
+    """
+
+
+def _iter_body(mail_server, chunks):
+    """Iterates the chunks of a mail whose transaction started, closing the session if reading them fails.
+
+    Once DATA or BDAT started, the server takes whatever comes next as mail
+    data, so the session can't be reset and reused, and pools discard it.
+    The error is raised again as :class:`MailReadError`.
+    """
+    chunks = iter(chunks)
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        except Exception as ex:
+            mail_server.close()
+            six.raise_from(MailReadError('Reading the mail failed while sending it: %s' % ex), ex)
+        yield chunk
+
+
+class _DeliveryUnknown(smtplib.SMTPServerDisconnected):
+    """Raised when the session is lost after the end of a mail was sent, so it may have been delivered"""
+
+
+@contextmanager
+def _ending_mail(ending=True):
+    """Raises connection errors as :class:`_DeliveryUnknown` while the end of a mail is sent.
+
+    Once the server may have received the whole mail, resending it over
+    another session could deliver it twice.
+    """
+    if not ending:
+        yield
+        return
+
+    try:
+        yield
+    except Exception as ex:
+        if not _is_connection_error(ex) or isinstance(ex, _DeliveryUnknown):
+            raise
+        six.raise_from(_DeliveryUnknown('Connection lost once the mail was sent: %s' % ex), ex)
+
+
+def _send_body(mail_server, msg):
+    """Sends the mail with DATA, checking the server took it"""
+    code, response = mail_server.docmd('data')
+    if code != 354:
+        mail_server.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+    sent = 0
+    for chunk in _iter_body(mail_server, msg):
+        mail_server.send(chunk)
+        sent += len(chunk)
+
+    with _ending_mail():
+        mail_server.send(b'.\r\n')
+        _count('bytes_sent', sent + 3)
+        code, response = mail_server.getreply()
+    if code != 250:
+        mail_server.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+
+def _send_body_chunked(mail_server, msg, pipelining=False):
+    """Sends the mail in BDAT chunks (RFC 3030), checking the server took them.
+
+    With PIPELINING the chunks are written without waiting for each reply,
+    which are all read once the last chunk was sent.
+    """
+    replies = 0
+    sent = 0
+    failure = None
+    chunks = _iter_body(mail_server, _iter_unstuffed(msg))
+    chunk = next(chunks, None)
+    if chunk is None:
+        with _ending_mail():
+            mail_server.send(b'BDAT 0 LAST\r\n')
+        replies += 1
+    while chunk is not None:
+        # One chunk is held back so the last one carries LAST itself: a
+        # separate empty BDAT would cost every mail an extra round trip
+        following = next(chunks, None)
+        with _ending_mail(following is None):
+            last = b' LAST' if following is None else b''
+            mail_server.send(b'BDAT %d%s\r\n' % (len(chunk), last) + chunk)
+            sent += len(chunk)
+            replies += 1
+            if not pipelining:
+                code, response = mail_server.getreply()
+                replies -= 1
+                if code != 250:
+                    failure = code, response
+                    break
+        chunk = following
+
+    _count('bytes_sent', sent)
+
+    # pipelined replies are only read once the whole mail was sent
+    with _ending_mail(replies > 0):
+        for _ in range(replies):
+            code, response = mail_server.getreply()
+            if code != 250 and failure is None:
+                failure = code, response
+
+    if failure is not None:
+        mail_server.rset()
+        raise smtplib.SMTPDataError(*failure)
+
+
+# line endings and leading dots of mails given as byte strings
+_BYTES_EOL_RE = re.compile(br'(?:\r\n|\n|\r(?!\n))')
+_LEADING_DOT_RE = re.compile(br'(?m)^\.')
+
+
+def _encode_data(msg):
+    """Turns a mail given as a string into a DATA-ready chunk, like :meth:`smtplib.SMTP.sendmail` does"""
+    if isinstance(msg, six.text_type):
+        data = _DataEncoder().encode(msg)
+    else:
+        data = _LEADING_DOT_RE.sub(b'..', _BYTES_EOL_RE.sub(b'\r\n', msg))
+
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return [data]
+
+
+def _sendmail(mail_server, from_addr, to_addrs, msg):
+    """Sends a mail given as a string or as DATA-ready byte chunks, e.g. a :class:`_StreamedMail`.
+
+    Chunked mails go through the same transaction :meth:`smtplib.SMTP.sendmail`
+    runs, but their chunks are written to the socket one by one instead of
+    being joined first. When the server supports them, the envelope commands
+    are pipelined and the mail is sent in BDAT chunks instead of with DATA.
+    Strings are encoded into one chunk first, so they're sent and counted the
+    same way.
+
+    Returns:
+        :obj:`dict`: refused recipients, as returned by :meth:`smtplib.SMTP.sendmail`.
+    """
+    if isinstance(msg, (six.text_type, six.binary_type)):
+        msg = _encode_data(msg)
+
+    mail_server.ehlo_or_helo_if_needed()
+    pipelining = mail_server.has_extn('pipelining')
+
+    with _phase('envelope'):
+        if pipelining:
+            refused = _send_envelope_pipelined(mail_server, from_addr, to_addrs)
+        else:
+            refused = _send_envelope(mail_server, from_addr, to_addrs)
+
+    _count('recipients_refused', len(refused))
+    if len(refused) == len(to_addrs):
+        mail_server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    with _phase('data'):
+        if mail_server.has_extn('chunking'):
+            _send_body_chunked(mail_server, msg, pipelining)
+        else:
+            _send_body(mail_server, msg)
+
+    _count('recipients_accepted', len(to_addrs) - len(refused))
+    return refused
+
+
+def _disconnect(mail_server):
+    """Politely ends a session with the mail server, closing the socket regardless"""
+    try:
+        mail_server.quit()
+    except (smtplib.SMTPException, socket.error):
+        pass
+    finally:
+        mail_server.close()
+
+
+def _is_connection_error(ex):
+    """Tells apart errors which leave a session unusable from mail server replies"""
+    if isinstance(ex, smtplib.SMTPServerDisconnected):
+        return True
+
+    # on Python 3 SMTPException is an OSError too, so check it's not a reply
+    return isinstance(ex, socket.error) and not isinstance(ex, smtplib.SMTPException)
+
+
+class _PooledSession(object):
+    """Bookkeeping for a mail server connection owned by a pool"""
+
+    def __init__(self, key, mail_server):
+        self.key = key
+        self.mail_server = mail_server
+        self.created_at = time.time()
+        self.last_used_at = self.created_at
+        self.reused = False
+
+
+class Transport(object):
+    """Delivers built mails, given as the ``transport`` of :func:`send_mail` and friends.
+
+    Building a mail, steps 1 to 4 of :func:`send_mail`, is the same whatever
+    delivers it. :class:`SMTPConnectionPool` and :class:`RelayPool` deliver
+    to mail servers, :class:`MXTransport` straight to the recipients' ones,
+    while :class:`MaildirTransport`, :class:`MboxTransport`
+    and :class:`PickupDirectoryTransport` write to local files.
+
+    Subclasses implement :meth:`sendmail`, and :meth:`close` if they hold on
+    to resources. They may be used from several threads at once.
+
+    Attributes:
+        config (:class:`MailerConfig`): settings used by the sending
+            functions when given none, or None.
+    """
+
+    config = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def sendmail(self, from_addr, to_addrs, msg, **settings):
+        """Delivers a mail.
+
+        Args:
+            from_addr (:obj:`str`): envelope sender.
+            to_addrs (:obj:`list`): envelope recipients.
+            msg: the mail, as a string or as DATA-ready byte chunks which can
+                be iterated more than once, like a :class:`_StreamedMail`.
+            **settings: connection settings resolved by the sending function.
+
+        Returns:
+            :obj:`dict`: refused recipients, as returned by :meth:`smtplib.SMTP.sendmail`.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Releases what the transport holds on to"""
+
+
+def _get_transport(kwargs):
+    """Transport given to a sending function, also taken as ``pool`` like before transports existed"""
+    return kwargs.get('transport', None) or kwargs.get('pool', None)
+
+
+class SMTPConnectionPool(Transport):
+    """Keeps authenticated mail server sessions alive for reuse between sends.
+
+    Sessions are keyed by host, port, username and TLS/SSL mode, so one pool
+    can be shared by sends targeting different servers or accounts.
+
+    Before an idle session is reused it is health-checked with ``RSET``, which
+    also clears any half-finished transaction. Dead sessions are discarded and
+    replaced by new connections, and a send whose reused session is dropped
+    by the server before the end of the mail was sent is retried once over a
+    fresh connection.
+
+    Example::
+
+        pool = SMTPConnectionPool(max_idle=2, max_lifetime=300)
+        for report in reports:
+            send_mail(report.subject, message=report.body, to=report.to, pool=pool)
+        pool.close()
+
+    Args:
+        max_idle (:obj:`int`): Maximum number of idle sessions kept per key.
+            Extra sessions are closed when they are released.
+        max_lifetime (:obj:`float`, optional): Seconds after which a session is
+            closed instead of reused, regardless of its health. ``None`` means
+            no limit.
+        max_idle_time (:obj:`float`, optional): Seconds a session may stay idle
+            before it is closed instead of reused. ``None`` means no limit.
+
+    Attributes:
+        hits (:obj:`int`): number of idle sessions reused.
+        misses (:obj:`int`): number of new connections made.
+    """
+
+    def __init__(self, max_idle=4, max_lifetime=300, max_idle_time=60):
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.max_idle_time = max_idle_time
+        self.hits = 0
+        self.misses = 0
+        self._idle = {}
+        self._in_use = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(host, port, username=None, use_tls=False, use_ssl=False):
+        return host, int(port), username, bool(use_tls), bool(use_ssl)
+
+    def _is_expired(self, session, now):
+        if self.max_lifetime is not None and now - session.created_at > self.max_lifetime:
+            return True
+
+        if self.max_idle_time is not None and now - session.last_used_at > self.max_idle_time:
+            return True
+
+        return False
+
+    @staticmethod
+    def _is_alive(session):
+        try:
+            return session.mail_server.rset()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def _pop_idle(self, key):
+        """Takes the most recently used idle session for key, if any is reusable"""
+        while True:
+            with self._lock:
+                sessions = self._idle.get(key)
+                if not sessions:
+                    return None
+                session = sessions.pop()
+
+            if not self._is_expired(session, time.time()) and self._is_alive(session):
+                return session
+
+            _disconnect(session.mail_server)
+
+    def acquire(self, host, port, username=None, password=None, use_tls=False, use_ssl=False, debug=False):
+        """Takes a session from the pool, connecting a new one if none is reusable.
+
+        Returns:
+            :class:`smtplib.SMTP`: Connected and authenticated mail server
+            session. It must be given back with :meth:`release`.
+        """
+        key = self._make_key(host, port, username, use_tls, use_ssl)
+        session = self._pop_idle(key)
+
+        if session is None:
+            with self._lock:
+                self.misses += 1
+            _count('pool_misses')
+            mail_server = _connect(host, port, username, password, use_tls, use_ssl, debug)
+            session = _PooledSession(key, mail_server)
+        else:
+            session.reused = True
+            _count('pool_hits')
+
+        with self._lock:
+            if session.reused:
+                self.hits += 1
+            self._in_use[id(session.mail_server)] = session
+
+        return session.mail_server
+
+    def release(self, mail_server, discard=False):
+        """Gives a session back to the pool.
+
+        Args:
+            mail_server (:class:`smtplib.SMTP`): session taken with :meth:`acquire`.
+            discard (:obj:`bool`): close the session instead of keeping it for
+                reuse, e.g. after it failed.
+        """
+        with self._lock:
+            session = self._in_use.pop(id(mail_server), None)
+
+            if session is not None and not discard:
+                session.last_used_at = time.time()
+                sessions = self._idle.setdefault(session.key, [])
+
+                if len(sessions) < self.max_idle and not self._is_expired(session, session.last_used_at):
+                    sessions.append(session)
+                    return
+
+        _disconnect(mail_server)
+
+    @contextmanager
+    def connection(self, **settings):
+        """Context manager which acquires a session and releases it afterwards.
+
+        The session is discarded if the block raises a connection error or
+        closed it.
+        """
+        mail_server = self.acquire(**settings)
+        try:
+            yield mail_server
+        except Exception as ex:
+            self.release(mail_server, discard=_is_connection_error(ex) or mail_server.sock is None)
+            raise
+        else:
+            self.release(mail_server)
+
+    def _is_reused(self, mail_server):
+        with self._lock:
+            return self._in_use[id(mail_server)].reused
+
+    def sendmail(self, from_addr, to_addrs, msg, **settings):
+        """Sends a message over a pooled session, reconnecting once if a reused one was dropped.
+
+        The message may be a string or DATA-ready byte chunks which can be
+        iterated more than once, like a :class:`_StreamedMail`. It is only
+        sent again if the session was lost before the end of the mail was
+        sent, as the server may have delivered it otherwise.
+
+        Returns:
+            :obj:`dict`: refused recipients, as returned by :meth:`smtplib.SMTP.sendmail`.
+        """
+        reused = False
+        try:
+            with self.connection(**settings) as mail_server:
+                reused = self._is_reused(mail_server)
+                return _sendmail(mail_server, from_addr, to_addrs, msg)
+        except Exception as ex:
+            if not reused or not _is_connection_error(ex) or isinstance(ex, _DeliveryUnknown):
+                raise
+
+            # the server may have timed out the idle session between the
+            # health check and the transaction, so give it one more try
+            with self.connection(**settings) as mail_server:
+                return _sendmail(mail_server, from_addr, to_addrs, msg)
+
+    def close(self):
+        """Closes all idle sessions held by the pool"""
+        with self._lock:
+            sessions = [session for key_sessions in self._idle.values() for session in key_sessions]
+            self._idle = {}
+
+        for session in sessions:
+            _disconnect(session.mail_server)
+
+
+# seconds assumed a mail takes through a relay which failed before sending any
+_FAILED_RELAY_LATENCY = 1.0
+
+
+class _Relay(object):
+    """Health of one relay of a :class:`RelayPool`"""
+
+    def __init__(self, config):
+        self.config = config
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def __repr__(self):
+        return '<Relay %s:%s latency=%r error_rate=%.2f in_flight=%d>' % (
+            self.config.host, self.config.port, self.latency, self.error_rate, self.in_flight
+        )
+
+
+def _is_relay_failure(ex):
+    """Tells apart errors worth retrying on another relay from those any relay would give"""
+    if _is_connection_error(ex) or isinstance(ex, smtplib.SMTPConnectError):
+        return True
+
+    # transient replies, e.g. 421 service not available or 451 local error
+    return (isinstance(ex, smtplib.SMTPResponseException) and 400 <= ex.smtp_code < 500 and
+            not isinstance(ex, smtplib.SMTPRecipientsRefused))
+
+
+class RelayPool(Transport):
+    """Spreads mails over several relays, failing over from those in trouble.
+
+    It sends like a :class:`SMTPConnectionPool`, so it can be given as the
+    ``pool`` of :func:`send_mail`, :func:`send_many`, :func:`send_merge` or a
+    :class:`Dispatcher`. Each mail goes to the relay with the lowest expected
+    cost: its moving average latency times the mails it has in flight, scaled
+    up by its moving average error rate. Relays not tried yet go first, while
+    those which only ever failed count as taking a second per mail.
+
+    When a relay can't be connected to, drops the session or gives a
+    transient 4xx reply, the already encoded mail is sent to the next best
+    relay instead. After ``failure_threshold`` failures in a row a relay's
+    circuit opens and it gets no mails for ``cooldown`` seconds, after which
+    the next mail probes it: success closes the circuit, failure reopens it.
+    Permanent 5xx replies are raised as they are, no relay would take that
+    mail.
+
+    Each relay connects with its own settings, the ones the sending function
+    resolved are only used for what isn't relay specific, like the envelope
+    sender fallback.
+
+    Example::
+
+        relays = RelayPool(['smtp1.example.com', 'smtp2.example.com:2525'], port=587, use_tls=True)
+        send_many(reports, pool=relays)
+        relays.close()
+
+    Args:
+        relays: the relays, each a :class:`MailerConfig`, a :obj:`dict` of
+            its keywords or a ``host`` or ``host:port`` string.
+        failure_threshold (:obj:`int`): failures in a row opening a relay's circuit.
+        cooldown (:obj:`float`): seconds an open circuit stays open.
+        smoothing (:obj:`float`): weight of the latest observation in the
+            moving averages, between 0 and 1.
+        max_idle (:obj:`int`): idle sessions kept per relay.
+        **kwargs: :class:`MailerConfig` keywords shared by the relays given as
+            strings or dicts, e.g. ``port``, ``username`` or ``use_tls``.
+
+    Attributes:
+        relays (:obj:`list`): state of each relay, with its ``config``,
+            ``latency`` and ``error_rate`` moving averages, mails ``in_flight``,
+            ``sent`` and ``failed`` counts and ``open_until`` time.
+        failovers (:obj:`int`): mails sent to another relay after one failed.
+
+    Raises:
+        ValueError: if no relay is given or one's settings are invalid.
+    """
+
+    def __init__(self, relays, failure_threshold=3, cooldown=30.0, smoothing=0.2, max_idle=4, **kwargs):
+        if isinstance(relays, (six.string_types, dict, MailerConfig)):
+            relays = [relays]
+        if not relays:
+            raise ValueError('No relay given')
+
+        self.relays = [_Relay(self._make_config(relay, kwargs)) for relay in relays]
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.failovers = 0
+        self._sessions = SMTPConnectionPool(max_idle=max_idle)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_config(relay, kwargs):
+        if isinstance(relay, MailerConfig):
+            return relay
+        if isinstance(relay, dict):
+            return MailerConfig(**dict(kwargs, **relay))
+
+        host, _, port = relay.rpartition(':') if ':' in relay else (relay, None, None)
+        return MailerConfig(**dict(kwargs, host=host, port=port or kwargs.get('port', None)))
+
+    @property
+    def config(self):
+        """Settings of the first relay, used by sending functions given no others"""
+        return self.relays[0].config
+
+    def _cost(self, relay):
+        if relay.consecutive_failures >= self.failure_threshold:
+            # its circuit is past its cool-down, so it's probed first
+            return 0.0, relay.in_flight
+
+        latency = relay.latency
+        if latency is None:
+            # relays not tried yet go first, those which only ever failed
+            # are weighed down by their error rate like the others
+            latency = _FAILED_RELAY_LATENCY if relay.failed else 0.0
+        return latency * (relay.in_flight + 1) / max(1.0 - relay.error_rate, 0.01), relay.in_flight
+
+    def _pick(self, tried):
+        """Takes the cheapest relay with a closed circuit not tried yet for the mail, if any"""
+        now = time.time()
+        with self._lock:
+            candidates = [
+                relay for relay in self.relays
+                if relay not in tried and relay.open_until <= now and not relay.probing
+            ]
+            if not candidates:
+                return None
+
+            relay = min(candidates, key=self._cost)
+            # a circuit past its cool-down lets a single mail through
+            relay.probing = relay.consecutive_failures >= self.failure_threshold
+            relay.in_flight += 1
+            return relay
+
+    def _record(self, relay, seconds=None):
+        """Updates a relay's health after a mail, ``seconds`` being None if it failed"""
+        alpha = self.smoothing
+        with self._lock:
+            relay.in_flight -= 1
+            relay.probing = False
+            relay.error_rate += alpha * ((0.0 if seconds is not None else 1.0) - relay.error_rate)
+
+            if seconds is not None:
+                relay.sent += 1
+                relay.consecutive_failures = 0
+                relay.latency = seconds if relay.latency is None else relay.latency + alpha * (seconds - relay.latency)
+            else:
+                relay.failed += 1
+                relay.consecutive_failures += 1
+                if relay.consecutive_failures >= self.failure_threshold:
+                    relay.open_until = time.time() + self.cooldown
+
+    def sendmail(self, from_addr, to_addrs, msg, **settings):
+        """Sends a message through the best relay, failing over to the others.
+
+        The message may be a string or DATA-ready byte chunks which can be
+        iterated more than once, like a :class:`_StreamedMail`. Each relay is
+        tried at most once.
+
+        Returns:
+            :obj:`dict`: refused recipients, as returned by :meth:`smtplib.SMTP.sendmail`.
+
+        Raises:
+            smtplib.SMTPConnectError: if every relay's circuit is open.
+        """
+        tried = []
+        error = None
+
+        while True:
+            relay = self._pick(tried)
+            if relay is None:
+                if error is not None:
+                    raise error
+                raise smtplib.SMTPConnectError(-1, 'No relay available, all circuits are open')
+
+            if tried:
+                with self._lock:
+                    self.failovers += 1
+                _count('relay_failovers')
+            tried.append(relay)
+
+            started_at = time.time()
+            try:
+                refused = self._sessions.sendmail(from_addr, to_addrs, msg, **relay.config.settings)
+            except Exception as ex:
+                if not _is_relay_failure(ex):
+                    # the relay answered, it's the mail that's refused
+                    self._record(relay, time.time() - started_at)
+                    raise
+                self._record(relay)
+                error = ex
+            else:
+                self._record(relay, time.time() - started_at)
+                return refused
+
+    def close(self):
+        """Closes all idle sessions to the relays"""
+        self._sessions.close()
+
+
+def _fsync_path(path):
+    """Flushes a file or directory to disk, given its path"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _GroupSync(object):
+    """Flushes a file or directory to disk for many writers at once.
+
+    A writer asking for a flush while one is running waits for the next,
+    which then covers every writer which asked meanwhile, so concurrent
+    deliveries share one fsync instead of queuing for one each.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.syncs = 0
+        self._requested = 0
+        self._synced = 0
+        self._syncing = False
+        self._condition = threading.Condition()
+
+    def sync(self):
+        with self._condition:
+            self._requested += 1
+            ticket = self._requested
+
+            while self._synced < ticket:
+                if self._syncing:
+                    self._condition.wait()
+                    continue
+
+                self._syncing = True
+                covered = self._requested
+                self._condition.release()
+                try:
+                    _fsync_path(self.path)
+                finally:
+                    self._condition.acquire()
+                    self._syncing = False
+                    self._condition.notify_all()
+                self._synced = covered
+                self.syncs += 1
+
+
+def _iter_mail_bytes(msg):
+    """Content of a mail given as a string or as DATA-ready byte chunks, in byte chunks"""
+    if isinstance(msg, six.text_type):
+        msg = msg.encode('utf-8')
+    if isinstance(msg, six.binary_type):
+        return [msg]
+    return _iter_unstuffed(msg)
+
+
+# lines mbox readers would take for the start of a mail, quoted the mboxrd way
+_MBOX_FROM_RE = re.compile(br'^(>*From )', re.M)
+
+
+def _iter_lf_chunks(chunks, quote_from=False):
+    """Turns CRLF line endings into LF ones, as local mailboxes store them.
+
+    Chunks are cut after their last line break and the rest carried over to
+    the next one, so line endings and ``From`` lines split between chunks are
+    still seen.
+    """
+    rest = b''
+    for chunk in chunks:
+        data = rest + bytes(chunk)
+        end = data.rfind(b'\n') + 1
+        data, rest = data[:end], data[end:]
+        if data:
+            data = data.replace(b'\r\n', b'\n')
+            yield _MBOX_FROM_RE.sub(br'>\1', data) if quote_from else data
+
+    if rest:
+        yield _MBOX_FROM_RE.sub(br'>\1', rest) if quote_from else rest
+
+
+_delivery_counter = itertools.count()
+
+
+def _make_delivery_name():
+    """Name unique to a mail written by this host and process, in the Maildir fashion"""
+    now = time.time()
+    host = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+    return '%d.M%dP%dQ%d.%s' % (now, (now % 1) * 1000000, os.getpid(), next(_delivery_counter), host)
+
+
+class _FileTransport(Transport):
+    """Writes each mail to its own file, moved in place once complete.
+
+    Mails are written to a temporary file renamed to its final name, so
+    readers never see a partial mail. With ``fsync`` the file is flushed to
+    disk before the rename and the directory after it, the latter shared by
+    the writers delivering at the same time.
+    """
+
+    def __init__(self, fsync=False):
+        self.fsync = fsync
+        # file transports connect nowhere, only the login matters as envelope sender fallback
+        self.config = MailerConfig(host='localhost', port=25)
+
+    def _write(self, tmp_path, final_path, chunks, directory_sync):
+        with _phase('data'):
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                    if self.fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.rename(tmp_path, final_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+            if self.fsync:
+                directory_sync.sync()
+
+
+class MaildirTransport(_FileTransport):
+    """Delivers mails to a Maildir, e.g. for a local mail reader or a test sink.
+
+    Each mail is written to ``tmp`` and renamed into ``new``, with a
+    ``Return-Path`` header holding the envelope sender and LF line endings.
+    All the envelope recipients are taken to share the Maildir.
+
+    Example::
+
+        with MaildirTransport('/var/mail/staging') as maildir:
+            send_mail('Report', message='...', to='you@example.com', transport=maildir)
+
+    Args:
+        directory (:obj:`str`): the Maildir, created if missing.
+        fsync (:obj:`bool`): flush mails to disk before returning.
+    """
+
+    def __init__(self, directory, fsync=False):
+        _FileTransport.__init__(self, fsync)
+        self.directory = directory
+        for name in ('tmp', 'new', 'cur'):
+            if not os.path.isdir(os.path.join(directory, name)):
+                os.makedirs(os.path.join(directory, name))
+        self._sync = _GroupSync(os.path.join(directory, 'new'))
+
+    def sendmail(self, from_addr, to_addrs, msg, **settings):
+        name = _make_delivery_name()
+        return_path = ('Return-Path: <%s>\n' % from_addr).encode('utf-8')
+        self._write(
+            os.path.join(self.directory, 'tmp', name), os.path.join(self.directory, 'new', name),
+            itertools.chain([return_path], _iter_lf_chunks(_iter_mail_bytes(msg))), self._sync
+        )
+        return {}
+
+
+class PickupDirectoryTransport(_FileTransport):
+    """Drops mails as ``.eml`` files in the pickup directory of a local MTA.
+
+    The envelope is given in ``X-Sender`` and ``X-Receiver`` headers before
+    the mail's own, as IIS SMTP and Exchange pickup directories expect. Mails
+    are written to hidden temporary files in the pickup directory unless a
+    ``tmp_directory`` on the same file system is given, for MTAs picking up
+    any file.
+
+    Args:
+        directory (:obj:`str`): the pickup directory, created if missing.
+        tmp_directory (:obj:`str`, optional): directory mails are written to
+            before being moved to the pickup one.
+        envelope_headers (:obj:`bool`): write the ``X-Sender`` and
+            ``X-Receiver`` headers.
+        fsync (:obj:`bool`): flush mails to disk before returning.
+    """
+
+    def __init__(self, directory, tmp_directory=None, envelope_headers=True, fsync=False):
+        _FileTransport.__init__(self, fsync)
+        self.directory = directory
+        self.tmp_directory = tmp_directory
+        self.envelope_headers = envelope_headers
+        for path in (directory, tmp_directory):
+            if path and not os.path.isdir(path):
+                os.makedirs(path)
+        self._sync = _GroupSync(directory)
+
+    def sendmail(self, from_addr, to_addrs, msg, **settings):
+        name = _make_delivery_name()
+        if self.tmp_directory:
+            tmp_path = os.path.join(self.tmp_directory, name + '.tmp')
+        else:
+            tmp_path = os.path.join(self.directory, '.' + name + '.tmp')
+
+        chunks = _iter_mail_bytes(msg)
+        if self.envelope_headers:
+            envelope = 'X-Sender: %s\r\n' % from_addr + ''.join('X-Receiver: %s\r\n' % to for to in to_addrs)
+            chunks = itertools.chain([envelope.encode('utf-8')], chunks)
+
+        self._write(tmp_path, os.path.join(self.directory, name + '.eml'), chunks, self._sync)
+        return {}
+
+
+class MboxTransport(Transport):
+    """Appends mails to an mbox file.
+
+    Each mail starts with a ``From`` line holding the envelope sender, has
+    LF line endings and its own lines starting with ``From`` quoted the
+    mboxrd way. Appends are serialized within the process and, where
+    :mod:`fcntl` is available, locked against other processes with
+    :func:`fcntl.flock`. A mail failing half-way is cut off the file again.
+
+    Args:
+        path (:obj:`str`): the mbox file, created if missing.
+        fsync (:obj:`bool`): flush mails to disk before returning, sharing
+            the flush between the writers appending at the same time.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.config = MailerConfig(host='localhost', port=25)
+        self._lock = threading.Lock()
+        self._sync = _GroupSync(path)
+
+    def sendmail(self, from_addr, to_addrs, msg, **settings):
+        from_line = 'From %s %s\n' % (from_addr or 'MAILER-DAEMON', time.asctime(time.gmtime()))
+
+        with _phase('data'):
+            with self._lock, open(self.path, 'ab') as f:
+                try:
+                    import fcntl
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                except ImportError:  # not on Windows
+                    pass
+
+                f.seek(0, os.SEEK_END)
+                start = f.tell()
+                try:
+                    f.write(from_line.encode('utf-8'))
+                    last = b''
+                    for chunk in _iter_lf_chunks(_iter_mail_bytes(msg), quote_from=True):
+                        f.write(chunk)
+                        last = chunk
+                    # mails are separated by an empty line
+                    f.write(b'\n' if last.endswith(b'\n') else b'\n\n')
+                    f.flush()
+                except Exception:
+                    f.truncate(start)
+                    raise
+
+            if self.fsync:
+                self._sync.sync()
+
+        return {}
+
+
+# seconds answers without MX records are cached, the domain then being its own mail server
+_IMPLICIT_MX_TTL = 300
+
+
+def _dns_mx_lookup(domain):
+    """Looks up the MX records of a domain with dnspython.
+
+    Domains without MX records are their own mail server (RFC 5321, section
+    5.1), which is all that's assumed of any domain without dnspython.
+
+    Returns:
+        :obj:`tuple`: the ``(preference, host)`` records, empty for domains
+        which don't exist, and the seconds they may be cached.
+    """
+    try:
+        import dns.resolver
+    except ImportError:
+        return [(0, domain)], _IMPLICIT_MX_TTL
+
+    # renamed from query in dnspython 2.0
+    resolve = getattr(dns.resolver, 'resolve', None) or dns.resolver.query
+    try:
+        answer = resolve(domain, 'MX')
+    except dns.resolver.NoAnswer:
+        return [(0, domain)], _IMPLICIT_MX_TTL
+    except dns.resolver.NXDOMAIN:
+        return [], _IMPLICIT_MX_TTL
+
+    return [(record.preference, record.exchange.to_text().rstrip('.')) for record in answer], answer.rrset.ttl
+
+
+class MXResolver(object):
+    """Finds the mail servers of domains, caching them as long as their records allow.
+
+    Example::
+
+        # every domain handled by a local stand-in, e.g. in tests
+        resolver = MXResolver(lookup=lambda domain: ([(10, '127.0.0.1:2525')], 300))
+
+    Args:
+        lookup: function taking a domain and returning its ``(preference,
+            host)`` MX records and the seconds they may be cached. Hosts may
+            carry a port as ``host:port``. Defaults to looking them up in DNS
+            with dnspython when installed, or taking every domain for its own
+            mail server otherwise.
+        max_domains (:obj:`int`): domains whose records are cached.
+        min_ttl (:obj:`float`): seconds records are cached at least.
+        max_ttl (:obj:`float`): seconds records are cached at most.
+
+    Attributes:
+        lookups (:obj:`int`): lookups made, the other resolutions being
+            answered from the cache.
+    """
+
+    def __init__(self, lookup=None, max_domains=4096, min_ttl=30, max_ttl=86400):
+        self.lookup = lookup or _dns_mx_lookup
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.lookups = 0
+        self._cache = _LRUCache(max_domains)
+
+    def resolve(self, domain):
+        """Finds the mail servers of a domain.
+
+        Servers of equal preference are shuffled on each call, spreading the
+        mails over them.
+
+        Returns:
+            :obj:`list`: the hosts in order of preference, empty if the domain
+            accepts no mail, e.g. it doesn't exist or has a null MX (RFC 7505).
+        """
+        import random
+
+        domain = domain.lower()
+        now = time.time()
+        cached = self._cache.get(domain)
+
+        if cached is None or cached[0] <= now:
+            records, ttl = self.lookup(domain)
+            self.lookups += 1
+            # a null MX is a single record with an empty host
+            records = [(preference, host) for preference, host in records if host]
+            cached = now + min(max(ttl, self.min_ttl), self.max_ttl), records
+            self._cache.put(domain, cached)
+
+        return [host for _, _, host in sorted((preference, random.random(), host) for preference, host in cached[1])]
+
+
+class MXTransport(Transport):
+    """Delivers mails straight to the mail servers of their recipients' domains.
+
+    Meant for domains close by, e.g. internal ones, sparing the hop through
+    a relay. Recipients are grouped by domain and the domains delivered in
+    parallel, each over pooled sessions to its mail servers, tried in order
+    of preference. The next server is tried when one can't be connected to
+    or gives a transient 4xx reply. Recipients of domains no server took the
+    mail for are reported as refused, with code -1 and the error for
+    temporary failures.
+
+    Example::
+
+        with MXTransport(workers=8) as transport:
+            send_mail('Deploy done', message='...', to=['ops@example.com', 'dev@example.org'],
+                      transport=transport)
+
+    Args:
+        resolver (:class:`MXResolver`, optional): finds the mail servers of
+            a domain. Any object with a ``resolve(domain)`` method returning
+            hosts in order of preference will do.
+        port (:obj:`int`): port of the mail servers, unless a host carries its own.
+        use_tls (:obj:`bool`): upgrade every connection with STARTTLS.
+        workers (:obj:`int`): domains delivered at once.
+        max_idle (:obj:`int`): idle sessions kept per mail server.
+    """
+
+    def __init__(self, resolver=None, port=25, use_tls=False, workers=4, max_idle=1):
+        self.resolver = resolver or MXResolver()
+        self.port = port
+        self.use_tls = use_tls
+        self.workers = workers
+        self.config = MailerConfig(host='localhost', port=port)
+        self._sessions = SMTPConnectionPool(max_idle=max_idle)
+        self._thread_pool = None
+        if workers > 1:
+            from multiprocessing.pool import ThreadPool
+            self._thread_pool = ThreadPool(workers)
+
+    def _split_host(self, host):
+        name, _, port = host.rpartition(':')
+        return (name, int(port)) if port.isdigit() else (host, self.port)
+
+    def _deliver_domain(self, from_addr, domain, recipients, msg):
+        """Delivers a mail to the recipients of one domain, returning those refused"""
+        try:
+            hosts = self.resolver.resolve(domain)
+        except Exception as ex:
+            return dict((recipient, (-1, six.text_type(ex))) for recipient in recipients)
+
+        if not hosts:
+            return dict((recipient, (550, 'No mail server accepts mail for %s' % domain)) for recipient in recipients)
+
+        error = None
+        for host in hosts:
+            host, port = self._split_host(host)
+            try:
+                return self._sessions.sendmail(from_addr, recipients, msg, host=host, port=port, use_tls=self.use_tls)
+            except smtplib.SMTPRecipientsRefused as ex:
+                return ex.recipients
+            except Exception as ex:
+                if not _is_relay_failure(ex):
+                    reply = (ex.smtp_code, ex.smtp_error) if isinstance(ex, smtplib.SMTPResponseException) else None
+                    return dict((recipient, reply or (-1, six.text_type(ex))) for recipient in recipients)
+                error = ex
+
+        return dict((recipient, (-1, six.text_type(error))) for recipient in recipients)
+
+    def sendmail(self, from_addr, to_addrs, msg, **settings):
+        """Delivers a mail to the mail servers of its recipients' domains.
+
+        Returns:
+            :obj:`dict`: refused recipients, as returned by :meth:`smtplib.SMTP.sendmail`.
+
+        Raises:
+            smtplib.SMTPRecipientsRefused: if every recipient was refused.
+        """
+        domains = OrderedDict()
+        for recipient in to_addrs:
+            domains.setdefault(recipient.rpartition('@')[2].lower(), []).append(recipient)
+
+        # encoded once for all the domains
+        if isinstance(msg, _StreamedMail) and not msg.has_streamed_attachments():
+            msg = list(msg)
+
+        def deliver(group):
+            return self._deliver_domain(from_addr, group[0], group[1], msg)
+
+        groups = list(domains.items())
+        if self._thread_pool is not None and len(groups) > 1:
+            outcomes = self._thread_pool.map(deliver, groups)
+        else:
+            outcomes = [deliver(group) for group in groups]
+
+        refused = {}
+        for domain_refused in outcomes:
+            refused.update(domain_refused)
+
+        if len(refused) == len(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    def close(self):
+        """Stops the delivering threads and closes all idle sessions to the mail servers"""
+        if self._thread_pool is not None:
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
+        self._sessions.close()
+
+
+# base64 lines are 76 characters long, encoding 57 bytes each, so reading
+# multiples of 57 bytes yields chunks which can be joined without re-wrapping
+_BASE64_LINE_BYTES = 57
+_STREAM_CHUNK_BYTES = _BASE64_LINE_BYTES * 1024
+
+# a lone CR or LF, or a CRLF, so any line ending is turned into CRLF
+_EOL_RE = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+
+
+def _iter_base64_file(file_path, chunk_size=_STREAM_CHUNK_BYTES):
+    """Encodes a file to base64 lines ending in CRLF, a chunk at a time.
+
+    The file is memory-mapped, so only the chunk being encoded is held in
+    memory regardless of the file's size.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in range(0, len(data), chunk_size):
+                yield encodebytes(data[offset:offset + chunk_size]).replace(b'\n', b'\r\n')
+        finally:
+            data.close()
+
+
+def _iter_base64_buffer(data, chunk_size=_STREAM_CHUNK_BYTES):
+    """Encodes a memoryview to base64 lines ending in CRLF, a chunk at a time, without copying it"""
+    for offset in range(0, len(data), chunk_size):
+        yield encodebytes(data[offset:offset + chunk_size]).replace(b'\n', b'\r\n')
+
+
+def _iter_base64_stream(stream, start=0, chunk_size=_STREAM_CHUNK_BYTES, lock=None):
+    """Encodes a binary file object to base64 lines ending in CRLF, a chunk at a time.
+
+    It is read from ``start`` into one reusable buffer. Every chunk but the
+    last is filled whole, even by streams returning less than asked for, so
+    chunks stay multiples of a base64 line.
+
+    Each chunk is read from this iteration's own position while holding
+    ``lock``, so iterations sharing the stream and the lock, like the
+    envelopes of a mail sent in parallel, don't move each other's position.
+    """
+    lock = lock or threading.Lock()
+    position = start
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    readinto = getattr(stream, 'readinto', None)
+
+    while True:
+        filled = 0
+        with lock:
+            stream.seek(position)
+            while filled < chunk_size:
+                if readinto is not None:
+                    read = readinto(view[filled:])
+                else:
+                    data = stream.read(chunk_size - filled)
+                    read = len(data) if data else 0
+                    view[filled:filled + read] = data
+                if not read:
+                    break
+                filled += read
+        position += filled
+
+        if filled:
+            yield encodebytes(view[:filled]).replace(b'\n', b'\r\n')
+        if filled < chunk_size:
+            return
+
+
+def _guess_content_type(file_name):
+    """MIME type for a file name, falling back to ``application/octet-stream``"""
+    import mimetypes
+    content_type, encoding = mimetypes.guess_type(file_name)
+    if content_type is None or encoding is not None:
+        return 'application/octet-stream'
+    return content_type
+
+
+class _StreamedAttachment(MIMEBase):
+    """File attachment whose content is only read and encoded while sending.
+
+    It has no payload of its own, :class:`_StreamedMail` writes the encoded
+    file content in its place.
+    """
+
+    def __init__(self, file_path, content_type='application/octet-stream'):
+        MIMEBase.__init__(self, *content_type.split('/', 1))
+        self.file_path = file_path
+        self['Content-Transfer-Encoding'] = 'base64'
+        self.set_payload('')
+
+    def iter_base64(self):
+        return _iter_base64_file(self.file_path)
+
+
+class _InMemoryAttachment(_StreamedAttachment):
+    """Attachment encoded while sending straight from a buffer or a seekable binary file object"""
+
+    def __init__(self, data, content_type='application/octet-stream'):
+        _StreamedAttachment.__init__(self, None, content_type)
+        if hasattr(data, 'read'):
+            self.stream, self.start, self.data = data, data.tell(), None
+            self._lock = threading.Lock()
+        else:
+            self.stream, self.start, self.data = None, 0, memoryview(data)
+            if six.PY3:
+                self.data = self.data.cast('B')
+
+    def iter_base64(self):
+        if self.stream is not None:
+            return _iter_base64_stream(self.stream, self.start, lock=self._lock)
+        return _iter_base64_buffer(self.data)
+
+
+class _DataEncoder(object):
+    """Turns text into DATA-ready bytes with CRLF line endings and dot-stuffing.
+
+    It remembers whether the last text ended a line, so a message can be
+    encoded piece by piece and still have its leading dots escaped.
+    """
+
+    def __init__(self):
+        self.at_line_start = True
+
+    def encode(self, text):
+        if not text:
+            return b''
+
+        text = _EOL_RE.sub('\r\n', text).replace('\r\n.', '\r\n..')
+        if self.at_line_start and text.startswith('.'):
+            text = '.' + text
+
+        self.at_line_start = text.endswith('\n')
+        return text.encode('utf-8')
+
+
+if six.PY2:
+    def _render_headers(part):
+        """Renders the part's headers just like ``as_string`` does"""
+        fp = six.StringIO()
+        Generator(fp, mangle_from_=False)._write_headers(part)
+        # the generator ends the headers with their blank line, which
+        # _iter_part_text writes itself
+        return fp.getvalue()[:-1]
+else:
+    def _render_headers(part):
+        """Renders the part's headers just like ``as_string`` does"""
+        policy = part.policy.clone(max_line_length=0)
+        return ''.join(policy.fold(name, value) for name, value in part.raw_items())
+
+
+def _iter_part_text(part):
+    """Walks a MIME tree once, yielding its rendering in text pieces.
+
+    The output matches ``as_string`` but for streamed attachments, whose
+    file paths are yielded as :class:`_StreamedAttachment` instances in
+    place of their content.
+    """
+    if part.is_multipart() and part.get_boundary() is None:
+        part.set_boundary(_make_boundary())
+
+    yield _render_headers(part)
+    yield '\n'
+
+    if isinstance(part, _StreamedAttachment):
+        yield part
+        return
+
+    if not part.is_multipart():
+        # get_payload() would copy the whole payload checking it for
+        # surrogates, which mails built here never have
+        payload = part._payload or ''
+        # big payloads go in slices, so they're never copied whole while encoding
+        start = 0
+        while start < len(payload):
+            end = payload.find('\n', start + _STREAM_CHUNK_BYTES)
+            end = len(payload) if end == -1 else end + 1
+            yield payload[start:end]
+            start = end
+        return
+
+    subparts = part.get_payload()
+
+    if part.get_content_maintype() == 'message':
+        for subpart in subparts:
+            for piece in _iter_part_text(subpart):
+                yield piece
+        return
+
+    boundary = part.get_boundary()
+
+    if part.preamble is not None:
+        yield part.preamble + '\n'
+
+    for index, subpart in enumerate(subparts):
+        yield ('\n--' if index else '--') + boundary + '\n'
+        for piece in _iter_part_text(subpart):
+            yield piece
+
+    yield '\n--' + boundary + '--\n'
+
+    if part.epilogue is not None:
+        yield part.epilogue
+
+
+def _iter_data(part, terminate=True):
+    """Renders a MIME part into DATA-ready byte pieces, encoding streamed attachments.
+
+    With ``terminate`` a last line lacking its line break is given one, as
+    DATA must end with one.
+    """
+    encoder = _DataEncoder()
+    for piece in _iter_part_text(part):
+        if isinstance(piece, _StreamedAttachment):
+            for chunk in piece.iter_base64():
+                yield chunk
+            encoder.at_line_start = True
+        else:
+            yield encoder.encode(piece)
+
+    if terminate and not encoder.at_line_start:
+        yield b'\r\n'
+
+
+class _StreamedMail(object):
+    """Mail serialized lazily into DATA-ready byte chunks.
+
+    The MIME tree is walked once and its rendering is encoded on the fly
+    with CRLF line endings and dot-stuffing, so chunks can be written to the
+    socket as they are, without first building the whole message as a
+    string and re-encoding it. Streamed attachments are encoded straight
+    from disk. Small pieces are gathered into chunks of about
+    ``chunk_size`` bytes to keep the number of socket writes down.
+
+    It can be iterated more than once, e.g. to retry a send. Iterating
+    yields the message without the final ``.`` line ending DATA.
+    """
+
+    def __init__(self, mail, chunk_size=64 * 1024):
+        self.mail = mail
+        self.chunk_size = chunk_size
+
+    def has_streamed_attachments(self):
+        return any(isinstance(part, _StreamedAttachment) for part in self.mail.walk())
+
+    def __iter__(self):
+        buffered, size = [], 0
+        for piece in _iter_data(self.mail):
+            if len(piece) >= self.chunk_size:
+                if buffered:
+                    yield b''.join(buffered)
+                    buffered, size = [], 0
+                yield piece
+                continue
+
+            buffered.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                yield b''.join(buffered)
+                buffered, size = [], 0
+
+        if buffered:
+            yield b''.join(buffered)
+
+
+class AttachmentCache(object):
+    """Keeps base64-encoded attachments to reuse them when the same files are sent again.
+
+    Files are identified by path, modification time and size, so a file
+    changed between sends is read again. With ``by_content`` they're
+    identified by a hash of their content instead, which still reads the
+    file but shares the encoding between copies of it.
+
+    Enable it for every send with :func:`set_attachment_cache`.
+
+    Args:
+        max_bytes (:obj:`int`): Maximum total size of the encoded
+            attachments kept. The least recently used are evicted first.
+        by_content (:obj:`bool`): key the cache by content hash.
+
+    Attributes:
+        hits (:obj:`int`): attachments taken from the cache.
+        misses (:obj:`int`): attachments which had to be encoded.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, by_content=False):
+        self.by_content = by_content
+        self._cache = _LRUCache(max_bytes, weigh=len)
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    @property
+    def size(self):
+        """Total size in bytes of the encoded attachments kept"""
+        return self._cache.weight
+
+    def clear(self):
+        self._cache.clear()
+
+    def get_attachment(self, file_path, content_type='application/octet-stream'):
+        """Makes a base64-encoded MIME part for the file, encoding it only if not cached"""
+        content = None
+        if self.by_content:
+            with open(file_path, 'rb') as f:
+                content = f.read()
+            key = hashlib.sha1(content).hexdigest()
+        else:
+            stat = os.stat(file_path)
+            key = (os.path.abspath(file_path), stat.st_mtime, stat.st_size)
+
+        encoded = self._cache.get(key)
+
+        if encoded is None:
+            if content is None:
+                with open(file_path, 'rb') as f:
+                    content = f.read()
+            encoded = encodebytes(content).decode('ascii')
+            self._cache.put(key, encoded)
+
+        attachment = MIMEBase(*content_type.split('/', 1))
+        attachment.set_payload(encoded)
+        attachment['Content-Transfer-Encoding'] = 'base64'
+        return attachment
+
+
+_attachment_cache = None
+
+
+def set_attachment_cache(cache):
+    """Makes every send use the given :class:`AttachmentCache`, or none if it's None.
+
+    Attachments which are streamed are never cached.
+
+    Returns:
+        The cache previously in use, if any.
+    """
+    global _attachment_cache
+    previous, _attachment_cache = _attachment_cache, cache
+    return previous
+
+
+# content types worth compressing, as prefixes
+_COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/xml', 'application/javascript')
+
+
+def _iter_source_chunks(source, chunk_size=_STREAM_CHUNK_BYTES):
+    """Reads an attachment's content, given as a file path, buffer or file object, a chunk at a time"""
+    if isinstance(source, six.string_types):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+    elif hasattr(source, 'read'):
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            yield chunk
+    else:
+        data = memoryview(source)
+        if six.PY3:
+            data = data.cast('B')
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+
+def _zip_from_file(archive, file_name, source):
+    """Adds an attachment to a zip archive from a file, for Pythons whose archives can't be written to as streams.
+
+    Buffers and file objects are copied to a temporary file first.
+
+    Returns:
+        :obj:`int`: the attachment's size.
+    """
+    if isinstance(source, six.string_types):
+        archive.write(source, file_name)
+        return os.path.getsize(source)
+
+    import tempfile
+
+    # closed before it's read again, which Windows needs
+    fd, path = tempfile.mkstemp()
+    try:
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in _iter_source_chunks(source):
+                f.write(chunk)
+                size += len(chunk)
+        archive.write(path, file_name)
+    finally:
+        os.remove(path)
+    return size
+
+
+class _CompressedAttachment(_StreamedAttachment):
+    """Attachment encoded while sending from the file it's being compressed to in the background"""
+
+    def __init__(self, result, content_type):
+        _StreamedAttachment.__init__(self, None, content_type)
+        self.result = result
+        self._lock = threading.Lock()
+
+    def iter_base64(self):
+        return _iter_base64_stream(self.result.get(), lock=self._lock)
+
+    def close(self):
+        """Deletes the compressed file, once compressing it is over"""
+        try:
+            compressed = self.result.get()
+        except Exception:
+            return  # compressing failed, leaving no file behind
+        compressed.close()
+
+
+def _close_attachments(mail):
+    """Releases what a mail's attachments hold on to, once it won't be sent again"""
+    for part in mail.walk():
+        if isinstance(part, _CompressedAttachment):
+            part.close()
+
+
+class AttachmentCompression(object):
+    """Policy compressing big attachments before they're encoded.
+
+    Attachments of compressible types, like CSV or JSON exports, at least
+    ``min_size`` bytes long are sent gzipped or zipped instead, renamed with
+    a ``.gz`` or ``.zip`` extension. They're compressed in chunks to
+    temporary files by a pool of worker threads, so memory stays bounded
+    and, as zlib releases the GIL, compression runs while the mail is being
+    connected and its other parts sent. Sending waits for the compressed
+    file only once it reaches the attachment.
+
+    Example::
+
+        compression = AttachmentCompression(min_size=512 * 1024)
+        send_mail('Export', message='...', to='you@example.com', attachments=['/tmp/export.csv'],
+                  compress_attachments=compression)
+        print('%.0f%% of the size in %.2fs' % (compression.ratio * 100, compression.seconds))
+
+    Args:
+        min_size (:obj:`int`): size in bytes from which attachments are compressed.
+        format (:obj:`str`): ``gzip`` or ``zip``.
+        level (:obj:`int`): compression level, from 1 (fastest) to 9 (smallest).
+        content_types: content types, or prefixes of them like ``text/``,
+            of the attachments to compress. ``None`` compresses any type.
+        workers (:obj:`int`): number of compressing threads.
+
+    Attributes:
+        compressed (:obj:`int`): attachments compressed.
+        bytes_in (:obj:`int`): total size of the attachments before compression.
+        bytes_out (:obj:`int`): total size of the attachments after compression.
+        seconds (:obj:`float`): time spent compressing, summed over the workers.
+
+    Mails built by the worker processes of a :class:`Dispatcher` given
+    ``build_processes`` are compressed by copies of the policy living in
+    those processes, so their attachments aren't counted in these
+    attributes.
+
+    Raises:
+        ValueError: if the format is unknown.
+    """
+
+    def __init__(self, min_size=1024 * 1024, format='gzip', level=6, content_types=_COMPRESSIBLE_TYPES, workers=2):
+        if format not in ('gzip', 'zip'):
+            raise ValueError('Unknown compression format: "%s"' % format)
+
+        self.min_size = min_size
+        self.format = format
+        self.level = level
+        self.content_types = content_types
+        self.workers = workers
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # sent to build processes without its threads, which can't be pickled
+        state = dict(self.__dict__, _pool=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def ratio(self):
+        """Compressed size over original size of all the attachments compressed, None if none was"""
+        return float(self.bytes_out) / self.bytes_in if self.bytes_in else None
+
+    def applies(self, source, content_type):
+        """Whether an attachment, given as a file path, buffer or file object, is to be compressed"""
+        if self.content_types is not None and not any(
+                content_type.startswith(compressible) for compressible in self.content_types):
+            return False
+
+        if isinstance(source, six.string_types):
+            size = os.path.getsize(source)
+        elif hasattr(source, 'read'):
+            start = source.tell()
+            size = source.seek(0, os.SEEK_END) - start
+            source.seek(start)
+        else:
+            # Python 2 views have no nbytes, and are of bytes
+            size = memoryview(source).nbytes if six.PY3 else len(source)
+
+        return size >= self.min_size
+
+    def compress(self, file_name, source):
+        """Starts compressing an attachment in the background.
+
+        Returns:
+            :obj:`tuple`: the MIME part of the compressed attachment and its file name.
+        """
+        with self._lock:
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.workers)
+
+        result = self._pool.apply_async(self._compress, (file_name, source))
+        if self.format == 'zip':
+            return _CompressedAttachment(result, 'application/zip'), file_name + '.zip'
+        return _CompressedAttachment(result, 'application/gzip'), file_name + '.gz'
+
+    def _compress(self, file_name, source):
+        import tempfile
+
+        started_at = time.time()
+        compressed = tempfile.TemporaryFile()
+        size = 0
+
+        with _phase('compress'):
+            if self.format == 'zip':
+                import zipfile
+                # zip archives are compressed at the default level before Python 3.7
+                options = {'compresslevel': self.level} if sys.version_info >= (3, 7) else {}
+                with zipfile.ZipFile(compressed, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, **options) as archive:
+                    if sys.version_info >= (3, 6):
+                        with archive.open(file_name, 'w', force_zip64=True) as f:
+                            for chunk in _iter_source_chunks(source):
+                                f.write(chunk)
+                                size += len(chunk)
+                    else:
+                        size = _zip_from_file(archive, file_name, source)
+            else:
+                import gzip
+                with gzip.GzipFile(file_name, 'wb', self.level, compressed) as f:
+                    for chunk in _iter_source_chunks(source):
+                        f.write(chunk)
+                        size += len(chunk)
+
+        elapsed = time.time() - started_at
+        with self._lock:
+            self.compressed += 1
+            self.bytes_in += size
+            self.bytes_out += compressed.tell()
+            self.seconds += elapsed
+
+        compressed.seek(0)
+        return compressed
+
+    def close(self):
+        """Stops the compressing threads once the attachments at hand are compressed"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _make_attachment(attachment, stream_attachments=False, compression=None):
+    """Makes the MIME part of one attachment, given as a file path, file object or tuple"""
+    if isinstance(attachment, six.string_types):
+        file_path = attachment
+        if not os.path.isfile(file_path):
+            raise ValueError('File for attachment "%s" not found in file system' % six.text_type(file_path))
+
+        file_name = os.path.basename(file_path)
+        content_type = _guess_content_type(file_name)
+
+        if compression is not None and compression.applies(file_path, content_type):
+            part, file_name = compression.compress(file_name, file_path)
+        elif stream_attachments:
+            part = _StreamedAttachment(file_path, content_type)
+        elif _attachment_cache is not None:
+            part = _attachment_cache.get_attachment(file_path, content_type)
+        else:
+            with open(file_path, 'rb') as f:
+                part = MIMEBase(*content_type.split('/', 1))
+                part.set_payload(f.read())
+                encoders.encode_base64(part)
+    else:
+        if isinstance(attachment, tuple):
+            file_name, data = attachment[:2]
+            content_type = attachment[2] if len(attachment) > 2 else None
+        else:
+            file_name, data, content_type = os.path.basename(getattr(attachment, 'name', 'attachment')), attachment, None
+
+        if hasattr(data, 'read') and not (hasattr(data, 'seekable') and data.seekable()):
+            # it can't be read again for a retry, so it's read now
+            data = data.read()
+
+        if six.PY2 and isinstance(data, six.binary_type):
+            # byte strings would be taken for file paths
+            data = memoryview(data)
+
+        content_type = content_type or _guess_content_type(file_name)
+
+        if compression is not None and compression.applies(data, content_type):
+            part, file_name = compression.compress(file_name, data)
+        else:
+            part = _InMemoryAttachment(data, content_type)
+
+    part.add_header('Content-Disposition', 'attachment; filename="%s"' % file_name)
+    return part
+
+
+def _make_attachments(attachments, logger=None, stream_attachments=False, compression=None):
+    """Makes MIME parts for the attachments.
+
+    Attachments are given as a CSV string of file paths, a single
+    attachment, or a list of them. Each is either a file path, a binary
+    file object with a ``name``, or a ``(file_name, data)`` or
+    ``(file_name, data, content_type)`` tuple whose data is :obj:`bytes`,
+    :obj:`bytearray`, :obj:`memoryview` or a binary file object. Content
+    types not given are guessed from the file names.
+
+    In-memory data and seekable file objects are encoded straight from
+    them while sending, so they must not change until the mail was sent.
+    Other file objects are read when the mail is built.
+
+    With a ``compression`` policy, attachments it applies to are replaced by
+    their compressed version.
+    """
+    if isinstance(attachments, six.string_types):
+        attachments = list(map(six.text_type.strip, attachments.split(',')))
+    elif not isinstance(attachments, list):
+        attachments = [attachments]
+
+    parts = []
+    for attachment in attachments:
+        try:
+            parts.append(_make_attachment(attachment, stream_attachments, compression))
+        except Exception as ex:
+            if logger is not None:
+                logger.error("Unable to open one of the attachments. Error: %s" % six.text_type(ex))
+            raise
+
+    return parts
+
+
+def _encode_part(part):
+    """Renders a MIME part into DATA-ready bytes"""
+    return b''.join(_iter_data(part, terminate=False))
+
+
+def _serialize_mail(mail):
+    """Renders the mail for sending as lazily encoded chunks"""
+    return _StreamedMail(mail)
+
+
+# headers signed by default, those missing from a mail are left out
+_DKIM_HEADERS = ('From', 'Reply-To', 'Subject', 'Date', 'To', 'Cc', 'Message-ID', 'MIME-Version', 'Content-Type')
+
+_WSP_RUN_RE = re.compile(br'[ \t]+')
+_HEADER_FIELD_RE = re.compile(br'\r\n(?![ \t])')
+
+_dkim_keys = {}
+_dkim_keys_lock = threading.Lock()
+
+
+def _load_dkim_key(domain, selector, private_key):
+    """Parses a PEM private key, once for each domain, selector and key"""
+    if isinstance(private_key, six.text_type):
+        private_key = private_key.encode('ascii')
+
+    cache_key = domain, selector, hashlib.sha256(private_key).digest()
+    with _dkim_keys_lock:
+        key = _dkim_keys.get(cache_key)
+
+    if key is None:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+        key = load_pem_private_key(private_key, password=None, backend=default_backend())
+        with _dkim_keys_lock:
+            key = _dkim_keys.setdefault(cache_key, key)
+
+    return key
+
+
+def _split_head(chunks):
+    """Splits DATA-ready chunks at the empty line ending the headers.
+
+    Returns:
+        :obj:`tuple`: the header fields, each ending in CRLF, and an
+        iterator over the body chunks.
+    """
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        start = max(len(head) - 3, 0)
+        head += chunk
+        end = head.find(b'\r\n\r\n', start)
+        if end >= 0:
+            rest = head[end + 4:]
+            return head[:end + 2], itertools.chain([rest] if rest else [], chunks)
+
+    return head, iter(())
+
+
+class _DKIMBodyHash(object):
+    """SHA-256 of a mail body canonicalized (RFC 6376, section 3.4) as it's fed, a chunk at a time.
+
+    Empty lines are held back until some content follows them, as trailing
+    ones are left out. With relaxed canonicalization the last, unfinished
+    line of each chunk is carried over to the next, so whitespace is only
+    reduced on whole lines.
+    """
+
+    def __init__(self, relaxed):
+        self.relaxed = relaxed
+        self._hash = hashlib.sha256()
+        self._line = b''
+        self._empty_lines = b''
+        self._content = False
+
+    @staticmethod
+    def _relax(data):
+        return _WSP_RUN_RE.sub(b' ', data).replace(b' \r\n', b'\r\n')
+
+    def update(self, data):
+        if self.relaxed:
+            data = self._line + data
+            end = data.rfind(b'\n') + 1
+            data, self._line = self._relax(data[:end]), data[end:]
+        self._update(data)
+
+    def _update(self, data):
+        content = data.rstrip(b'\r\n')
+        if content:
+            self._hash.update(self._empty_lines + content)
+            self._empty_lines = data[len(content):]
+            self._content = True
+        else:
+            self._empty_lines += data
+
+    def digest(self):
+        if self._line:
+            self._update(self._relax(self._line + b'\r\n'))
+            self._line = b''
+        # the last line's break, or the lone one of an empty simple body
+        if self._content or not self.relaxed:
+            self._hash.update(b'\r\n')
+        return self._hash.digest()
+
+
+class _SignedMail(object):
+    """DATA-ready chunks of a mail after its DKIM-Signature header, read again on each iteration"""
+
+    def __init__(self, signature, msg):
+        self.signature = signature
+        self.msg = msg
+
+    def __iter__(self):
+        yield self.signature
+        for chunk in self.msg:
+            yield chunk
+
+
+class DKIMSigner(object):
+    """Signs mails with DKIM (RFC 6376) as they're serialized for sending.
+
+    Given as the ``dkim`` keyword of :func:`send_mail` and friends, it adds a
+    ``DKIM-Signature`` header to every mail. Parsed private keys are cached
+    for each domain and selector, so signers can be created at will. The
+    body hash is computed over the DATA-ready chunks of the mail, which are
+    kept for sending, instead of parsing and serializing it again. Mails
+    streaming attachments from disk are read and encoded twice instead,
+    once for the hash and once for sending.
+
+    Mails sent to recipients split in several envelopes are signed once,
+    and a mail whose body is the same as the last one signed, as happens in
+    :func:`send_merge` with the same subject and body values, reuses its
+    body hash.
+
+    Requires the ``cryptography`` package.
+
+    Example::
+
+        with open('/etc/dkim/mail.private', 'rb') as f:
+            signer = DKIMSigner('example.com', 'mail', f.read())
+        send_mail('Report', message='...', sender='app@example.com', to='you@example.com', dkim=signer)
+
+    Args:
+        domain (:obj:`str`): signing domain, the ``d=`` tag.
+        selector (:obj:`str`): selector of the public key in DNS, the ``s=`` tag.
+        private_key (:obj:`bytes` or :obj:`str`): unencrypted PEM private
+            key, RSA for ``rsa-sha256`` signatures or Ed25519 for
+            ``ed25519-sha256`` ones.
+        headers: names of the headers to sign when present.
+        canonicalization (:obj:`str`): header and body canonicalization,
+            each ``simple`` or ``relaxed``, as in the ``c=`` tag.
+
+    Attributes:
+        signed (:obj:`int`): mails signed.
+        body_hashes (:obj:`int`): body hashes computed, the others reused.
+
+    Raises:
+        ValueError: if the canonicalization or key type is unsupported.
+    """
+
+    def __init__(self, domain, selector, private_key, headers=_DKIM_HEADERS, canonicalization='relaxed/relaxed'):
+        header_canonicalization, _, body_canonicalization = canonicalization.partition('/')
+        body_canonicalization = body_canonicalization or 'simple'
+        if not {header_canonicalization, body_canonicalization} <= {'simple', 'relaxed'}:
+            raise ValueError('Invalid DKIM canonicalization: "%s"' % canonicalization)
+
+        self.domain = domain
+        self.selector = selector
+        self.headers = tuple(headers)
+        self.canonicalization = '%s/%s' % (header_canonicalization, body_canonicalization)
+        self.signed = 0
+        self.body_hashes = 0
+        self._private_key = private_key
+        self._key = _load_dkim_key(domain, selector, private_key)
+        self._relaxed_headers = header_canonicalization == 'relaxed'
+        self._relaxed_body = body_canonicalization == 'relaxed'
+        self._last_body = None
+        self._lock = threading.Lock()
+
+        key_type = type(self._key).__name__
+        if 'RSA' in key_type:
+            self.algorithm = 'rsa-sha256'
+        elif 'Ed25519' in key_type:
+            self.algorithm = 'ed25519-sha256'
+        else:
+            raise ValueError('Unsupported DKIM key type: %s' % key_type)
+
+    def __getstate__(self):
+        # sent to build processes without the parsed key, parsed again there
+        return dict(self.__dict__, _key=None, _lock=None, _last_body=None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._key = _load_dkim_key(self.domain, self.selector, self._private_key)
+        self._lock = threading.Lock()
+
+    def _hash_body(self, body):
+        body_hash = _DKIMBodyHash(self._relaxed_body)
+        for chunk in _iter_unstuffed(body):
+            body_hash.update(chunk)
+        return body_hash.digest()
+
+    def _canonicalize_header(self, field):
+        if not self._relaxed_headers:
+            return field
+        name, _, value = field.partition(b':')
+        value = _WSP_RUN_RE.sub(b' ', value.replace(b'\r\n', b'')).strip(b' ')
+        return name.strip().lower() + b':' + value + b'\r\n'
+
+    def _make_signature(self, head, body_hash):
+        """Makes the DKIM-Signature header for a mail's header fields and body hash"""
+        fields = {}
+        for field in _HEADER_FIELD_RE.split(head[:-2]):
+            fields.setdefault(field.split(b':', 1)[0].strip().lower(), []).append(field + b'\r\n')
+
+        # of repeated headers the last is signed, as verifiers pick them bottom up
+        names, signed = [], []
+        for name in self.headers:
+            occurrences = fields.get(name.lower().encode('ascii'))
+            if occurrences:
+                names.append(name)
+                signed.append(self._canonicalize_header(occurrences.pop()))
+
+        signature = (
+            'DKIM-Signature: v=1; a=%s; c=%s; d=%s; s=%s;\r\n\tt=%d; h=%s;\r\n\tbh=%s;\r\n\tb=' % (
+                self.algorithm, self.canonicalization, self.domain, self.selector, time.time(),
+                ':'.join(names), base64.b64encode(body_hash).decode('ascii')
+            )
+        ).encode('ascii')
+        data = b''.join(signed) + self._canonicalize_header(signature + b'\r\n')[:-2]
+
+        if self.algorithm == 'rsa-sha256':
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.primitives.asymmetric import padding
+            value = self._key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+        else:
+            value = self._key.sign(hashlib.sha256(data).digest())
+
+        value = base64.b64encode(value)
+        return signature + b'\r\n\t '.join(value[i:i + 72] for i in range(0, len(value), 72)) + b'\r\n'
+
+    def sign(self, msg):
+        """Signs a mail.
+
+        Args:
+            msg: DATA-ready byte chunks of the mail, like a :class:`_StreamedMail`.
+
+        Returns:
+            DATA-ready byte chunks of the mail with its ``DKIM-Signature`` header.
+        """
+        with _phase('sign'):
+            if isinstance(msg, _StreamedMail) and msg.has_streamed_attachments():
+                head, body = _split_head(msg)
+                body_hash = self._hash_body(body)
+                with self._lock:
+                    self.signed += 1
+                    self.body_hashes += 1
+                return _SignedMail(self._make_signature(head, body_hash), msg)
+
+            chunks = msg if isinstance(msg, list) else list(msg)
+            head, body = _split_head(chunks)
+            body = tuple(body)
+
+            with self._lock:
+                last_body = self._last_body
+            if last_body is not None and last_body[0] == body:
+                body_hash = last_body[1]
+            else:
+                body_hash = self._hash_body(body)
+                with self._lock:
+                    self.body_hashes += 1
+                    self._last_body = body, body_hash
+
+            with self._lock:
+                self.signed += 1
+            return [self._make_signature(head, body_hash)] + chunks
+
+
+_UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
+
+
+def _exceeds(addresses, limit):
+    return limit is not None and len(addresses) > limit
+
+
+def _build_mail(
+        subject,
+        message='', html_message='',
+        to=None, cc=None, bcc=None,
+        sender=None, reply_to=None,
+        attachments=None,
+        custom_headers=None,
+        logger=None,
+        stream_attachments=False,
+        max_header_recipients=None,
+        compress_attachments=None
+):
+    """Builds the mail object for the given email details.
+
+    With ``stream_attachments`` the attachments aren't read, but left to be
+    encoded from disk by :class:`_StreamedMail` while the mail is sent.
+
+    With ``compress_attachments``, a :class:`AttachmentCompression` policy,
+    the attachments it applies to are compressed in the background.
+
+    With ``max_header_recipients``, To and Cc headers which would list more
+    addresses are replaced by an empty ``undisclosed-recipients:;`` group,
+    keeping huge recipient lists out of the headers.
+
+    Returns:
+        :obj:`tuple`: The mail object, the parsed sender or None and
+        the parsed list of all destinations.
+    """
+
+    # 1. Parse and Validate Email details
+
+    with _phase('parse'):
+        if sender:
+            sender = _parse_mail_address(sender)
+
+        if reply_to:
+            reply_to = _parse_address_list(reply_to)
+
+        destinations = _AddressList()
+
+        if to:
+            to = _parse_address_list(to)
+            destinations.extend(to)
+
+        if cc:
+            cc = _parse_address_list(cc)
+            destinations.extend(cc)
+
+        if bcc:
+            bcc = _parse_address_list(bcc)
+            destinations.extend(bcc)
+
+        all_destinations = destinations.addresses
+
+        if len(all_destinations) == 0:
+            raise ValueError('At least one recipient must be specified')
+
+        if message and not isinstance(message, six.text_type):
+            raise ValueError('message must be a string')
+
+        if html_message and not isinstance(html_message, six.text_type):
+            raise ValueError('html_message must be a string')
+
+    # 2. Setup email object with basic details
+
+    with _phase('build'):
+        mail = MIMEMultipart()
+        body = MIMEMultipart('alternative')
+
+        if sender:
+            mail['From'] = formataddr(sender)
+
+        if to:
+            mail['To'] = to.header if not _exceeds(to, max_header_recipients) else _UNDISCLOSED_RECIPIENTS
+
+        if cc and not _exceeds(cc, max_header_recipients):
+            mail['Cc'] = cc.header
+
+        if reply_to:
+            mail['Reply-To'] = reply_to.header
+
+        mail['Date'] = formatdate(localtime=True)
+        mail['Message-ID'] = make_msgid()
+        mail['Subject'] = subject
+        mail.preamble = subject
+
+        if html_message and not message:
+            message = _html_to_text(html_message)
+
+        # NOTE: We must always attach plain text mail before html, otherwise we'll break Gmail
+        if message:
+            body.attach(MIMEText(message, 'plain', 'utf-8'))
+
+        if html_message:
+            body.attach(MIMEText(html_message, 'html', 'utf-8'))
+
+        mail.attach(body)
+
+    # 3. Add attachments to email
+
+    if attachments:
+        with _phase('attachments'):
+            for attachment in _make_attachments(attachments, logger, stream_attachments, compress_attachments):
+                mail.attach(attachment)
+
+    # 4. Add custom headers to email
+
+    if custom_headers:
+        for k, v in six.iteritems(custom_headers):
+            mail.add_header(k, v)
+
+    return mail, sender, all_destinations
+
+
+class SendResult(object):
+    """Outcome of sending one email.
+
+    Attributes:
+        accepted (:obj:`list`): Addresses the mail server accepted.
+        refused (:obj:`dict`): Refused addresses mapped to the server's
+            ``(code, response)`` reply.
+        error (:obj:`Exception`): Error which prevented the mail from being
+            sent, if any.
+    """
+
+    def __init__(self, recipients=(), refused=None, error=None, accepted=None):
+        self.refused = dict(refused or {})
+        if accepted is None:
+            accepted = [] if error is not None else [r for r in recipients if r not in self.refused]
+        self.accepted = accepted
+        self.error = error
+
+    @property
+    def ok(self):
+        """Whether the mail was sent to all its recipients"""
+        return self.error is None and not self.refused
+
+    def __repr__(self):
+        return '<SendResult accepted=%d refused=%d error=%r>' % (len(self.accepted), len(self.refused), self.error)
+
+
+# plain text renderings of HTML-only messages, keyed by the HTML's digest
+# and bounded by their total length
+_html_text_cache = _LRUCache(8 * 1024 * 1024, weigh=len)
+
+
+def _convert_html(html_message):
+    """Renders an HTML message as plain text.
+
+    html2text is imported on first use rather than with this module, as it's
+    only needed for HTML-only messages and weighs on every script's startup.
+    Converters keep parsing state, like an unclosed ``<pre>``, after they
+    ran, so each message gets a new one.
+    """
+    import html2text
+    return html2text.HTML2Text().handle(html_message)
+
+
+def _html_digest(html_message):
+    return hashlib.sha1(html_message.encode('utf-8')).digest()
+
+
+def _html_to_text(html_message):
+    """Renders an HTML message as plain text, reusing earlier renderings of the same HTML"""
+    key = _html_digest(html_message)
+    text = _html_text_cache.get(key)
+    if text is None:
+        with _phase('html_to_text'):
+            text = _convert_html(html_message)
+        _html_text_cache.put(key, text)
+    return text
+
+
+def _convert_html_messages(messages, processes):
+    """Fills in the plain text of HTML-only messages, converting them in a process pool.
+
+    Conversions missing from the cache are spread over ``processes`` worker
+    processes and the messages are yielded in order as soon as their text is
+    ready, so sending the first ones overlaps converting the rest.
+    """
+    from multiprocessing import Pool
+
+    def get_html(details):
+        html_message = details.get('html_message', None)
+        if html_message and not details.get('message', None) and isinstance(html_message, six.text_type):
+            return html_message
+        return None
+
+    messages = list(messages)
+    jobs = []
+    positions = {}
+    for details in messages:
+        html_message = get_html(details)
+        if html_message is not None:
+            key = _html_digest(html_message)
+            if key not in positions and _html_text_cache.get(key) is None:
+                positions[key] = len(jobs)
+                jobs.append(html_message)
+
+    process_pool = Pool(min(processes, len(jobs))) if jobs else None
+    try:
+        texts = process_pool.imap(_convert_html, jobs) if jobs else None
+        converted = []
+        for details in messages:
+            html_message = get_html(details)
+            if html_message is not None:
+                key = _html_digest(html_message)
+                position = positions.get(key, None)
+                if position is None:
+                    text = _html_to_text(html_message)
+                else:
+                    while len(converted) <= position:
+                        converted.append(next(texts))
+                    text = converted[position]
+                    _html_text_cache.put(key, text)
+                details = dict(details, message=text)
+            yield details
+    finally:
+        if process_pool is not None:
+            process_pool.terminate()
+
+
+def _get_envelope_sender(sender, settings):
+    """Address bounces are sent to: the sender's, falling back to the login's"""
+    return sender[1] if sender else (settings['username'] or '')
+
+
+def send_mail(
+        subject,
+        message='', html_message='',
+        to=None, cc=None, bcc=None,
+        sender=None, reply_to=None,
+        attachments=None,
+        custom_headers=None,
+        logger=None,
+        **kwargs
+):
+    """Sends an email.
+
+    Single emails addresses can be provided as strings like `'pphagula@gmail.com'`
+    or name-address tuples like `('Paulo Phagula', 'pphagula@gmail.com'')`
+
+    Multiple email addresses can be provided as CSV strings like `'email@example.com, email2@example.com'`
+    or lists mixing singular address style `['email@example.com', (Example, email@example.com)]`
+
+    Attachments can be passed as a CSV string with full paths to the
+    desired files, or as a list mixing paths, binary file objects and
+    in-memory attachments like `('report.csv', data)` or
+    `('report.csv', data, 'text/csv')`, where data is bytes, a memoryview or
+    a binary file object. Content types are guessed from the file names
+    unless given.
+
+    Args:
+        subject (:obj:`str`): Subject line for this e-mail message.
+        message (:obj:`str`): Plain-text message body.
+        html_message (:obj:`str`): HTML message body.
+        to: Recipients address collection
+        cc: Carbon Copy (CC) recipients address collection
+        bcc: Blind Carbon Copy (BCC) recipients address collection
+        sender: Sender email address as it appears in the 'From' email line.
+        reply_to: List of addresses to reply to for the mail message.
+        attachments: Attachments collection used to store data
+            attached to this e-mail message.
+        custom_headers (:obj:`dict`, optional): Custom Headers to be added to the mail.
+        logger (:obj:`logging.Logger`,optional): Logger instance for logging
+            error and debug messages.
+        **kwargs: Arbitrary keywords arguments
+
+            If any of them is not provided they will be taken from
+            their environment variables equivalents (SMTP_<KEYWORD>) or
+            use default values.
+
+            - host (:obj:`str`, optional): mail server host. If not given uses :envvar:`SMTP_HOST`.
+            - port (:obj:`str` or :obj:`int`, optional): mail server port. If not given uses :envvar:`SMTP_PORT`.
+            - username (:obj:`str`, optional): mail server password. If not given uses :envvar:`SMTP_USERNAME`.
+            - password (:obj:`str`, optional): mail server password. If not given uses :envvar:`SMTP_PASSWORD`.
+            - use_tls (:obj:`bool`, optional): connect using TLS flag. If not given uses :envvar:`SMTP_USE_TLS`. Defaults to False
+            - use_ssl (:obj:`bool`, optional): connect using SSL flag. If not given uses :envvar:`SMTP_USE_SSL`.  Defaults to False
+            - debug (:obj:`bool`, optional): debug mode enabling flag. If not given uses :envvar:`SMTP_DEBUG`.Defaults to False
+            - config (:class:`MailerConfig`, optional): connection settings resolved beforehand, used for those
+              not given as keywords.
+            - pool (:class:`SMTPConnectionPool`, optional): pool of sessions to send the mail through. If not
+              given a new connection is made and closed for this mail only. A :class:`RelayPool` spreads
+              mails over several relays instead.
+            - transport (:class:`Transport`, optional): delivers the built mail, e.g. a
+              :class:`MaildirTransport` writing it to a local Maildir, or a :class:`MXTransport` delivering
+              it straight to the recipients' domains. Takes the place of ``pool``.
+            - dkim (:class:`DKIMSigner`, optional): signs the mail with DKIM before it's sent.
+            - compress_attachments (:class:`AttachmentCompression`, optional): policy compressing big
+              attachments before they're encoded.
+            - stream_attachments (:obj:`bool`, optional): encode attachments from disk in chunks while sending,
+              instead of reading them into memory when building the mail. Defaults to False
+            - max_recipients (:obj:`int`, optional): split the recipients in envelopes of at most this many
+              addresses, sending the same encoded mail in each. To and Cc headers listing more addresses are
+              replaced by ``undisclosed-recipients:;``. The mail is only considered failed if no envelope
+              was sent, otherwise the failed envelopes' recipients are reported as refused.
+            - chunk_workers (:obj:`int`, optional): number of envelopes sent in parallel when splitting
+              recipients. Defaults to 1
+            - outbox (:class:`Outbox`, optional): spool the encoded mail to be delivered in the background,
+              returning its id instead of sending it. Connection keywords are then taken from the outbox.
+
+    Returns:
+        :class:`SendResult`: accepted and refused recipients, or the id of
+        the queued mail when an ``outbox`` is given.
+
+    Raises:
+        ValueError: if no recipient is given, no message is given or the
+            connection settings are invalid.
+
+    .. envvar:: SMTP_HOST
+        Mail server host.
+
+    .. envvar:: SMTP_PORT
+        Mail server port.
+
+    .. envvar:: SMTP_USERNAME
+        Mail server username for login.
+
+    .. envvar:: SMTP_PASSWORD
+        Mail server password for login.
+
+    .. envvar:: SMTP_USE_TLS
+        Flag indicating if connection should be made using TLS.
+
+    .. envvar:: SMTP_USE_SSL
+        Flag indicating if connection to server should be made using SSL.
+
+    .. envvar:: SMTP_DEBUG
+        Flag indicating if debug mode is enabled.abs
+    """
+
+    max_recipients = kwargs.get('max_recipients', None)
+    outbox = kwargs.get('outbox', None)
+
+    mail, sender, all_destinations = _build_mail(
+        subject,
+        message=message, html_message=html_message,
+        to=to, cc=cc, bcc=bcc,
+        sender=sender, reply_to=reply_to,
+        attachments=attachments,
+        custom_headers=custom_headers,
+        logger=logger,
+        stream_attachments=kwargs.get('stream_attachments', False),
+        max_header_recipients=max_recipients,
+        compress_attachments=kwargs.get('compress_attachments', None)
+    )
+
+    # 5. Connect to mail server and send email
+
+    try:
+        return _deliver_mail(mail, sender, all_destinations, max_recipients, outbox, logger, kwargs)
+    finally:
+        _close_attachments(mail)
+
+
+def _deliver_mail(mail, sender, all_destinations, max_recipients, outbox, logger, kwargs):
+    """Sends a mail built by :func:`send_mail`, or queues it in the outbox"""
+    settings = _get_connection_settings(outbox.kwargs if outbox is not None else kwargs)
+    pool = _get_transport(kwargs)
+    envelope_sender = _get_envelope_sender(sender, settings)
+    envelope_recipients = list(map(lambda x: x[1], all_destinations))
+    msg = _serialize_mail(mail)
+
+    if kwargs.get('dkim', None) is not None:
+        msg = kwargs['dkim'].sign(msg)
+
+    if outbox is not None:
+        return outbox.enqueue(envelope_sender, envelope_recipients, msg)
+
+    if max_recipients and len(envelope_recipients) > max_recipients:
+        result = _send_in_chunks(
+            pool, envelope_sender, envelope_recipients, msg, settings,
+            max_recipients, kwargs.get('chunk_workers', 1)
+        )
+        if result.error is not None:
+            if logger is not None:
+                logger.error("Unable to send the email to some recipients. Error: %s" % str(result.error))
+            if not result.accepted:
+                raise result.error
+        return result
+
+    try:
+        if pool is not None:
+            refused = pool.sendmail(envelope_sender, envelope_recipients, msg, **settings)
+        else:
+            mail_server = _connect(**settings)
+            refused = _sendmail(mail_server, envelope_sender, envelope_recipients, msg)
+            # Should be mailServer.quit(), but that crashes...
+            mail_server.close()
+    except Exception as ex:
+        if logger is not None:
+            logger.error("Unable to send the email. Error: %s" % str(ex))
+        raise
+
+    return SendResult(envelope_recipients, refused)
+
+
+def _send_in_chunks(pool, envelope_sender, envelope_recipients, msg, settings, max_recipients, workers=1):
+    """Sends one mail to its recipients split in envelopes of at most ``max_recipients``.
+
+    The mail is encoded once and the same bytes are sent in every envelope,
+    unless it streams attachments, which are then read again for each one.
+    Envelopes go in sequence, or in parallel over ``workers`` pooled sessions.
+
+    Returns:
+        :class:`SendResult`: merged result for all the envelopes. Recipients
+        of envelopes which failed are refused with code -1 and the error
+        message, and the first such error is set as the result's error.
+    """
+    if isinstance(msg, _StreamedMail) and not msg.has_streamed_attachments():
+        msg = list(msg)
+
+    own_pool = pool is None
+    if own_pool:
+        pool = SMTPConnectionPool(max_idle=workers)
+
+    def send_chunk(recipients):
+        try:
+            return pool.sendmail(envelope_sender, recipients, msg, **settings), None
+        except smtplib.SMTPRecipientsRefused as ex:
+            return ex.recipients, ex
+        except Exception as ex:
+            return dict((recipient, (-1, six.text_type(ex))) for recipient in recipients), ex
+
+    chunks = [
+        envelope_recipients[start:start + max_recipients]
+        for start in range(0, len(envelope_recipients), max_recipients)
+    ]
+
+    try:
+        if workers > 1:
+            from multiprocessing.pool import ThreadPool
+            thread_pool = ThreadPool(min(workers, len(chunks)))
+            try:
+                outcomes = thread_pool.map(send_chunk, chunks)
+            finally:
+                thread_pool.close()
+        else:
+            outcomes = [send_chunk(chunk) for chunk in chunks]
+    finally:
+        if own_pool:
+            pool.close()
+
+    refused, error = {}, None
+    for chunk_refused, chunk_error in outcomes:
+        refused.update(chunk_refused)
+        error = error or chunk_error
+
+    accepted = [recipient for recipient in envelope_recipients if recipient not in refused]
+    return SendResult(envelope_recipients, refused, error=error, accepted=accepted)
+
+
+_MAIL_ARGUMENTS = (
+    'subject', 'message', 'html_message', 'to', 'cc', 'bcc',
+    'sender', 'reply_to', 'attachments', 'custom_headers', 'stream_attachments', 'compress_attachments',
+)
+
+
+def send_many(messages, logger=None, **kwargs):
+    """Sends a batch of emails over one mail server session.
+
+    Each message is given as a :obj:`dict` with the same arguments
+    :func:`send_mail` takes, e.g.
+    ``{'subject': 'Report', 'message': '...', 'to': 'you@example.com'}``.
+    Connection details are resolved once for the whole batch from the
+    keyword arguments and environment variables, but any of them may be
+    overridden per message.
+
+    A message which cannot be built or sent doesn't stop the batch, its
+    error is reported in its result instead.
+
+    Args:
+        messages: Iterable of message details.
+        logger (:obj:`logging.Logger`,optional): Logger instance for logging
+            error and debug messages.
+        **kwargs: Connection keywords, as taken by :func:`send_mail`. If no
+            ``pool`` is given, a private one is used and closed at the end.
+            ``html_processes`` converts HTML-only messages to plain text in
+            that many worker processes, ahead of sending them.
+
+    Returns:
+        :obj:`list` of :class:`SendResult`: one result for each message, in order.
+    """
+    settings = _get_connection_settings(kwargs)
+    pool = _get_transport(kwargs)
+    own_pool = pool is None
+
+    if own_pool:
+        pool = SMTPConnectionPool(max_idle=1)
+
+    if kwargs.get('html_processes', None):
+        messages = _convert_html_messages(messages, kwargs['html_processes'])
+
+    try:
+        return [_send_details(pool, details, settings, kwargs, logger) for details in messages]
+    finally:
+        if own_pool:
+            pool.close()
+
+
+@contextmanager
+def _no_throttle(settings, envelope_recipients):
+    yield
+
+
+def _split_details(details, kwargs):
+    """Splits message details into :func:`_build_mail` arguments and connection overrides"""
+    mail_details = dict((k, v) for k, v in six.iteritems(details) if k in _MAIL_ARGUMENTS)
+    overrides = dict((k, v) for k, v in six.iteritems(details) if k not in _MAIL_ARGUMENTS)
+    mail_details.setdefault('stream_attachments', kwargs.get('stream_attachments', False))
+    mail_details.setdefault('compress_attachments', kwargs.get('compress_attachments', None))
+    return mail_details, overrides
+
+
+def _build_data(mail_details, dkim=None):
+    """Builds, serializes and signs a message in a worker process.
+
+    Returns:
+        :obj:`tuple`: the sender, the envelope recipients and the DATA-ready
+        bytes of the mail, as a single chunk, or the exception raised
+        building it, as pickling the traceback along isn't possible.
+    """
+    mail_details = dict(mail_details, stream_attachments=False)
+    try:
+        mail, sender, all_destinations = _build_mail(**mail_details)
+        try:
+            msg = _serialize_mail(mail)
+            if dkim is not None:
+                msg = dkim.sign(msg)
+            # a chunk rather than a string, which smtplib would dot-stuff again
+            return sender, [destination[1] for destination in all_destinations], [b''.join(msg)]
+        finally:
+            _close_attachments(mail)
+    except Exception as ex:
+        return ex
+
+
+def _build_pickled(payload):
+    """Runs :func:`_build_data` in a worker process on its pickled arguments.
+
+    Multiprocessing pools only call back on success on Python 2, and hang
+    when results can't be pickled or unpickled, so everything crossing
+    processes is pickled here instead, where it can fail.
+
+    Returns:
+        :obj:`bytes`: what :func:`_build_data` returned, pickled, or the
+        error unpickling the arguments or pickling the result.
+    """
+    from six.moves import cPickle as pickle
+    built = None
+    try:
+        built = _build_data(*pickle.loads(payload))
+        pickled = pickle.dumps(built, pickle.HIGHEST_PROTOCOL)
+        if isinstance(built, Exception):
+            # errors keeping other arguments than they take can't be unpickled
+            pickle.loads(pickled)
+        return pickled
+    except Exception as ex:
+        # report the error building the mail rather than the one passing it on
+        error = built if isinstance(built, Exception) else ex
+        error = RuntimeError('Building the mail failed: %s: %s' % (type(error).__name__, error))
+        return pickle.dumps(error, pickle.HIGHEST_PROTOCOL)
+
+
+def _send_details(pool, details, settings, kwargs, logger=None, throttle=_no_throttle, built=None):
+    """Builds and sends one message of a batch, reporting any failure in its result.
+
+    Args:
+        pool (:class:`SMTPConnectionPool`): pool to send the mail through.
+        details (:obj:`dict`): :func:`send_mail` arguments for the message.
+        settings (:obj:`dict`): connection settings resolved for the batch.
+        kwargs (:obj:`dict`): connection keywords the settings were resolved
+            from, for messages overriding some of them.
+        throttle: context manager factory taking the message's connection
+            settings and recipients, entered around the actual sending.
+        built: what :func:`_build_data` returned for the message, if it was
+            built beforehand.
+    """
+    mail_details, overrides = _split_details(details, kwargs)
+    envelope_recipients = []
+
+    try:
+        message_settings = _get_connection_settings(dict(kwargs, **overrides)) if overrides else settings
+        mail = None
+        if built is None:
+            mail, sender, all_destinations = _build_mail(logger=logger, **mail_details)
+            envelope_recipients = list(map(lambda x: x[1], all_destinations))
+            msg = _serialize_mail(mail)
+            if kwargs.get('dkim', None) is not None:
+                msg = kwargs['dkim'].sign(msg)
+        elif isinstance(built, Exception):
+            raise built
+        else:
+            sender, envelope_recipients, msg = built
+        envelope_sender = _get_envelope_sender(sender, message_settings)
+        try:
+            with throttle(message_settings, envelope_recipients):
+                refused = pool.sendmail(envelope_sender, envelope_recipients, msg, **message_settings)
+        finally:
+            if mail is not None:
+                _close_attachments(mail)
+        return SendResult(envelope_recipients, refused)
+    except smtplib.SMTPRecipientsRefused as ex:
+        return SendResult(envelope_recipients, ex.recipients, error=ex)
+    except Exception as ex:
+        if logger is not None:
+            logger.error("Unable to send one of the emails. Error: %s" % six.text_type(ex))
+        return SendResult(envelope_recipients, error=ex)
+
+
+class Mailer(object):
+    """Sends mails with settings resolved once, over sessions it keeps alive.
+
+    Meant for long running processes and hot loops: the connection settings
+    are resolved and validated when the mailer is created, and every send
+    goes through the mailer's own :class:`SMTPConnectionPool`.
+
+    Example::
+
+        with Mailer(host='smtp.example.com', port=587, use_tls=True) as mailer:
+            for report in reports:
+                mailer.send(report.subject, message=report.body, to=report.to)
+
+    Args:
+        config (:class:`MailerConfig`, optional): connection settings.
+            Resolved from ``kwargs`` and the environment if not given.
+        logger (:obj:`logging.Logger`,optional): Logger instance for logging
+            error and debug messages.
+        max_idle (:obj:`int`): Maximum number of idle sessions kept open.
+        **kwargs: :class:`MailerConfig` keywords, used if no ``config`` is given.
+    """
+
+    def __init__(self, config=None, logger=None, max_idle=4, **kwargs):
+        self.config = config or MailerConfig(**kwargs)
+        self.logger = logger
+        self.pool = SMTPConnectionPool(max_idle=max_idle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send(self, subject, **kwargs):
+        """Sends an email, taking the same arguments as :func:`send_mail`.
+
+        Returns:
+            :class:`SendResult`: accepted and refused recipients.
+        """
+        kwargs.setdefault('logger', self.logger)
+        return send_mail(subject, config=self.config, pool=self.pool, **kwargs)
+
+    def send_many(self, messages):
+        """Sends a batch of emails, given like for :func:`send_many`.
+
+        Returns:
+            :obj:`list` of :class:`SendResult`: one result for each message, in order.
+        """
+        return send_many(messages, logger=self.logger, config=self.config, pool=self.pool)
+
+    def reload(self):
+        """Resolves the settings again, closing the sessions opened with the old ones"""
+        self.config.reload()
+        self.pool.close()
+
+    def close(self):
+        """Closes the idle sessions kept by the mailer"""
+        self.pool.close()
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter.
+
+    Tokens are refilled continuously at ``rate`` per second up to
+    ``capacity``. Taking more tokens than the capacity is allowed once the
+    bucket is full, leaving it in debt so the average rate still holds.
+
+    Args:
+        rate (:obj:`float`): tokens added per second.
+        capacity (:obj:`float`, optional): burst size. Defaults to ``rate``.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """Takes tokens from the bucket, sleeping until they're available"""
+        needed = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+
+                wait = (needed - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class DispatchReport(object):
+    """Outcome of a :meth:`Dispatcher.dispatch` run.
+
+    Attributes:
+        results (:obj:`list` of :class:`SendResult`): one result for each
+            message, in order.
+        elapsed (:obj:`float`): seconds the whole run took.
+    """
+
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def sent(self):
+        """Number of messages the mail server accepted"""
+        return len([result for result in self.results if result.error is None])
+
+    @property
+    def failed(self):
+        """Number of messages which could not be sent"""
+        return len(self.results) - self.sent
+
+    @property
+    def recipients(self):
+        """Number of recipients the mail server accepted"""
+        return sum(len(result.accepted) for result in self.results)
+
+    @property
+    def messages_per_second(self):
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def recipients_per_second(self):
+        return self.recipients / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return '<DispatchReport sent=%d failed=%d elapsed=%.3fs rate=%.1f msg/s>' % (
+            self.sent, self.failed, self.elapsed, self.messages_per_second
+        )
+
+
+class Dispatcher(object):
+    """Sends messages in parallel over several mail server sessions.
+
+    Messages are fanned out from a bounded queue to ``workers`` threads,
+    each of which keeps its own session alive through a shared
+    :class:`SMTPConnectionPool`. Sessions to the same host are capped by
+    ``max_per_host`` and sending is throttled by token buckets so a relay
+    can be saturated without tripping its rate limits.
+
+    Building and encoding mails is CPU bound, so with ``build_processes``
+    it is moved off the sending threads to a pool of worker processes,
+    which hand the finished DATA bytes over. At most ``max_pending``
+    messages are being built, waiting or being sent at once, so a fast
+    producer is held back instead of filling memory with encoded mails.
+
+    Example::
+
+        dispatcher = Dispatcher(workers=8, max_per_host=4, messages_per_second=50)
+        report = dispatcher.dispatch({'subject': s, 'message': m, 'to': t} for s, m, t in jobs)
+        print(report.messages_per_second)
+
+    Args:
+        workers (:obj:`int`): number of sending threads.
+        max_per_host (:obj:`int` or :obj:`dict`, optional): maximum
+            concurrent sessions to one host, either for every host or as a
+            mapping of host to limit. Hosts missing from the mapping are
+            limited by ``workers`` only.
+        messages_per_second (:obj:`float`, optional): overall message rate limit.
+        recipients_per_second (:obj:`float`, optional): overall recipient rate limit.
+        build_processes (:obj:`int`, optional): number of worker processes
+            building and encoding mails. Mails are built by the sending
+            threads if not given.
+        max_pending (:obj:`int`, optional): maximum messages in flight when
+            building in processes. Defaults to twice the workers and processes.
+        logger (:obj:`logging.Logger`,optional): Logger instance for logging
+            errors and the throughput of each run.
+        **kwargs: Connection keywords, as taken by :func:`send_mail`, used
+            for every message not overriding them.
+    """
+
+    def __init__(self, workers=4, max_per_host=None, messages_per_second=None, recipients_per_second=None,
+                 build_processes=None, max_pending=None, logger=None, **kwargs):
+        self.workers = workers
+        self.build_processes = build_processes
+        self.max_pending = max_pending or 2 * (workers + (build_processes or 0))
+        self.max_per_host = max_per_host
+        self.message_bucket = TokenBucket(messages_per_second) if messages_per_second else None
+        self.recipient_bucket = TokenBucket(recipients_per_second) if recipients_per_second else None
+        self.logger = logger
+        self.kwargs = kwargs
+        self.pool = _get_transport(kwargs) or SMTPConnectionPool(max_idle=workers)
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    def _get_host_semaphore(self, host):
+        if isinstance(self.max_per_host, dict):
+            limit = self.max_per_host.get(host, None)
+        else:
+            limit = self.max_per_host
+
+        if limit is None:
+            return None
+
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(limit)
+            return self._host_semaphores[host]
+
+    @contextmanager
+    def _throttle(self, settings, envelope_recipients):
+        semaphore = self._get_host_semaphore(settings['host'])
+
+        if self.message_bucket is not None:
+            self.message_bucket.consume()
+
+        if self.recipient_bucket is not None:
+            self.recipient_bucket.consume(len(envelope_recipients))
+
+        if semaphore is None:
+            yield
+            return
+
+        with semaphore:
+            yield
+
+    def dispatch(self, messages):
+        """Sends the messages, returning once all of them were handled.
+
+        Args:
+            messages: Iterable of message details, as taken by :func:`send_many`.
+                It is consumed lazily, so generators don't need to fit in memory.
+
+        Returns:
+            :class:`DispatchReport`: per message results and throughput.
+        """
+        settings = _get_connection_settings(self.kwargs)
+        results = {}
+        started_at = time.time()
+
+        if self.build_processes:
+            self._dispatch_built(messages, settings, results)
+        else:
+            self._dispatch(messages, settings, results)
+
+        report = DispatchReport([results[index] for index in sorted(results)], time.time() - started_at)
+
+        if self.logger is not None:
+            self.logger.info(
+                "Dispatched %d emails (%d failed) in %.3fs: %.1f messages/s, %.1f recipients/s" % (
+                    report.sent, report.failed, report.elapsed,
+                    report.messages_per_second, report.recipients_per_second
+                )
+            )
+
+        return report
+
+    def _start_senders(self, tasks, send):
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                send(*task)
+
+        threads = [threading.Thread(target=work) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    @staticmethod
+    def _stop_senders(tasks, threads):
+        for _ in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _dispatch(self, messages, settings, results):
+        """Builds and sends the messages in the sending threads"""
+        tasks = queue.Queue(maxsize=self.workers * 2)
+
+        def send(index, details):
+            results[index] = _send_details(self.pool, details, settings, self.kwargs, self.logger, self._throttle)
+
+        threads = self._start_senders(tasks, send)
+        try:
+            for task in enumerate(messages):
+                tasks.put(task)
+        finally:
+            self._stop_senders(tasks, threads)
+
+    def _dispatch_built(self, messages, settings, results):
+        """Builds the messages in worker processes and sends them in the sending threads"""
+        from multiprocessing import Pool
+        from six.moves import cPickle as pickle
+
+        # taken for each message submitted and given back once it was sent,
+        # bounding the messages held anywhere in the pipeline
+        pending = threading.BoundedSemaphore(self.max_pending)
+        tasks = queue.Queue()
+
+        def send(index, details, built):
+            try:
+                if isinstance(built, bytes):
+                    try:
+                        built = pickle.loads(built)
+                    except Exception as ex:
+                        built = ex
+                results[index] = _send_details(
+                    self.pool, details, settings, self.kwargs, self.logger, self._throttle, built
+                )
+            finally:
+                pending.release()
+
+        threads = self._start_senders(tasks, send)
+        process_pool = Pool(self.build_processes)
+        try:
+            for index, details in enumerate(messages):
+                pending.acquire()
+                mail_details, _ = _split_details(details, self.kwargs)
+                try:
+                    payload = pickle.dumps((mail_details, self.kwargs.get('dkim', None)), pickle.HIGHEST_PROTOCOL)
+                except Exception as ex:
+                    tasks.put((index, details, ex))
+                    continue
+
+                # every outcome of the build comes back through the callback,
+                # the error callback, which Python 2 lacks, only gets failures
+                # of the pool itself
+                options = {} if six.PY2 else {
+                    'error_callback': lambda ex, index=index, details=details: tasks.put((index, details, ex))
+                }
+                process_pool.apply_async(
+                    _build_pickled, (payload,),
+                    callback=lambda built, index=index, details=details: tasks.put((index, details, built)),
+                    **options
+                )
+
+            # every message was sent once all the pending slots are free again
+            for _ in range(self.max_pending):
+                pending.acquire()
+        finally:
+            process_pool.terminate()
+            self._stop_senders(tasks, threads)
+
+    def close(self):
+        """Closes the idle sessions kept by the dispatcher's pool"""
+        self.pool.close()
+
+
+class MailTemplate(object):
+    """Message compiled once to be sent to many recipients with few changes.
+
+    The subject and bodies may hold ``$name`` or ``${name}`` placeholders
+    (``$$`` for a literal dollar sign), as in :class:`string.Template`.
+    Compiling renders and encodes everything shared by all mails up front:
+    the static headers, the quoted-printable fragments of the bodies between
+    placeholders and the shared attachments. Rendering a mail then only
+    encodes its recipients' headers, the placeholder values and any
+    attachments of its own.
+
+    Placeholder values are inserted as they are, so values for HTML bodies
+    must be escaped by the caller.
+
+    Example::
+
+        template = MailTemplate(
+            'Your report, $name', html_message='<p>Hello $name</p>',
+            sender=('App', 'notifications@example.com'), attachments=['/path/to/terms.pdf']
+        )
+        send_merge(template, [
+            {'to': 'you@example.com', 'context': {'name': 'You'}, 'attachments': ['/path/to/you.csv']},
+            {'to': 'him@example.com', 'context': {'name': 'Him'}},
+        ])
+
+    Args:
+        subject (:obj:`str`): Subject line template.
+        message (:obj:`str`): Plain-text message body template.
+        html_message (:obj:`str`): HTML message body template.
+        sender: Sender email address as it appears in the 'From' email line.
+        reply_to: List of addresses to reply to for the mail message.
+        attachments: Attachments shared by all the mails.
+        custom_headers (:obj:`dict`, optional): Custom Headers to be added to the mails.
+        logger (:obj:`logging.Logger`,optional): Logger instance for logging
+            error and debug messages.
+    """
+
+    _SLOT_RE = re.compile(br'@@send_mail_slot:(\w+)@@')
+
+    def __init__(
+            self,
+            subject,
+            message='', html_message='',
+            sender=None, reply_to=None,
+            attachments=None,
+            custom_headers=None,
+            logger=None
+    ):
+        if message and not isinstance(message, six.text_type):
+            raise ValueError('message must be a string')
+
+        if html_message and not isinstance(html_message, six.text_type):
+            raise ValueError('html_message must be a string')
+
+        if html_message and not message:
+            message = _html_to_text(html_message)
+
+        self.subject = string.Template(subject)
+        self.sender = _parse_mail_address(sender) if sender else None
+        self.logger = logger
+        self._bodies = {}
+
+        mail = MIMEMultipart()
+        body = MIMEMultipart('alternative')
+
+        if self.sender:
+            mail['From'] = formataddr(self.sender)
+
+        if reply_to:
+            mail['Reply-To'] = _parse_address_list(reply_to).header
+
+        if custom_headers:
+            for k, v in six.iteritems(custom_headers):
+                mail.add_header(k, v)
+
+        mail.preamble = self._slot('preamble')
+
+        # NOTE: We must always attach plain text mail before html, otherwise we'll break Gmail
+        if message:
+            self._bodies['plain'] = self._compile_body(message)
+            body.attach(MIMEText(self._slot('plain'), 'plain', 'utf-8'))
+
+        if html_message:
+            self._bodies['html'] = self._compile_body(html_message)
+            body.attach(MIMEText(self._slot('html'), 'html', 'utf-8'))
+
+        mail.attach(body)
+
+        for attachment in _make_attachments(attachments or [], logger):
+            mail.attach(attachment)
+
+        head, rest = _encode_part(mail).split(b'\r\n\r\n', 1)
+        boundary = mail.get_boundary().encode('ascii')
+        self._head = head + b'\r\n'
+        self._delimiter = b'\r\n--' + boundary + b'\r\n'
+        self._closing = b'\r\n--' + boundary + b'--\r\n'
+
+        # what's left is split into static bytes, at even indexes, and slot names
+        self._skeleton = self._SLOT_RE.split(rest[:-len(self._closing)])
+
+    @staticmethod
+    def _slot(name):
+        return '@@send_mail_slot:%s@@' % name
+
+    @staticmethod
+    def _encode_fragment(text):
+        """QP-encodes a body fragment so it can be joined with any other.
+
+        Fragments not ending a line end with a soft line break, so the next
+        fragment starts a new encoded line which decodes as a continuation.
+        """
+        # Python 2 encodes code points rather than their UTF-8 bytes
+        encoded = _UTF8_CHARSET.body_encode(text.encode('utf-8') if six.PY2 else text)
+        if not text.endswith('\n'):
+            encoded += '=\n'
+        return _DataEncoder().encode(encoded)
+
+    def _compile_body(self, text):
+        """Splits a body template into encoded static fragments and placeholder names"""
+        fragments, static, start = [], [], 0
+        for match in string.Template.pattern.finditer(text):
+            static.append(text[start:match.start()])
+            start = match.end()
+
+            if match.group('escaped') is not None:
+                static.append('$')
+                continue
+
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise ValueError('Invalid placeholder in message template at position %d' % match.start())
+
+            if ''.join(static):
+                fragments.append(self._encode_fragment(''.join(static)))
+            fragments.append(name)
+            static = []
+
+        static.append(text[start:])
+        if ''.join(static):
+            fragments.append(self._encode_fragment(''.join(static)))
+
+        return fragments
+
+    def _render_body(self, name, context):
+        return b''.join(
+            fragment if isinstance(fragment, six.binary_type)
+            else self._encode_fragment(six.text_type(context[fragment]))
+            for fragment in self._bodies[name]
+        )
+
+    def render(self, context=None, to=None, cc=None, bcc=None, attachments=None):
+        """Renders the mail for one set of recipients.
+
+        Args:
+            context (:obj:`dict`): values for the placeholders.
+            to: Recipients address collection
+            cc: Carbon Copy (CC) recipients address collection
+            bcc: Blind Carbon Copy (BCC) recipients address collection
+            attachments: Attachments for this mail only, added after the shared ones.
+
+        Returns:
+            :obj:`tuple`: The mail as a list of DATA-ready byte chunks and
+            the list of envelope recipient addresses.
+
+        Raises:
+            ValueError: if no recipient is given.
+            KeyError: if a placeholder has no value in the context.
+        """
+        context = context or {}
+        destinations = _AddressList()
+        headers = Message()
+
+        if to:
+            to = _parse_address_list(to)
+            destinations.extend(to)
+            headers['To'] = to.header
+
+        if cc:
+            cc = _parse_address_list(cc)
+            destinations.extend(cc)
+            headers['Cc'] = cc.header
+
+        if bcc:
+            destinations.extend(_parse_address_list(bcc))
+
+        if len(destinations) == 0:
+            raise ValueError('At least one recipient must be specified')
+
+        subject = self.subject.substitute(context)
+        headers['Date'] = formatdate(localtime=True)
+        headers['Message-ID'] = make_msgid()
+        headers['Subject'] = subject
+
+        chunks = [self._head, _DataEncoder().encode(_render_headers(headers)), b'\r\n']
+
+        for index, piece in enumerate(self._skeleton):
+            if index % 2 == 0:
+                chunks.append(piece)
+            elif piece == b'preamble':
+                chunks.append(_DataEncoder().encode(subject))
+            else:
+                chunks.append(self._render_body(piece.decode('ascii'), context))
+
+        for attachment in _make_attachments(attachments or [], self.logger):
+            chunks.append(self._delimiter)
+            chunks.append(_encode_part(attachment))
+
+        chunks.append(self._closing)
+
+        return chunks, destinations.envelope
+
+
+def send_merge(template, recipients, logger=None, **kwargs):
+    """Sends a :class:`MailTemplate` to many recipients over one mail server session.
+
+    Each mail is given as a :obj:`dict` with the arguments of
+    :meth:`MailTemplate.render`, e.g.
+    ``{'to': 'you@example.com', 'context': {'name': 'You'}}``.
+    A mail which cannot be rendered or sent doesn't stop the others, its
+    error is reported in its result instead.
+
+    Args:
+        template (:class:`MailTemplate`): compiled message to send.
+        recipients: Iterable of per mail details.
+        logger (:obj:`logging.Logger`,optional): Logger instance for logging
+            error and debug messages.
+        **kwargs: Connection keywords, as taken by :func:`send_mail`. If no
+            ``pool`` is given, a private one is used and closed at the end.
+
+    Returns:
+        :obj:`list` of :class:`SendResult`: one result for each mail, in order.
+    """
+    settings = _get_connection_settings(kwargs)
+    envelope_sender = _get_envelope_sender(template.sender, settings)
+    pool = _get_transport(kwargs)
+    dkim = kwargs.get('dkim', None)
+    own_pool = pool is None
+
+    if own_pool:
+        pool = SMTPConnectionPool(max_idle=1)
+
+    results = []
+
+    try:
+        for details in recipients:
+            envelope_recipients = []
+            try:
+                msg, envelope_recipients = template.render(**details)
+                if dkim is not None:
+                    msg = dkim.sign(msg)
+                refused = pool.sendmail(envelope_sender, envelope_recipients, msg, **settings)
+                results.append(SendResult(envelope_recipients, refused))
+            except smtplib.SMTPRecipientsRefused as ex:
+                results.append(SendResult(envelope_recipients, ex.recipients, error=ex))
+            except Exception as ex:
+                if logger is not None:
+                    logger.error("Unable to send one of the emails. Error: %s" % six.text_type(ex))
+                results.append(SendResult(envelope_recipients, error=ex))
+    finally:
+        if own_pool:
+            pool.close()
+
+    return results
+
+
+class _SpooledMail(object):
+    """DATA-ready mail read back from an outbox file a chunk at a time"""
+
+    def __init__(self, file_path, offset, chunk_size=64 * 1024):
+        self.file_path = file_path
+        self.offset = offset
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        with open(self.file_path, 'rb') as f:
+            f.seek(self.offset)
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+
+class Outbox(object):
+    """Durable spool directory of mails, delivered in the background.
+
+    Enqueuing writes the fully encoded mail to a file and returns without
+    talking to the mail server, so a slow or unreachable server doesn't hold
+    up the caller nor lose the mail. Worker threads deliver queued mails over
+    pooled sessions, retrying failures with exponential backoff and moving
+    mails which failed permanently, or too many times, to a dead letter
+    directory along with their last error.
+
+    Mails move between sub-directories with atomic renames: ``tmp`` while
+    being written, ``queue`` while waiting, ``inflight`` while being sent,
+    and ``dead`` if given up on. Queued file names carry the time of their
+    next attempt and the number of attempts made. Mails left in flight by a
+    crash are queued again by :meth:`recover`, which :meth:`start` calls, so
+    an outbox directory must be drained by a single process at a time.
+    With ``fsync``, the ``queue`` directory is flushed after mails are moved
+    into it, with concurrent moves sharing a flush.
+
+    Example::
+
+        outbox = Outbox('/var/spool/reports', host='smtp.example.com', port=587)
+        outbox.start(workers=2)
+        send_mail('Report', message='...', to='you@example.com', outbox=outbox)
+        ...
+        outbox.stop()
+
+    Args:
+        directory (:obj:`str`): spool directory, created if missing.
+        max_attempts (:obj:`int`): attempts before a mail is dead-lettered.
+        backoff (:obj:`float`): seconds before the first retry, doubled on
+            each further one.
+        max_backoff (:obj:`float`): longest wait between retries, in seconds.
+        fsync (:obj:`bool`): flush enqueued mails to disk before returning,
+            so they survive power loss too, at the cost of enqueue latency.
+        poll_interval (:obj:`float`): seconds idle workers wait before
+            checking for mails due for retry.
+        logger (:obj:`logging.Logger`,optional): Logger instance for logging
+            delivery errors.
+        **kwargs: Connection keywords, as taken by :func:`send_mail`, used to
+            deliver every mail.
+    """
+
+    def __init__(self, directory, max_attempts=5, backoff=1.0, max_backoff=300.0, fsync=False,
+                 poll_interval=1.0, logger=None, **kwargs):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.fsync = fsync
+        self.poll_interval = poll_interval
+        self.logger = logger
+        self.kwargs = kwargs
+        self.pool = _get_transport(kwargs)
+        self._workers = []
+        self._stopping = threading.Event()
+        self._wake_up = threading.Event()
+        # sorted queue listing claims are taken from, rescanned only once
+        # it runs out, its head isn't due yet or mails were enqueued
+        self._listing = []
+        self._rescan = True
+        self._claim_lock = threading.Lock()
+
+        for name in ('tmp', 'queue', 'inflight', 'dead'):
+            path = os.path.join(directory, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        self._queue_sync = _GroupSync(self._path('queue'))
+
+    def _path(self, state, name=''):
+        return os.path.join(self.directory, state, name)
+
+    @staticmethod
+    def _make_name(due_at, attempts, mail_id):
+        # zero padded due time first, so sorting names sorts by due time
+        return '%016d_%d_%s.eml' % (int(due_at * 1000), attempts, mail_id)
+
+    @staticmethod
+    def _parse_name(name):
+        due_at, attempts, mail_id = name[:-len('.eml')].split('_', 2)
+        return int(due_at) / 1000.0, int(attempts), mail_id
+
+    def __len__(self):
+        """Number of mails waiting or being delivered"""
+        return len(os.listdir(self._path('queue'))) + len(os.listdir(self._path('inflight')))
+
+    @property
+    def dead(self):
+        """Ids of the mails which were given up on"""
+        return sorted(self._parse_name(name)[2] for name in os.listdir(self._path('dead')) if name.endswith('.eml'))
+
+    def enqueue(self, envelope_sender, envelope_recipients, msg):
+        """Spools a mail for delivery.
+
+        Args:
+            envelope_sender (:obj:`str`): address bounces are sent to.
+            envelope_recipients (:obj:`list`): addresses to deliver to.
+            msg: DATA-ready byte chunks of the mail, like a :class:`_StreamedMail`.
+
+        Returns:
+            :obj:`str`: id of the queued mail.
+        """
+        import uuid
+        mail_id = uuid.uuid4().hex
+        name = self._make_name(time.time(), 0, mail_id)
+        envelope = json.dumps({'from': envelope_sender, 'to': envelope_recipients})
+
+        with open(self._path('tmp', name), 'wb') as f:
+            f.write(envelope.encode('utf-8') + b'\n')
+            for chunk in msg:
+                f.write(chunk)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        os.rename(self._path('tmp', name), self._path('queue', name))
+        self._sync_queue()
+        self._rescan = True
+        self._wake_up.set()
+        return mail_id
+
+    def _sync_queue(self):
+        """Makes the mails moved into the queue survive power loss, with ``fsync``"""
+        if self.fsync:
+            self._queue_sync.sync()
+
+    def recover(self, tmp_grace=60.0):
+        """Cleans up after a crashed process.
+
+        Mails it left half written are removed, and those it left in flight
+        are queued again with the interrupted attempt counted, so a mail
+        crashing its sender is dead-lettered after ``max_attempts`` too.
+
+        Args:
+            tmp_grace (:obj:`float`): seconds since their last write before
+                half written mails are removed, so mails still being enqueued
+                by other threads or processes are left alone.
+        """
+        stale_before = time.time() - tmp_grace
+        for name in os.listdir(self._path('tmp')):
+            try:
+                if os.path.getmtime(self._path('tmp', name)) <= stale_before:
+                    os.remove(self._path('tmp', name))
+            except OSError:
+                pass  # queued since it was listed
+
+        for name in os.listdir(self._path('inflight')):
+            self._retry(name, smtplib.SMTPServerDisconnected('Delivery was interrupted'))
+
+    def _claim(self):
+        """Takes the mail which has been due the longest, if any"""
+        now = time.time()
+        with self._claim_lock:
+            # mails retried sooner than the cached head is due aren't listed
+            # yet, so a head which isn't due calls for a rescan too
+            if self._rescan or not self._listing or self._parse_name(self._listing[0])[0] > now:
+                self._rescan = False
+                self._listing = sorted(os.listdir(self._path('queue')), reverse=True)
+
+            while self._listing:
+                name = self._listing[-1]
+                if self._parse_name(name)[0] > now:
+                    return None
+                self._listing.pop()
+                try:
+                    os.rename(self._path('queue', name), self._path('inflight', name))
+                except OSError:
+                    continue  # gone since it was listed
+                return name
+
+        return None
+
+    def _deliver(self, name, settings):
+        file_path = self._path('inflight', name)
+        with open(file_path, 'rb') as f:
+            envelope_line = f.readline()
+        envelope = json.loads(envelope_line.decode('utf-8'))
+        msg = _SpooledMail(file_path, len(envelope_line))
+
+        try:
+            refused = self.pool.sendmail(envelope['from'], envelope['to'], msg, **settings)
+        except Exception as ex:
+            self._retry(name, ex)
+            return
+
+        if refused and self.logger is not None:
+            self.logger.error("Mail %s was refused for some recipients: %s" % (name, refused))
+        os.remove(file_path)
+
+    def _retry(self, name, error):
+        due_at, attempts, mail_id = self._parse_name(name)
+        attempts += 1
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            # only worth retrying if some recipient was refused for now, e.g. greylisted
+            permanent = all(code >= 500 for code, _ in error.recipients.values())
+        else:
+            permanent = isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+        if self.logger is not None:
+            self.logger.error("Unable to send mail %s on attempt %d. Error: %s" % (mail_id, attempts, error))
+
+        if permanent or attempts >= self.max_attempts:
+            with open(self._path('dead', mail_id + '.error'), 'w') as f:
+                f.write('%s: %s\n' % (type(error).__name__, error))
+            os.rename(self._path('inflight', name), self._path('dead', self._make_name(due_at, attempts, mail_id)))
+            return
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        os.rename(
+            self._path('inflight', name),
+            self._path('queue', self._make_name(time.time() + delay, attempts, mail_id))
+        )
+        self._sync_queue()
+
+    def deliver_due(self):
+        """Delivers every mail due now in the calling thread.
+
+        Returns:
+            :obj:`int`: number of delivery attempts made.
+        """
+        settings = _get_connection_settings(self.kwargs)
+        if self.pool is None:
+            self.pool = SMTPConnectionPool()
+
+        attempts = 0
+        while not self._stopping.is_set():
+            name = self._claim()
+            if name is None:
+                break
+            self._deliver(name, settings)
+            attempts += 1
+
+        return attempts
+
+    def _work(self):
+        while not self._stopping.is_set():
+            self._wake_up.clear()
+            if not self.deliver_due():
+                self._wake_up.wait(self.poll_interval)
+
+    def start(self, workers=1):
+        """Recovers mails left in flight and starts delivering in background threads"""
+        self.recover()
+        self._stopping.clear()
+        if self.pool is None:
+            self.pool = SMTPConnectionPool(max_idle=workers)
+
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, wait=True):
+        """Stops the background workers once they finish the mail at hand"""
+        self._stopping.set()
+        self._wake_up.set()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+            self._workers = []
+            if self.pool is not None:
+                self.pool.close()
+
+    def flush(self, timeout=None):
+        """Waits until no mail is waiting for delivery or being delivered.
+
+        Mails waiting for a retry count as waiting, so with failing
+        deliveries this may take until they're dead-lettered.
+
+        Returns:
+            :obj:`bool`: whether the outbox was emptied before the timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while len(self):
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
@@ -0,0 +1,361 @@
+# coding: utf-8
+# vim: set fenc=utf-8 ft=python ts=4 sts=4 sw=4 ai et
+"""
+    send_mail_async
+    ---------------
+
+    Non-blocking email sending for asyncio applications.
+
+    Mails are built exactly like :func:`send_mail.send_mail` does, but are
+    delivered by a small SMTP client speaking over asyncio streams, so many
+    sessions can be in flight on one event loop without tying up threads.
+
+    Requires Python 3.7 or later.
+
+    :copyright: Copyright 2017-2018 by Paulo Phagula.
+    :license: MIT, see LICENSE for details.
+"""
+import asyncio
+import base64
+import hmac
+import smtplib
+import socket
+import ssl
+
+from send_mail import SendResult, _build_mail, _get_connection_settings, _get_envelope_sender, _serialize_mail
+from send_mail import _CompressedAttachment, _close_attachments
+
+__all__ = ['async_send_mail', 'async_send_many']
+
+CRLF = b'\r\n'
+
+
+class _AsyncSMTP(object):
+    """Minimal SMTP client over asyncio streams.
+
+    Errors are reported with the same :mod:`smtplib` exceptions
+    :class:`smtplib.SMTP` raises, so callers handle both paths alike.
+    """
+
+    def __init__(self, host, port, timeout=None, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.reader = None
+        self.writer = None
+        self.extensions = {}
+
+    def _get_ssl_context(self):
+        if self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        return self.ssl_context
+
+    async def connect(self, use_ssl=False):
+        ssl_context = self._get_ssl_context() if use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl_context), self.timeout
+        )
+        code, message = await self.getreply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, message)
+
+    async def getreply(self):
+        """Reads a possibly multiline reply, returning its code and joined text"""
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+    async def command(self, line):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        self.writer.write(line.encode('ascii') + CRLF)
+        await self.writer.drain()
+        return await self.getreply()
+
+    async def ehlo(self):
+        code, message = await self.command('EHLO %s' % socket.getfqdn())
+        if code != 250:
+            code, message = await self.command('HELO %s' % socket.getfqdn())
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+            self.extensions = {}
+            return
+
+        self.extensions = {}
+        for line in message.decode('latin-1').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            self.extensions[keyword.lower()] = params.strip()
+
+    async def starttls(self):
+        if 'starttls' not in self.extensions:
+            raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server.')
+        code, message = await self.command('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, message)
+
+        if hasattr(self.writer, 'start_tls'):
+            await self.writer.start_tls(self._get_ssl_context(), server_hostname=self.host)
+            return
+
+        # before Python 3.11 streams can't be upgraded, so the TLS transport
+        # replaces the plain one underneath them
+        loop = asyncio.get_event_loop()
+        transport = self.writer.transport
+        tls_transport = await loop.start_tls(
+            transport, transport.get_protocol(), self._get_ssl_context(), server_hostname=self.host
+        )
+        self.reader._transport = tls_transport
+        self.writer._transport = tls_transport
+
+    async def login(self, username, password):
+        mechanisms = self.extensions.get('auth', '').upper().split()
+        if 'CRAM-MD5' in mechanisms:
+            code, message = await self.command('AUTH CRAM-MD5')
+            if code == 334:
+                challenge = base64.b64decode(message)
+                digest = hmac.new(password.encode('utf-8'), challenge, 'md5').hexdigest()
+                response = ('%s %s' % (username, digest)).encode('utf-8')
+                code, message = await self.command(base64.b64encode(response).decode('ascii'))
+        elif 'PLAIN' in mechanisms:
+            response = ('\0%s\0%s' % (username, password)).encode('utf-8')
+            code, message = await self.command('AUTH PLAIN ' + base64.b64encode(response).decode('ascii'))
+        elif 'LOGIN' in mechanisms:
+            code, message = await self.command('AUTH LOGIN ' + base64.b64encode(username.encode('utf-8')).decode('ascii'))
+            if code == 334:
+                code, message = await self.command(base64.b64encode(password.encode('utf-8')).decode('ascii'))
+        else:
+            raise smtplib.SMTPNotSupportedError('No suitable authentication method found.')
+
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """Runs one mail transaction, returning the refused recipients like smtplib does.
+
+        The message is given as DATA-ready byte chunks, which are written as
+        they come, waiting for the socket to drain in between.
+        """
+        code, message = await self.command('MAIL FROM:<%s>' % from_addr)
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPSenderRefused(code, message, from_addr)
+
+        refused = {}
+        for to_addr in to_addrs:
+            code, message = await self.command('RCPT TO:<%s>' % to_addr)
+            if code not in (250, 251):
+                refused[to_addr] = (code, message)
+
+        if len(refused) == len(to_addrs):
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, message = await self.command('DATA')
+        if code != 354:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, message)
+
+        for chunk in msg:
+            self.writer.write(chunk)
+            await self.writer.drain()
+        self.writer.write(b'.' + CRLF)
+        await self.writer.drain()
+        code, message = await self.getreply()
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, message)
+
+        return refused
+
+    async def rset(self):
+        try:
+            await self.command('RSET')
+        except (smtplib.SMTPServerDisconnected, OSError):
+            pass
+
+    async def quit(self):
+        if self.writer is None:
+            return  # the connection is closed already
+        try:
+            await self.command('QUIT')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+async def _connect(host, port, username=None, password=None, use_tls=False, use_ssl=False, debug=False,
+                   timeout=None, ssl_context=None):
+    """Opens an identified and authenticated asyncio connection to the mail server"""
+    mail_server = _AsyncSMTP(host, port, timeout, ssl_context)
+    await mail_server.connect(use_ssl)
+
+    try:
+        await mail_server.ehlo()  # identify ourselves, prompting server for supported features
+
+        if use_tls:
+            await mail_server.starttls()
+            await mail_server.ehlo()  # re-identify ourselves over TLS connection
+
+        if username and password:
+            await mail_server.login(username, password)
+    except BaseException:
+        mail_server.close()
+        raise
+
+    return mail_server
+
+
+async def async_send_mail(
+        subject,
+        message='', html_message='',
+        to=None, cc=None, bcc=None,
+        sender=None, reply_to=None,
+        attachments=None,
+        custom_headers=None,
+        logger=None,
+        **kwargs
+):
+    """Sends an email without blocking the event loop.
+
+    Takes the same arguments as :func:`send_mail.send_mail`, plus:
+
+    - semaphore (:class:`asyncio.Semaphore`, optional): limits how many
+      mails are built and sent at once among the calls sharing it, and so
+      the sessions open and the mails held in memory.
+    - timeout (:obj:`float`, optional): seconds to wait for the mail server
+      on each step before giving up.
+    - ssl_context (:class:`ssl.SSLContext`, optional): context for SSL and
+      STARTTLS connections. Defaults to one verifying the server certificate
+      against the system's trusted CAs.
+
+    Sessions aren't pooled, so ``pool``, ``transport``, ``outbox`` and
+    ``max_recipients`` aren't supported.
+
+    Returns:
+        :class:`send_mail.SendResult`: accepted and refused recipients.
+
+    Raises:
+        ValueError: if given an unsupported keyword.
+    """
+    _check_keywords(kwargs)
+
+    mail_arguments = dict(
+        message=message, html_message=html_message,
+        to=to, cc=cc, bcc=bcc,
+        sender=sender, reply_to=reply_to,
+        attachments=attachments,
+        custom_headers=custom_headers,
+    )
+
+    # taken before building, so the mails held in memory are bounded too
+    semaphore = kwargs.get('semaphore', None)
+    if semaphore is not None:
+        async with semaphore:
+            return await _send_mail(subject, mail_arguments, logger, kwargs)
+    return await _send_mail(subject, mail_arguments, logger, kwargs)
+
+
+async def _send_mail(subject, mail_arguments, logger, kwargs):
+    """Builds and sends a mail for :func:`async_send_mail`"""
+    mail, sender, all_destinations = _build_mail(
+        subject,
+        logger=logger,
+        stream_attachments=kwargs.get('stream_attachments', False),
+        compress_attachments=kwargs.get('compress_attachments', None),
+        **mail_arguments
+    )
+
+    try:
+        await _wait_for_compression(mail)
+
+        settings = _get_connection_settings(kwargs)
+        envelope_sender = _get_envelope_sender(sender, settings)
+        envelope_recipients = [destination[1] for destination in all_destinations]
+        msg = _serialize_mail(mail)
+        if kwargs.get('dkim', None) is not None:
+            msg = kwargs['dkim'].sign(msg)
+
+        refused = await _deliver(settings, envelope_sender, envelope_recipients, msg, kwargs)
+    except Exception as ex:
+        if logger is not None:
+            logger.error("Unable to send the email. Error: %s" % str(ex))
+        raise
+    finally:
+        _close_attachments(mail)
+
+    return SendResult(envelope_recipients, refused)
+
+
+# keywords of the blocking functions which the asyncio client has no use for
+_UNSUPPORTED_KEYWORDS = ('pool', 'transport', 'outbox', 'max_recipients')
+
+
+def _check_keywords(kwargs):
+    """Refuses keywords which would be silently ignored, sending the mail differently than asked"""
+    unsupported = [name for name in _UNSUPPORTED_KEYWORDS if kwargs.get(name, None) is not None]
+    if unsupported:
+        raise ValueError('Unsupported keywords for sending asynchronously: %s' % ', '.join(unsupported))
+
+
+async def _wait_for_compression(mail):
+    """Waits in an executor for the attachments compressed in the background, as serializing them would block"""
+    loop = asyncio.get_running_loop()
+    for part in mail.walk():
+        if isinstance(part, _CompressedAttachment):
+            await loop.run_in_executor(None, part.result.wait)
+
+
+async def _deliver(settings, envelope_sender, envelope_recipients, msg, kwargs):
+    mail_server = await _connect(
+        timeout=kwargs.get('timeout', None), ssl_context=kwargs.get('ssl_context', None), **settings
+    )
+    try:
+        return await mail_server.sendmail(envelope_sender, envelope_recipients, msg)
+    finally:
+        await mail_server.quit()
+
+
+async def async_send_many(messages, concurrency=10, logger=None, **kwargs):
+    """Sends a batch of emails concurrently, with at most ``concurrency`` sessions open.
+
+    Messages are given as :obj:`dict` like for :func:`send_mail.send_many`,
+    and a failed message doesn't stop the others.
+
+    Returns:
+        :obj:`list` of :class:`send_mail.SendResult`: one result for each
+        message, in order.
+
+    Raises:
+        ValueError: if given a keyword :func:`async_send_mail` doesn't support.
+    """
+    _check_keywords(kwargs)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(details):
+        try:
+            return await async_send_mail(logger=logger, semaphore=semaphore, **dict(kwargs, **details))
+        except smtplib.SMTPRecipientsRefused as ex:
+            return SendResult(refused=ex.recipients, error=ex)
+        except Exception as ex:
+            return SendResult(error=ex)
+
+    return list(await asyncio.gather(*[send(details) for details in messages]))
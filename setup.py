@@ -40,7 +40,7 @@ setup(
         'Programming Language :: Python',
     ),
     keywords=('mail', 'smtp'),
-    py_modules=['send_mail'],
+    py_modules=['send_mail', 'send_mail_async'],
     install_requires=['six', 'html2text'],
     platforms=('any'),
     include_package_data=True,
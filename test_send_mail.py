@@ -3,9 +3,41 @@
 from __future__ import unicode_literals, print_function
 import unittest
 import os
+import base64
 import codecs
+import io
+import shutil
+import smtplib
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
-from send_mail import send_mail
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from email import message_from_bytes
+except ImportError:
+    # mails are byte strings on Python 2
+    from email import message_from_string as message_from_bytes
+
+import six
+from six.moves import socketserver
+
+from send_mail import send_mail, send_many, send_merge, SMTPConnectionPool, Dispatcher, TokenBucket, MailTemplate
+from send_mail import Outbox, Mailer, MailerConfig, AttachmentCompression, RelayPool, MailReadError
+from send_mail import MaildirTransport, MboxTransport, PickupDirectoryTransport, DKIMSigner
+from send_mail import MXResolver, MXTransport
+from send_mail import Instrumentation, PrometheusInstrumentation, OpenTelemetryInstrumentation, set_instrumentation
+from send_mail import _html_text_cache, _convert_html
+from send_mail import AttachmentCache, set_attachment_cache, _build_mail, _parse_address_list, _StreamedMail
+from send_mail import _iter_unstuffed, _sendmail
 
 
 PLAINTEXT_EMAIL = """
@@ -44,6 +76,264 @@ def cheap_dot_env(dot_env_path):
         raise Exception('no dot env file')
 
 
+def make_ssl_contexts(test_case):
+    """Creates a self-signed certificate for 127.0.0.1 returning server and client SSL contexts"""
+    directory = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, directory)
+    key_file, cert_file = os.path.join(directory, 'key.pem'), os.path.join(directory, 'cert.pem')
+    with open(os.devnull, 'w') as devnull:
+        try:
+            subprocess.check_call(
+                [
+                    'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', key_file, '-out', cert_file,
+                    '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+                ],
+                stdout=devnull, stderr=devnull
+            )
+        except (OSError, subprocess.CalledProcessError):
+            test_case.skipTest('openssl is needed to create a test certificate')
+
+    # PROTOCOL_TLS_SERVER only exists from Python 3.6
+    server_context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+    server_context.load_cert_chain(cert_file, key_file)
+    client_context = ssl.create_default_context(cafile=cert_file)
+    return server_context, client_context
+
+
+class UnreadableStream(io.RawIOBase):
+    """Seekable attachment whose reads fail, like a file on a disk which went away"""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        return 0
+
+    def tell(self):
+        return 0
+
+    def readinto(self, buffer):
+        raise ValueError('disk went away')
+
+
+class MountError(Exception):
+    """Error which pickles but can't be unpickled, as its arguments aren't the ones it was raised with"""
+
+    def __init__(self, path, reason):
+        Exception.__init__(self, '%s: %s' % (path, reason))
+
+
+class UnmountedStream(UnreadableStream):
+    """Attachment whose reads fail with an error which can't travel between processes"""
+
+    def readinto(self, buffer):
+        raise MountError('/mnt/reports', 'not mounted')
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP for smtplib to deliver mails to a FakeSMTPServer"""
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def readline(self):
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError()
+        return line.decode('utf-8').rstrip('\r\n')
+
+    def handle(self):
+        server = self.server
+        server.register(self.connection)
+        mail_from, rcpts, chunks = None, [], []
+        try:
+            self.reply('220 fake.example.com ESMTP')
+            while True:
+                line = self.readline()
+                verb, _, arg = line.partition(' ')
+                verb = verb.upper()
+                if verb in server.hang_up_on:
+                    server.hang_up_on.discard(verb)
+                    return
+                server.verbs.append(verb)
+                if verb == 'EHLO':
+                    extensions = ['fake.example.com'] + list(server.extensions) + ['AUTH PLAIN LOGIN']
+                    if server.ssl_context is not None and not server.implicit_tls:
+                        extensions.insert(1, 'STARTTLS')
+                    for extension in extensions[:-1]:
+                        self.reply('250-' + extension)
+                    self.reply('250 ' + extensions[-1])
+                elif verb == 'STARTTLS' and server.ssl_context is not None:
+                    self.reply('220 Ready to start TLS')
+                    self.connection = server.ssl_context.wrap_socket(self.connection, server_side=True)
+                    self.rfile = self.connection.makefile('rb')
+                    self.wfile = self.connection.makefile('wb')
+                    server.tls_sessions += 1
+                elif verb == 'HELO':
+                    self.reply('250 fake.example.com')
+                elif verb == 'AUTH':
+                    mechanism, _, initial = arg.partition(' ')
+                    if mechanism.upper() == 'PLAIN' and not initial:
+                        self.reply('334 ')
+                        self.readline()
+                    elif mechanism.upper() == 'LOGIN':
+                        if not initial:
+                            self.reply('334 ' + base64.b64encode(b'Username:').decode('ascii'))
+                            self.readline()
+                        self.reply('334 ' + base64.b64encode(b'Password:').decode('ascii'))
+                        self.readline()
+                    server.logins += 1
+                    self.reply('235 Authentication successful')
+                elif verb == 'MAIL':
+                    mail_from, rcpts = arg.split(':', 1)[1].split(' ')[0].strip('<>'), []
+                    self.reply('250 OK')
+                elif verb == 'RCPT':
+                    rcpt = arg.split(':', 1)[1].split(' ')[0].strip('<>')
+                    if rcpt in server.refuse:
+                        self.reply('550 No such user')
+                    elif rcpt in server.greylist:
+                        self.reply('450 Greylisted, try again later')
+                    else:
+                        rcpts.append(rcpt)
+                        self.reply('250 OK')
+                elif verb == 'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    lines, size = [], 0
+                    while True:
+                        data_line = self.rfile.readline()
+                        if not data_line:
+                            # the client hung up mid-mail, which drops it
+                            return
+                        if data_line == b'.\r\n':
+                            break
+                        if data_line.startswith(b'.'):
+                            data_line = data_line[1:]
+                        size += len(data_line)
+                        if server.keep_data:
+                            lines.append(data_line)
+                    server.deliver(mail_from, rcpts, b''.join(lines), size)
+                    mail_from, rcpts = None, []
+                    if verb in server.hang_up_after:
+                        server.hang_up_after.discard(verb)
+                        return
+                    self.reply('250 OK queued')
+                elif verb == 'BDAT' and 'CHUNKING' in server.extensions:
+                    size, _, last = arg.partition(' ')
+                    chunk = self.rfile.read(int(size))
+                    if server.keep_data:
+                        chunks.append(chunk)
+                    server.bdat_sizes.append(len(chunk))
+                    if last.upper() == 'LAST':
+                        data = b''.join(chunks)
+                        server.deliver(mail_from, rcpts, data, len(data))
+                        mail_from, rcpts, chunks = None, [], []
+                        if verb in server.hang_up_after:
+                            server.hang_up_after.discard(verb)
+                            return
+                        self.reply('250 OK queued')
+                    else:
+                        self.reply('250 %d octets received' % len(chunk))
+                elif verb == 'RSET':
+                    mail_from, rcpts, chunks = None, [], []
+                    self.reply('250 OK')
+                elif verb == 'NOOP':
+                    self.reply('250 OK')
+                elif verb == 'QUIT':
+                    # the session is over for the client once it has the reply
+                    server.unregister(self.connection)
+                    self.reply('221 Bye')
+                    break
+                else:
+                    self.reply('502 Command not implemented')
+        except (EOFError, socket.error):
+            pass
+        finally:
+            server.unregister(self.connection)
+
+
+class FakeSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """In-process SMTP stand-in which records the mails it receives.
+
+    It hangs up once on each verb of ``hang_up_on`` without carrying it out,
+    and once after delivering a mail sent with a verb of ``hang_up_after``
+    without replying.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, extensions=(), refuse=(), ssl_context=None, implicit_tls=False, keep_data=True,
+                 hang_up_on=(), hang_up_after=(), greylist=()):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), FakeSMTPHandler)
+        self.extensions = extensions
+        self.hang_up_on = set(hang_up_on)
+        self.hang_up_after = set(hang_up_after)
+        self.keep_data = keep_data
+        self.refuse = set(refuse)
+        self.greylist = set(greylist)
+        self.ssl_context = ssl_context
+        self.implicit_tls = implicit_tls
+        self.tls_sessions = 0
+        self.messages = []
+        self.connections = 0
+        self.peak_connections = 0
+        self.logins = 0
+        self.verbs = []
+        self.bdat_sizes = []
+        self._sockets = set()
+        self._lock = threading.Lock()
+
+    def get_request(self):
+        sock, address = socketserver.TCPServer.get_request(self)
+        if self.implicit_tls:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True)
+            self.tls_sessions += 1
+        return sock, address
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def register(self, sock):
+        with self._lock:
+            self.connections += 1
+            self._sockets.add(sock)
+            self.peak_connections = max(self.peak_connections, len(self._sockets))
+
+    def unregister(self, sock):
+        with self._lock:
+            self._sockets.discard(sock)
+
+    def deliver(self, mail_from, rcpts, data, size):
+        with self._lock:
+            self.messages.append({'from': mail_from, 'rcpts': rcpts, 'data': data, 'size': size})
+
+    def drop_connections(self):
+        """Abruptly closes every open client connection, like a server timing out sessions"""
+        with self._lock:
+            sockets, self._sockets = list(self._sockets), set()
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
 class MailTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -102,5 +392,1428 @@ class MailTestCase(unittest.TestCase):
         )
 
 
+class AddressParsingTestCase(unittest.TestCase):
+
+    def test_addresses_are_normalized_and_deduplicated(self):
+        addresses = _parse_address_list([' you@example.com', ('You', 'YOU@example.com'), ('Him', 'him@example.com')])
+
+        self.assertEqual(addresses.addresses, [(False, 'you@example.com'), ('Him', 'him@example.com')])
+        self.assertEqual(addresses.envelope, ['you@example.com', 'him@example.com'])
+        self.assertEqual(addresses.header, 'you@example.com, Him <him@example.com>')
+
+    def test_csv_addresses_are_parsed(self):
+        self.assertEqual(_parse_address_list('a@example.com, b@example.com').envelope, ['a@example.com', 'b@example.com'])
+
+    def test_invalid_addresses_are_rejected(self):
+        for address in ('not an address', ('Name',), ['a@example.com'], None):
+            with self.assertRaises(Exception):
+                _parse_address_list([address])
+
+    def test_bcc_recipients_are_in_envelope_only(self):
+        mail, _, all_destinations = _build_mail(
+            'Subject', message=PLAINTEXT_EMAIL,
+            to='you@example.com', cc='him@example.com', bcc='them@example.com, you@example.com'
+        )
+
+        self.assertEqual([d[1] for d in all_destinations], ['you@example.com', 'him@example.com', 'them@example.com'])
+        self.assertNotIn('them@example.com', mail.as_string())
+
+
+class ImportTestCase(unittest.TestCase):
+
+    def test_heavy_dependencies_are_imported_on_first_use(self):
+        here = os.path.abspath(os.path.dirname(__file__))
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, send_mail; print(sorted({"html2text", "multiprocessing", "uuid"} & set(sys.modules)))'
+        ], cwd=here)
+        self.assertEqual(output.strip(), b'[]')
+
+
+class SMTPConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.settings = {
+            'host': '127.0.0.1',
+            'port': self.server.port,
+            'username': 'user',
+            'password': 'secret',
+        }
+
+    def send(self, pool, **kwargs):
+        settings = dict(self.settings, **kwargs)
+        send_mail(
+            '[Mail Test] pooled',
+            message=PLAINTEXT_EMAIL,
+            to='you@example.com',
+            sender=('App', 'notifications@example.com'),
+            pool=pool,
+            **settings
+        )
+
+    def test_sessions_are_reused(self):
+        with SMTPConnectionPool() as pool:
+            for _ in range(3):
+                self.send(pool)
+
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(self.server.messages[0]['from'], 'notifications@example.com')
+
+    def test_sessions_are_keyed_by_user(self):
+        with SMTPConnectionPool() as pool:
+            self.send(pool)
+            self.send(pool, username='other')
+
+        self.assertEqual(self.server.connections, 2)
+
+    def test_dropped_session_is_replaced(self):
+        with SMTPConnectionPool() as pool:
+            self.send(pool)
+            self.server.drop_connections()
+            self.send(pool)
+
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_reused_session_dropped_before_the_mail_was_sent_is_retried(self):
+        with SMTPConnectionPool() as pool:
+            self.send(pool)
+            self.server.hang_up_on.add('MAIL')
+            self.send(pool)
+
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_new_session_dropped_is_not_retried(self):
+        self.server.hang_up_on.add('MAIL')
+        with SMTPConnectionPool() as pool:
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                self.send(pool)
+
+        self.assertEqual(len(self.server.messages), 0)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(pool.misses, 1)
+
+    def test_session_dropped_once_the_mail_was_sent_is_not_retried(self):
+        for extensions in ([], ['CHUNKING'], ['CHUNKING', 'PIPELINING']):
+            self.server.extensions = extensions
+            self.server.messages = []
+            with SMTPConnectionPool() as pool:
+                self.send(pool)
+                self.server.hang_up_after.update(['DATA', 'BDAT'])
+                with self.assertRaises(smtplib.SMTPServerDisconnected):
+                    self.send(pool)
+                self.server.hang_up_after.clear()
+
+            # the server may have delivered it, so it isn't sent twice
+            self.assertEqual(len(self.server.messages), 2)
+            self.assertEqual(pool.hits, 1)
+
+    def test_expired_session_is_not_reused(self):
+        with SMTPConnectionPool(max_lifetime=0) as pool:
+            self.send(pool)
+            self.send(pool)
+
+        self.assertEqual(self.server.connections, 2)
+
+    def test_session_is_discarded_when_reading_the_body_fails(self):
+        with SMTPConnectionPool() as pool:
+            with self.assertRaises(MailReadError):
+                self.send(pool, attachments=[('broken.bin', UnreadableStream())])
+            self.send(pool)
+
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual(pool.hits, 0)
+        # the unreadable mail isn't retried over another session
+        self.assertEqual(self.server.connections, 2)
+
+    def test_idle_sessions_are_capped(self):
+        pool = SMTPConnectionPool(max_idle=1)
+        first = pool.acquire(**self.settings)
+        second = pool.acquire(**self.settings)
+        pool.release(first)
+        pool.release(second)
+
+        self.assertEqual(sum(len(sessions) for sessions in pool._idle.values()), 1)
+        pool.close()
+
+
+class RelayPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [FakeSMTPServer().__enter__() for _ in range(2)]
+        for server in self.servers:
+            self.addCleanup(server.__exit__, None, None, None)
+
+    @staticmethod
+    def closed_port():
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def make_relays(self, ports, **kwargs):
+        relays = RelayPool(['127.0.0.1:%d' % port for port in ports], environ={}, **kwargs)
+        self.addCleanup(relays.close)
+        return relays
+
+    def send(self, relays, count=1, to='you@example.com'):
+        for i in range(count):
+            send_mail('[Mail Test] relayed %d' % i, message=PLAINTEXT_EMAIL, to=to, pool=relays)
+
+    def test_mails_fail_over_from_dead_relays(self):
+        server = self.servers[0]
+        relays = self.make_relays([self.closed_port(), server.port], failure_threshold=2, cooldown=60)
+        self.send(relays, 4)
+
+        self.assertEqual(len(server.messages), 4)
+        dead, alive = relays.relays
+        # tried first, then weighed down by its error rate
+        self.assertEqual((dead.failed, alive.sent), (1, 4))
+        self.assertEqual(relays.failovers, 1)
+        self.assertEqual(dead.open_until, 0.0)
+
+    def test_circuits_of_failing_relays_open(self):
+        relays = self.make_relays([self.closed_port(), self.closed_port(), self.servers[0].port],
+                                  failure_threshold=1, cooldown=60)
+        self.send(relays, 2)
+
+        first, second, alive = relays.relays
+        self.assertEqual((first.failed, second.failed, alive.sent), (1, 1, 2))
+        self.assertEqual(relays.failovers, 2)
+        self.assertGreater(first.open_until, time.time())
+        self.assertGreater(second.open_until, time.time())
+
+    def test_open_circuits_are_probed_after_cooldown(self):
+        relays = self.make_relays([self.closed_port(), self.servers[0].port], failure_threshold=1, cooldown=0.2)
+        self.send(relays, 2)
+        time.sleep(0.3)
+        self.send(relays, 2)
+
+        self.assertEqual(relays.relays[0].failed, 2)
+        self.assertEqual(len(self.servers[0].messages), 4)
+
+    def test_all_circuits_open(self):
+        relays = self.make_relays([self.closed_port()], failure_threshold=1)
+        self.assertRaises(socket.error, self.send, relays)
+        self.assertRaises(smtplib.SMTPConnectError, self.send, relays)
+
+    def test_faster_relays_get_the_mails(self):
+        relays = self.make_relays([server.port for server in self.servers])
+        relays.relays[0].latency = 1.0
+        relays.relays[1].latency = 0.5
+        self.send(relays, 3)
+
+        self.assertEqual([len(server.messages) for server in self.servers], [0, 3])
+        self.assertLess(relays.relays[1].latency, 0.5)
+
+    def test_relays_which_only_failed_are_not_preferred(self):
+        relays = self.make_relays([server.port for server in self.servers])
+        relays.relays[0].failed, relays.relays[0].error_rate = 1, 0.2
+        relays.relays[1].latency = 0.5
+        self.send(relays, 3)
+
+        self.assertEqual([len(server.messages) for server in self.servers], [0, 3])
+
+    def test_unreadable_mails_dont_open_circuits(self):
+        relays = self.make_relays([server.port for server in self.servers], failure_threshold=1)
+        for _ in range(3):
+            with self.assertRaises(MailReadError):
+                send_mail('[Mail Test] unreadable', message=PLAINTEXT_EMAIL, to='you@example.com',
+                          attachments=[('broken.bin', UnreadableStream())], pool=relays)
+        self.send(relays)
+
+        self.assertEqual(sum(len(server.messages) for server in self.servers), 1)
+        self.assertEqual(relays.failovers, 0)
+
+    def test_refused_mails_dont_fail_over(self):
+        self.servers[0].refuse.add('nobody@example.com')
+        relays = self.make_relays([server.port for server in self.servers])
+
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self.send, relays, to='nobody@example.com')
+        self.assertEqual(self.servers[1].verbs, [])
+        self.assertEqual(relays.relays[0].error_rate, 0.0)
+
+
+class FileTransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def send(self, transport, message='Hello,\n.dotted line\nFrom here on\n'):
+        return send_mail(
+            '[Mail Test] local', message=message, to=['you@example.com', 'him@example.com'],
+            sender='app@example.com', transport=transport
+        )
+
+    @staticmethod
+    def failing_mail():
+        yield b'Subject: half\r\n'
+        raise IOError('disk full')
+
+    def test_maildir(self):
+        import mailbox
+
+        maildir = os.path.join(self.directory, 'Maildir')
+        with MaildirTransport(maildir, fsync=True) as transport:
+            self.assertTrue(self.send(transport).ok)
+            self.assertRaises(IOError, transport.sendmail, 'app@example.com', ['you@example.com'], self.failing_mail())
+
+        self.assertEqual(os.listdir(os.path.join(maildir, 'tmp')), [])
+        [name] = os.listdir(os.path.join(maildir, 'new'))
+        with open(os.path.join(maildir, 'new', name), 'rb') as f:
+            data = f.read()
+        self.assertTrue(data.startswith(b'Return-Path: <app@example.com>\n'))
+        self.assertNotIn(b'\r\n', data)
+        self.assertIn(b'\n.dotted line\nFrom here on\n', data)
+
+        [mail] = mailbox.Maildir(maildir, factory=None)
+        self.assertEqual(mail['Subject'], '[Mail Test] local')
+
+    def test_mbox(self):
+        import mailbox
+
+        path = os.path.join(self.directory, 'mbox')
+        transport = MboxTransport(path)
+        self.send(transport)
+        self.send(transport, message='Second\n')
+        size = os.path.getsize(path)
+        self.assertRaises(IOError, transport.sendmail, 'app@example.com', ['you@example.com'], self.failing_mail())
+
+        self.assertEqual(os.path.getsize(path), size)
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertTrue(data.startswith(b'From app@example.com '))
+        self.assertIn(b'\n.dotted line\n>From here on\n', data)
+        self.assertEqual([mail['Subject'] for mail in mailbox.mbox(path)], ['[Mail Test] local'] * 2)
+
+    def test_pickup_directory(self):
+        pickup = os.path.join(self.directory, 'pickup')
+        self.send(PickupDirectoryTransport(pickup))
+
+        [name] = os.listdir(pickup)
+        self.assertTrue(name.endswith('.eml'))
+        with open(os.path.join(pickup, name), 'rb') as f:
+            data = f.read()
+        self.assertTrue(data.startswith(
+            b'X-Sender: app@example.com\r\nX-Receiver: you@example.com\r\nX-Receiver: him@example.com\r\n'
+        ))
+        self.assertIn(b'\r\n.dotted line\r\n', data)
+
+    def test_parallel_writers_share_syncs(self):
+        maildir = os.path.join(self.directory, 'Maildir')
+        transport = MaildirTransport(maildir, fsync=True)
+        dispatcher = Dispatcher(workers=4, transport=transport)
+        report = dispatcher.dispatch(
+            {'subject': '[Mail Test] %d' % i, 'message': PLAINTEXT_EMAIL, 'to': 'you@example.com'} for i in range(40)
+        )
+        dispatcher.close()
+
+        self.assertEqual(report.sent, 40)
+        self.assertEqual(len(os.listdir(os.path.join(maildir, 'new'))), 40)
+        self.assertLessEqual(transport._sync.syncs, 40)
+
+
+class MXTransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [FakeSMTPServer().__enter__() for _ in range(2)]
+        for server in self.servers:
+            self.addCleanup(server.__exit__, None, None, None)
+        dead_port = RelayPoolTestCase.closed_port()
+        self.records = {
+            'a.test': [(20, '127.0.0.1:%d' % self.servers[0].port), (10, '127.0.0.1:%d' % dead_port)],
+            'b.test': [(10, '127.0.0.1:%d' % self.servers[1].port)],
+            'null.test': [(0, '')],
+            'missing.test': [],
+        }
+        self.lookups = []
+
+    def lookup(self, domain):
+        self.lookups.append(domain)
+        return self.records[domain], 300
+
+    def make_transport(self, **kwargs):
+        transport = MXTransport(resolver=MXResolver(lookup=self.lookup), **kwargs)
+        self.addCleanup(transport.close)
+        return transport
+
+    def send(self, transport, to):
+        return send_mail('[Mail Test] direct', message=PLAINTEXT_EMAIL, sender='app@example.com', to=to,
+                         transport=transport)
+
+    def test_recipients_are_delivered_per_domain(self):
+        transport = self.make_transport()
+        result = self.send(transport, ['x@a.test', 'y@B.test', 'z@a.test', 'nobody@null.test', 'nobody@missing.test'])
+        self.send(transport, ['w@a.test'])
+
+        self.assertEqual(result.accepted, ['x@a.test', 'y@B.test', 'z@a.test'])
+        self.assertEqual(result.refused['nobody@null.test'][0], 550)
+        first, second = self.servers
+        self.assertEqual([message['rcpts'] for message in first.messages], [['x@a.test', 'z@a.test'], ['w@a.test']])
+        self.assertEqual([message['rcpts'] for message in second.messages], [['y@B.test']])
+        self.assertEqual(first.messages[0]['data'], second.messages[0]['data'])
+        # records are cached, the preferred server of a.test is down
+        self.assertEqual(sorted(self.lookups), ['a.test', 'b.test', 'missing.test', 'null.test'])
+        self.assertEqual(first.connections, 1)
+
+    def test_all_recipients_refused(self):
+        self.servers[1].refuse.add('y@b.test')
+        transport = self.make_transport(workers=1)
+
+        with self.assertRaises(smtplib.SMTPRecipientsRefused) as context:
+            self.send(transport, ['y@b.test', 'nobody@missing.test'])
+        self.assertEqual(context.exception.recipients['y@b.test'][0], 550)
+
+    def test_file_objects_are_read_apart_by_parallel_domains(self):
+        data = os.urandom(512 * 1024)
+        transport = self.make_transport(workers=4)
+        for _ in range(5):
+            send_mail('[Mail Test] direct', message=PLAINTEXT_EMAIL, sender='app@example.com',
+                      to=['x@a.test', 'y@b.test'], attachments=[('data.bin', io.BytesIO(data))],
+                      transport=transport)
+
+        for server in self.servers:
+            for message in server.messages:
+                mail = message_from_bytes(message['data'])
+                self.assertEqual(mail.get_payload(1).get_payload(decode=True), data)
+
+    def test_delivering_threads_are_reused_then_stopped(self):
+        transport = self.make_transport(workers=2)
+        thread_pool = transport._thread_pool
+        for _ in range(2):
+            self.send(transport, ['x@a.test', 'y@b.test'])
+
+        self.assertIs(transport._thread_pool, thread_pool)
+        transport.close()
+        self.assertFalse(any(worker.is_alive() for worker in thread_pool._pool))
+
+    def test_records_are_cached_for_their_ttl(self):
+        resolver = MXResolver(lookup=lambda domain: ([(20, 'backup.' + domain), (10, 'mx.' + domain)], 0.1),
+                              min_ttl=0)
+
+        self.assertEqual(resolver.resolve('example.com'), ['mx.example.com', 'backup.example.com'])
+        resolver.resolve('Example.com')
+        self.assertEqual(resolver.lookups, 1)
+        time.sleep(0.15)
+        resolver.resolve('example.com')
+        self.assertEqual(resolver.lookups, 2)
+
+
+class MailerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer(extensions=['AUTH PLAIN']).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.environ = {'SMTP_HOST': '127.0.0.1', 'SMTP_PORT': str(self.server.port), 'SMTP_USE_TLS': 'false'}
+
+    def test_settings_are_resolved_from_keywords_then_environment(self):
+        config = MailerConfig(username='me', password='secret', environ=self.environ)
+
+        self.assertEqual(config.host, '127.0.0.1')
+        self.assertEqual(config.port, self.server.port)
+        self.assertEqual(config.username, 'me')
+        self.assertFalse(config.use_tls)
+
+    def test_invalid_settings_are_rejected(self):
+        with self.assertRaises(ValueError):
+            MailerConfig(environ={})
+        with self.assertRaises(ValueError):
+            MailerConfig(host='127.0.0.1', port='smtp', environ={})
+        with self.assertRaises(ValueError):
+            MailerConfig(host='127.0.0.1', port=25, use_tls=True, use_ssl=True, environ={})
+
+    def test_mails_are_sent_over_one_session(self):
+        with Mailer(MailerConfig(username='me', password='secret', environ=self.environ)) as mailer:
+            self.assertTrue(mailer.send('[Mail Test] first', message=PLAINTEXT_EMAIL, to='you@example.com').ok)
+            results = mailer.send_many([
+                {'subject': '[Mail Test] second', 'message': PLAINTEXT_EMAIL, 'to': 'him@example.com'},
+                {'subject': '[Mail Test] third', 'message': PLAINTEXT_EMAIL, 'to': 'her@example.com'},
+            ])
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.logins, 1)
+
+    def test_reload_picks_up_new_settings(self):
+        mailer = Mailer(config=MailerConfig(environ=self.environ))
+        self.addCleanup(mailer.close)
+        mailer.send('[Mail Test] first', message=PLAINTEXT_EMAIL, to='you@example.com')
+
+        with FakeSMTPServer() as other:
+            self.environ['SMTP_PORT'] = str(other.port)
+            mailer.reload()
+            mailer.send('[Mail Test] second', message=PLAINTEXT_EMAIL, to='you@example.com')
+
+            self.assertEqual(len(other.messages), 1)
+
+        self.environ['SMTP_PORT'] = 'smtp'
+        self.assertRaises(ValueError, mailer.reload)
+        self.assertEqual(mailer.config.port, other.port)
+
+
+class PipeliningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        here = os.path.abspath(os.path.dirname(__file__))
+        self.mail, _, _ = _build_mail(
+            '[Mail Test] pipelined',
+            message='.leading dot\n..two dots\n' * 1000,
+            to=['user%d@example.com' % i for i in range(250)],
+            attachments=[here + '/LICENSE']
+        )
+        self.recipients = ['user%d@example.com' % i for i in range(250)]
+
+    def send(self, extensions):
+        """Sends the mail to a server with the given extensions, counting the writes to its socket"""
+        with FakeSMTPServer(extensions=extensions, refuse=['user7@example.com']) as server:
+            pool = SMTPConnectionPool()
+            self.addCleanup(pool.close)
+            with pool.connection(host='127.0.0.1', port=server.port) as mail_server:
+                writes = []
+                send = mail_server.send
+                mail_server.send = lambda data: writes.append(data) or send(data)
+                refused = _sendmail(mail_server, 'me@example.com', self.recipients, _StreamedMail(self.mail))
+            return server, refused, writes
+
+    def test_envelope_is_pipelined_and_mail_sent_in_chunks(self):
+        server, refused, writes = self.send(['PIPELINING', 'CHUNKING'])
+        plain_server, plain_refused, plain_writes = self.send([])
+
+        self.assertEqual(list(refused), ['user7@example.com'])
+        self.assertEqual(refused, plain_refused)
+        self.assertEqual(server.messages[0]['rcpts'], plain_server.messages[0]['rcpts'])
+        self.assertEqual(server.messages[0]['data'], plain_server.messages[0]['data'])
+        self.assertIn('BDAT', server.verbs)
+        self.assertNotIn('DATA', server.verbs)
+        # 251 envelope commands in groups of 100, then the mail's chunks
+        self.assertEqual(len(writes), 3 + len(server.bdat_sizes))
+        self.assertGreater(len(plain_writes), 251)
+
+    def test_last_chunk_ends_the_mail(self):
+        for extensions in (['PIPELINING', 'CHUNKING'], ['CHUNKING']):
+            server, _, writes = self.send(extensions)
+            self.assertNotEqual(server.bdat_sizes[-1], 0)
+            self.assertTrue(writes[-1].startswith(b'BDAT %d LAST\r\n' % server.bdat_sizes[-1]))
+            self.assertEqual(len(server.messages), 1)
+
+    def test_empty_mail_is_sent_as_an_empty_last_chunk(self):
+        with FakeSMTPServer(extensions=['CHUNKING']) as server:
+            with SMTPConnectionPool() as pool:
+                with pool.connection(host='127.0.0.1', port=server.port) as mail_server:
+                    _sendmail(mail_server, 'me@example.com', ['user1@example.com'], [])
+        self.assertEqual(server.bdat_sizes, [0])
+        self.assertEqual(server.messages[0]['data'], b'')
+
+    def test_extensions_are_used_independently(self):
+        server, refused, _ = self.send(['PIPELINING'])
+        self.assertIn('DATA', server.verbs)
+        self.assertEqual(list(refused), ['user7@example.com'])
+
+        server, refused, _ = self.send(['CHUNKING'])
+        self.assertIn('BDAT', server.verbs)
+        self.assertEqual(list(refused), ['user7@example.com'])
+        self.assertEqual(server.messages[0]['data'], b''.join(_iter_unstuffed(_StreamedMail(self.mail))))
+
+    def test_all_refused_recipients_are_reported(self):
+        with FakeSMTPServer(extensions=['PIPELINING']) as server:
+            server.refuse.add('user1@example.com')
+            with SMTPConnectionPool() as pool:
+                with pool.connection(host='127.0.0.1', port=server.port) as mail_server:
+                    with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                        _sendmail(mail_server, 'me@example.com', ['user1@example.com'], _StreamedMail(self.mail))
+
+    def test_dot_stuffing_is_undone_across_chunks(self):
+        chunks = [b'.a\r', b'\n..b\r\n', b'.', b'.c\r\nd.\r\n', b'\r', b'\n.\r\n']
+        self.assertEqual(b''.join(_iter_unstuffed(chunks)), b'a\r\n.b\r\n.c\r\nd.\r\n\r\n\r\n')
+
+
+class RecordingInstrumentation(Instrumentation):
+
+    def __init__(self):
+        self.timings = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def timing(self, phase, seconds):
+        with self._lock:
+            self.timings.setdefault(phase, []).append(seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer(extensions=['AUTH PLAIN'], refuse=['nobody@example.com']).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def instrument(self, instrumentation):
+        previous = set_instrumentation(instrumentation)
+        self.addCleanup(set_instrumentation, previous)
+        return instrumentation
+
+    def send_twice(self):
+        here = os.path.abspath(os.path.dirname(__file__))
+        with SMTPConnectionPool() as pool:
+            for _ in range(2):
+                send_mail(
+                    '[Mail Test] instrumented',
+                    html_message=EMAIL_TEMPLATE,
+                    to='you@example.com, nobody@example.com',
+                    attachments=[here + '/LICENSE'],
+                    host='127.0.0.1', port=self.server.port, username='me', password='secret',
+                    pool=pool
+                )
+
+    def test_phases_and_counts_are_recorded(self):
+        _html_text_cache.clear()
+        recorder = self.instrument(RecordingInstrumentation())
+        self.send_twice()
+
+        self.assertEqual(
+            sorted(recorder.timings),
+            ['attachments', 'auth', 'build', 'connect', 'data', 'ehlo', 'envelope', 'html_to_text', 'parse']
+        )
+        self.assertEqual(len(recorder.timings['parse']), 2)
+        self.assertEqual(len(recorder.timings['connect']), 1)
+        self.assertEqual(recorder.counts['pool_misses'], 1)
+        self.assertEqual(recorder.counts['pool_hits'], 1)
+        self.assertEqual(recorder.counts['recipients_accepted'], 2)
+        self.assertEqual(recorder.counts['recipients_refused'], 2)
+        # the received data lacks the terminating dot line
+        self.assertEqual(recorder.counts['bytes_sent'], sum(message['size'] + 3 for message in self.server.messages))
+
+    def test_mails_given_as_strings_are_counted(self):
+        recorder = self.instrument(RecordingInstrumentation())
+        with SMTPConnectionPool() as pool:
+            refused = pool.sendmail(
+                'me@example.com', ['you@example.com', 'nobody@example.com'],
+                'Subject: plain\n\n.dotted\nline', host='127.0.0.1', port=self.server.port
+            )
+
+        self.assertEqual(list(refused), ['nobody@example.com'])
+        self.assertEqual(self.server.messages[0]['data'], b'Subject: plain\r\n\r\n.dotted\r\nline\r\n')
+        self.assertEqual(recorder.counts['recipients_accepted'], 1)
+        self.assertEqual(recorder.counts['recipients_refused'], 1)
+        # the escaped dot and the terminating dot line
+        self.assertEqual(recorder.counts['bytes_sent'], self.server.messages[0]['size'] + 4)
+
+    def test_prometheus_metrics_are_exported(self):
+        try:
+            import prometheus_client
+        except ImportError:
+            self.skipTest('prometheus_client is not installed')
+
+        registry = prometheus_client.CollectorRegistry()
+        self.instrument(PrometheusInstrumentation(registry=registry))
+        self.send_twice()
+
+        self.assertEqual(registry.get_sample_value('send_mail_pool_hits_total'), 1)
+        self.assertEqual(registry.get_sample_value('send_mail_recipients_refused_total'), 2)
+        self.assertEqual(registry.get_sample_value('send_mail_phase_seconds_count', {'phase': 'envelope'}), 2)
+
+    def test_opentelemetry_spans_are_traced(self):
+        try:
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+            from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+        except ImportError:
+            self.skipTest('opentelemetry-sdk is not installed')
+
+        exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+        tracer = provider.get_tracer('test')
+        self.instrument(OpenTelemetryInstrumentation(tracer))
+
+        with tracer.start_as_current_span('job') as job:
+            self.send_twice()
+
+        spans = exporter.get_finished_spans()
+        self.assertIn('send_mail.data', [span.name for span in spans])
+        self.assertTrue(all(span.parent.span_id == job.get_span_context().span_id
+                            for span in spans if span.name == 'send_mail.envelope'))
+        self.assertIn('send_mail.pool_hits', [event.name for event in job.events])
+
+
+class RecipientChunkingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer(refuse=['user7@example.com']).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def send(self, **kwargs):
+        return send_mail(
+            '[Mail Test] chunked',
+            message=PLAINTEXT_EMAIL,
+            to=['user%d@example.com' % i for i in range(10)],
+            cc='him@example.com',
+            bcc=['them%d@example.com' % i for i in range(15)],
+            host='127.0.0.1',
+            port=self.server.port,
+            max_recipients=4,
+            **kwargs
+        )
+
+    def assert_chunked(self, result):
+        self.assertEqual(len(result.accepted), 25)
+        self.assertEqual(list(result.refused), ['user7@example.com'])
+        self.assertEqual(len(self.server.messages), 7)
+        self.assertTrue(all(len(message['rcpts']) <= 4 for message in self.server.messages))
+        self.assertEqual(len(set(message['data'] for message in self.server.messages)), 1)
+
+        mail = message_from_bytes(self.server.messages[0]['data'])
+        self.assertEqual(mail['To'], 'undisclosed-recipients:;')
+        self.assertEqual(mail['Cc'], 'him@example.com')
+
+    def test_recipients_are_sent_in_chunks(self):
+        self.assert_chunked(self.send())
+
+    def test_chunks_are_sent_in_parallel(self):
+        self.assert_chunked(self.send(chunk_workers=3))
+        self.assertLessEqual(self.server.connections, 3)
+
+    def test_parallel_chunks_read_file_objects_apart(self):
+        data = os.urandom(512 * 1024)
+        self.send(chunk_workers=4, attachments=[('data.bin', io.BytesIO(data))])
+
+        self.assertEqual(len(set(message['data'] for message in self.server.messages)), 1)
+        mail = message_from_bytes(self.server.messages[0]['data'])
+        self.assertEqual(mail.get_payload(1).get_payload(decode=True), data)
+
+    def test_failed_chunks_are_reported(self):
+        self.server.refuse.update(['user%d@example.com' % i for i in range(4)])
+        result = self.send()
+
+        self.assertIsNotNone(result.error)
+        self.assertEqual(len(result.refused), 5)
+        self.assertEqual(len(result.accepted), 21)
+
+
+class SendManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer(refuse=['nobody@example.com']).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def test_batch_is_sent_over_one_session(self):
+        results = send_many(
+            [
+                {'subject': 'First', 'message': PLAINTEXT_EMAIL, 'to': 'you@example.com'},
+                {'subject': 'Second', 'message': PLAINTEXT_EMAIL, 'to': 'not an address'},
+                {'subject': 'Third', 'message': PLAINTEXT_EMAIL, 'to': 'you@example.com, nobody@example.com'},
+                {'subject': 'Fourth', 'message': PLAINTEXT_EMAIL, 'to': 'nobody@example.com'},
+            ],
+            host='127.0.0.1',
+            port=self.server.port
+        )
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(results[0].ok)
+        self.assertEqual(results[0].accepted, ['you@example.com'])
+        self.assertIsNotNone(results[1].error)
+        self.assertEqual(results[2].accepted, ['you@example.com'])
+        self.assertEqual(list(results[2].refused), ['nobody@example.com'])
+        self.assertEqual(list(results[3].refused), ['nobody@example.com'])
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 1)
+
+
+class HtmlToTextTestCase(unittest.TestCase):
+
+    def setUp(self):
+        _html_text_cache.clear()
+
+    def plain_text(self, mail):
+        return mail.get_payload(0).get_payload(0).get_payload(decode=True).decode('utf-8')
+
+    def test_html_only_messages_get_plain_text_part(self):
+        mail, _, _ = _build_mail('[Mail Test] html', html_message=EMAIL_TEMPLATE, to='you@example.com')
+
+        self.assertIn('# Hello, Welcome to the mailing group', self.plain_text(mail))
+        self.assertEqual(mail.get_payload(0).get_payload(1).get_content_subtype(), 'html')
+
+    def test_conversions_are_cached(self):
+        hits, misses = _html_text_cache.hits, _html_text_cache.misses
+        for _ in range(3):
+            _build_mail('[Mail Test] html', html_message=EMAIL_TEMPLATE, to='you@example.com')
+
+        self.assertEqual((_html_text_cache.hits - hits, _html_text_cache.misses - misses), (2, 1))
+
+    def test_conversions_dont_share_parsing_state(self):
+        _convert_html('<pre>unclosed')
+
+        self.assertEqual(_convert_html('<p>Dear   customer,</p><p>thanks</p>').strip(), 'Dear customer,\n\nthanks')
+
+    def test_batches_are_converted_in_worker_processes(self):
+        with FakeSMTPServer() as server:
+            results = send_many(
+                [
+                    {'subject': 'First', 'html_message': '<p>first</p>', 'to': 'you@example.com'},
+                    {'subject': 'Second', 'message': 'second', 'to': 'you@example.com'},
+                    {'subject': 'Third', 'html_message': '<p>third</p>', 'to': 'you@example.com'},
+                    {'subject': 'Fourth', 'html_message': '<p>first</p>', 'to': 'you@example.com'},
+                ],
+                host='127.0.0.1',
+                port=server.port,
+                html_processes=2
+            )
+
+            self.assertTrue(all(result.ok for result in results))
+            texts = [self.plain_text(message_from_bytes(message['data'])) for message in server.messages]
+            self.assertEqual([text.strip() for text in texts], ['first', 'second', 'third', 'first'])
+
+
+class DispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def messages(self, count):
+        for i in range(count):
+            yield {'subject': 'Mail %d' % i, 'message': PLAINTEXT_EMAIL, 'to': 'you@example.com, him@example.com'}
+        yield {'subject': 'Broken', 'message': PLAINTEXT_EMAIL, 'to': 'not an address'}
+
+    def test_messages_are_dispatched_in_parallel(self):
+        dispatcher = Dispatcher(workers=4, max_per_host=2, host='127.0.0.1', port=self.server.port)
+        report = dispatcher.dispatch(self.messages(30))
+        dispatcher.close()
+
+        self.assertEqual(len(report.results), 31)
+        self.assertEqual(report.sent, 30)
+        self.assertEqual(report.failed, 1)
+        self.assertEqual(report.recipients, 60)
+        self.assertIsNotNone(report.results[-1].error)
+        self.assertGreater(report.messages_per_second, 0)
+        self.assertEqual(len(self.server.messages), 30)
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_recipients_are_rate_limited(self):
+        dispatcher = Dispatcher(workers=4, recipients_per_second=40, host='127.0.0.1', port=self.server.port)
+        report = dispatcher.dispatch(self.messages(30))
+        dispatcher.close()
+
+        # 60 recipients with a burst of 40 take at least half a second
+        self.assertGreaterEqual(report.elapsed, 0.45)
+        self.assertEqual(report.sent, 30)
+
+    def test_messages_are_built_in_worker_processes(self):
+        here = os.path.abspath(os.path.dirname(__file__))
+        messages = list(self.messages(20))
+        messages[3] = dict(messages[3], attachments=[here + '/LICENSE'], html_message='<p>Hello</p>')
+
+        dispatcher = Dispatcher(
+            workers=2, build_processes=2, max_pending=3, host='127.0.0.1', port=self.server.port
+        )
+        report = dispatcher.dispatch(iter(messages))
+        dispatcher.close()
+
+        self.assertEqual(report.sent, 20)
+        self.assertEqual(report.failed, 1)
+        self.assertEqual(report.results[3].accepted, ['you@example.com', 'him@example.com'])
+        subjects = sorted(message_from_bytes(message['data'])['Subject'] for message in self.server.messages)
+        self.assertEqual(subjects, sorted('Mail %d' % i for i in range(20)))
+        mail = [message_from_bytes(message['data']) for message in self.server.messages
+                if b'Subject: Mail 3\r\n' in message['data']][0]
+        with open(here + '/LICENSE', 'rb') as f:
+            self.assertEqual(mail.get_payload(1).get_payload(decode=True), f.read())
+
+    def test_mails_failing_to_build_in_worker_processes_are_reported(self):
+        here = os.path.abspath(os.path.dirname(__file__))
+        messages = list(self.messages(3))
+        with open(here + '/LICENSE', 'rb') as f:
+            messages[0] = dict(messages[0], attachments=[('broken.bin', UnreadableStream())])
+            # can't be pickled to be sent to the worker processes
+            messages[1] = dict(messages[1], attachments=[('LICENSE', f)])
+            messages[2] = dict(messages[2], attachments=[('stranded.bin', UnmountedStream())])
+
+            dispatcher = Dispatcher(
+                workers=1, build_processes=1, max_pending=2, host='127.0.0.1', port=self.server.port
+            )
+            report = dispatcher.dispatch(iter(messages))
+            dispatcher.close()
+
+        self.assertEqual(report.sent, 0)
+        self.assertEqual(report.failed, 4)
+        self.assertIn('disk went away', str(report.results[0].error))
+        self.assertIn('not mounted', str(report.results[2].error))
+        self.assertEqual(len(self.server.messages), 0)
+
+    def test_leading_dots_survive_worker_processes(self):
+        dispatcher = Dispatcher(workers=1, build_processes=1, host='127.0.0.1', port=self.server.port)
+        report = dispatcher.dispatch([{'subject': 'Dots', 'message': '.dotted\n', 'to': 'you@example.com'}])
+        dispatcher.close()
+
+        self.assertEqual(report.sent, 1)
+        body = message_from_bytes(self.server.messages[0]['data']).get_payload(0).get_payload(0)
+        self.assertEqual(body.get_payload(decode=True), b'.dotted\r\n')
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_consume_waits_for_tokens(self):
+        bucket = TokenBucket(50, capacity=1)
+        started_at = time.time()
+        for _ in range(6):
+            bucket.consume()
+
+        self.assertGreaterEqual(time.time() - started_at, 0.09)
+
+
+class StreamedMailTestCase(unittest.TestCase):
+
+    def test_chunks_match_smtplib_rendering(self):
+        mail, _, _ = _build_mail(
+            # the subject is the preamble too, which as_string can't write
+            # on Python 2 unless it's ASCII
+            '[Mail Test] Olá' if six.PY3 else '[Mail Test] Hello',
+            message='.leading dot\nline\r\n' * 50,
+            html_message=EMAIL_TEMPLATE,
+            to=[('Jöe Example', 'to@example.com'), 'you@example.com'],
+            attachments=[os.path.abspath(os.path.dirname(__file__)) + '/LICENSE'],
+            custom_headers={'X-Mailer': 'SendMail'}
+        )
+
+        expected = smtplib.quotedata(mail.as_string())
+        if not isinstance(expected, bytes):
+            expected = expected.encode('utf-8')
+        if not expected.endswith(b'\r\n'):
+            expected += b'\r\n'
+
+        self.assertEqual(b''.join(_StreamedMail(mail, chunk_size=100)), expected)
+        self.assertEqual(b''.join(_StreamedMail(mail)), expected)
+
+
+class StreamedAttachmentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_file(self, name, content):
+        file_path = os.path.join(self.directory, name)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        return file_path
+
+    def send(self, attachments, **kwargs):
+        send_mail(
+            '[Mail Test] streamed',
+            message='.leading dot\n' + PLAINTEXT_EMAIL,
+            to='you@example.com',
+            attachments=attachments,
+            host='127.0.0.1',
+            port=self.server.port,
+            **kwargs
+        )
+        return message_from_bytes(self.server.messages[-1]['data'])
+
+    def test_attachments_are_streamed_intact(self):
+        contents = [os.urandom(300001), b'', b'x' * 57 * 1024]
+        attachments = [self.make_file('file%d.bin' % i, content) for i, content in enumerate(contents)]
+
+        streamed = self.send(attachments, stream_attachments=True)
+        buffered = self.send(attachments)
+
+        streamed_parts = [part for part in streamed.walk() if part.get_filename()]
+        buffered_parts = [part for part in buffered.walk() if part.get_filename()]
+        self.assertEqual([part.get_payload(decode=True) for part in streamed_parts], contents)
+        self.assertEqual(
+            [part.get_payload(decode=True) for part in streamed_parts],
+            [part.get_payload(decode=True) for part in buffered_parts]
+        )
+        self.assertEqual(streamed.get_payload(0).get_payload(0).get_payload(decode=True)[:12], b'.leading dot')
+
+    @unittest.skipIf(tracemalloc is None, 'tracemalloc needs Python 3.4')
+    def test_streaming_memory_does_not_grow_with_attachment_size(self):
+        attachment = self.make_file('big.bin', os.urandom(8 * 1024 * 1024))
+        server = FakeSMTPServer(keep_data=False).__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+
+        tracemalloc.start()
+        try:
+            send_mail(
+                '[Mail Test] streamed', message=PLAINTEXT_EMAIL, to='you@example.com',
+                attachments=[attachment], host='127.0.0.1', port=server.port, stream_attachments=True
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertGreater(server.messages[0]['size'], 8 * 1024 * 1024)
+        self.assertLess(peak, 2 * 1024 * 1024)
+
+
+class InMemoryAttachmentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def send(self, attachments, **kwargs):
+        send_mail(
+            '[Mail Test] in memory', message=PLAINTEXT_EMAIL, to='you@example.com', attachments=attachments,
+            host='127.0.0.1', port=self.server.port, **kwargs
+        )
+        mail = message_from_bytes(self.server.messages[-1]['data'])
+        return [
+            (part.get_filename(), part.get_content_type(), part.get_payload(decode=True))
+            for part in mail.walk() if part.get_filename()
+        ]
+
+    def test_buffers_and_file_objects_are_attached(self):
+        data = os.urandom(200 * 1024)
+        here = os.path.abspath(os.path.dirname(__file__))
+        stream = io.BytesIO(b'skipped' + data)
+        stream.seek(len(b'skipped'))
+
+        attachments = self.send([
+            ('report.csv', b'a,b\n1,2\n'),
+            ('image.bin', memoryview(bytearray(data)), 'image/png'),
+            ('data.pdf', stream),
+            here + '/LICENSE',
+        ])
+
+        self.assertEqual(attachments, [
+            ('report.csv', 'text/csv', b'a,b\n1,2\n'),
+            ('image.bin', 'image/png', data),
+            ('data.pdf', 'application/pdf', data),
+            ('LICENSE', 'application/octet-stream', open(here + '/LICENSE', 'rb').read()),
+        ])
+
+    def test_unseekable_streams_are_read_once(self):
+        # small enough to fit in the pipe's buffer
+        data = os.urandom(16 * 1024)
+        read, write = os.pipe()
+        os.write(write, data)
+        os.close(write)
+
+        with io.open(read, 'rb', buffering=0) as stream:
+            self.assertEqual(
+                self.send(('pipe.bin', stream)),
+                [('pipe.bin', 'application/octet-stream', data)]
+            )
+
+    def test_short_reads_keep_base64_lines_whole(self):
+        class Trickle(io.RawIOBase):
+            def __init__(self, data):
+                self.data = io.BytesIO(data)
+
+            def readable(self):
+                return True
+
+            def seekable(self):
+                return True
+
+            def seek(self, offset, whence=0):
+                return self.data.seek(offset, whence)
+
+            def tell(self):
+                return self.data.tell()
+
+            def readinto(self, buffer):
+                chunk = self.data.read(min(len(buffer), 1000))
+                buffer[:len(chunk)] = chunk
+                return len(chunk)
+
+        data = os.urandom(150 * 1024)
+        self.assertEqual(self.send([('trickle.bin', Trickle(data))]), [('trickle.bin', 'application/octet-stream', data)])
+
+
+class DKIMTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import dkim
+            from cryptography.hazmat.primitives import serialization
+            from cryptography.hazmat.primitives.asymmetric import rsa
+        except ImportError:
+            raise unittest.SkipTest('cryptography and dkimpy are needed to sign and verify mails')
+
+        key = rsa.generate_private_key(65537, 2048)
+        cls.private_key = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        public_key = key.public_key().public_bytes(
+            serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        cls.dns_record = b'v=DKIM1; k=rsa; p=' + base64.b64encode(public_key)
+        cls.dkim = dkim
+
+    def setUp(self):
+        self.server = FakeSMTPServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.settings = {'host': '127.0.0.1', 'port': self.server.port}
+
+    def verify(self, data):
+        return self.dkim.verify(data, dnsfunc=lambda name, timeout=5: self.dns_record)
+
+    def test_mails_are_signed(self):
+        here = os.path.abspath(os.path.dirname(__file__))
+        for canonicalization in ('relaxed/relaxed', 'simple/simple'):
+            signer = DKIMSigner('example.com', 'mail', self.private_key, canonicalization=canonicalization)
+            for stream_attachments in (False, True):
+                send_mail(
+                    '[Mail Test]  signed', message='Hello \t there  \n.dotted line\n\n\n', sender='app@example.com',
+                    to='you@example.com', attachments=[here + '/LICENSE'], stream_attachments=stream_attachments,
+                    dkim=signer, **self.settings
+                )
+                data = self.server.messages[-1]['data']
+                self.assertTrue(data.startswith(b'DKIM-Signature: v=1; a=rsa-sha256; c=%s; d=example.com; s=mail;'
+                                                % canonicalization.encode('ascii')))
+                self.assertTrue(self.verify(data))
+
+        self.assertEqual(signer.signed, 2)
+
+    def test_body_hash_is_reused_by_merges_and_envelopes(self):
+        signer = DKIMSigner('example.com', 'mail', self.private_key)
+        template = MailTemplate('[Mail Test] newsletter', message='Same news for everyone\n', sender='app@example.com')
+        results = send_merge(template, [{'to': 'user%d@example.com' % i} for i in range(3)], dkim=signer, **self.settings)
+        send_mail('[Mail Test] many', message=PLAINTEXT_EMAIL, sender='app@example.com',
+                  to=['user%d@example.com' % i for i in range(4)], max_recipients=2, dkim=signer, **self.settings)
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertTrue(all(self.verify(message['data']) for message in self.server.messages))
+        self.assertEqual((signer.signed, signer.body_hashes), (4, 2))
+
+    def test_mails_built_in_processes_are_signed(self):
+        signer = DKIMSigner('example.com', 'mail', self.private_key)
+        dispatcher = Dispatcher(workers=2, build_processes=2, dkim=signer, **self.settings)
+        report = dispatcher.dispatch(
+            {'subject': 'Mail %d' % i, 'message': '.dotted line\n', 'sender': 'app@example.com', 'to': 'you@example.com'}
+            for i in range(4)
+        )
+        dispatcher.close()
+
+        self.assertEqual(report.sent, 4)
+        for message in self.server.messages:
+            self.assertIn(b'\r\n.dotted line', message['data'])
+            self.assertTrue(self.verify(message['data']))
+
+    def test_keys_are_parsed_once(self):
+        first = DKIMSigner('example.com', 'mail', self.private_key)
+        second = DKIMSigner('example.com', 'mail', self.private_key.decode('ascii'), headers=['From'])
+
+        self.assertIs(first._key, second._key)
+        self.assertRaises(ValueError, DKIMSigner, 'example.com', 'mail', self.private_key, canonicalization='loose')
+
+
+class AttachmentCompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.export = ''.join('%d,item %d,in stock\n' % (i, i) for i in range(20000)).encode('ascii')
+
+    def send(self, compression, attachments, **kwargs):
+        self.addCleanup(compression.close)
+        send_mail(
+            '[Mail Test] compressed', message=PLAINTEXT_EMAIL, to='you@example.com', attachments=attachments,
+            compress_attachments=compression, host='127.0.0.1', port=self.server.port, **kwargs
+        )
+        mail = message_from_bytes(self.server.messages[-1]['data'])
+        return [
+            (part.get_filename(), part.get_content_type(), part.get_payload(decode=True))
+            for part in mail.walk() if part.get_filename()
+        ]
+
+    def test_big_text_attachments_are_gzipped(self):
+        import gzip
+
+        compression = AttachmentCompression(min_size=64 * 1024)
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(self.export)
+            f.flush()
+            for stream_attachments in (False, True):
+                [(file_name, content_type, data)] = self.send(
+                    compression, [f.name], stream_attachments=stream_attachments
+                )
+                self.assertEqual(file_name, os.path.basename(f.name) + '.gz')
+                self.assertEqual(content_type, 'application/gzip')
+                self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(data)).read(), self.export)
+
+        self.assertEqual(compression.compressed, 2)
+        self.assertEqual(compression.bytes_in, 2 * len(self.export))
+        self.assertLess(compression.ratio, 0.5)
+
+    def test_compressed_files_are_closed_once_sent(self):
+        compressed = []
+
+        class RecordingCompression(AttachmentCompression):
+            def _compress(self, file_name, source):
+                compressed.append(AttachmentCompression._compress(self, file_name, source))
+                return compressed[-1]
+
+        self.send(RecordingCompression(min_size=64 * 1024), [('export.csv', self.export)])
+
+        self.assertTrue(compressed[0].closed)
+
+    def test_zip_format(self):
+        import zipfile
+
+        compression = AttachmentCompression(min_size=64 * 1024, format='zip')
+        [(file_name, content_type, data)] = self.send(compression, [('export.json', io.BytesIO(self.export))])
+
+        self.assertEqual((file_name, content_type), ('export.json.zip', 'application/zip'))
+        self.assertEqual(zipfile.ZipFile(io.BytesIO(data)).read('export.json'), self.export)
+
+    def test_small_and_binary_attachments_are_left_alone(self):
+        data = os.urandom(128 * 1024)
+        compression = AttachmentCompression(min_size=64 * 1024)
+
+        self.assertEqual(
+            self.send(compression, [('small.csv', b'a,b\n'), ('image.png', data)]),
+            [('small.csv', 'text/csv', b'a,b\n'), ('image.png', 'image/png', data)]
+        )
+        self.assertIsNone(compression.ratio)
+
+    def test_unknown_format_is_refused(self):
+        self.assertRaises(ValueError, AttachmentCompression, format='rar')
+
+
+class AttachmentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = AttachmentCache(max_bytes=3000)
+        previous = set_attachment_cache(self.cache)
+        self.addCleanup(set_attachment_cache, previous)
+
+    def make_file(self, name, content):
+        file_path = os.path.join(self.directory, name)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        return file_path
+
+    def send(self, *attachments):
+        send_mail(
+            '[Mail Test] cached', message=PLAINTEXT_EMAIL, to='you@example.com',
+            attachments=list(attachments), host='127.0.0.1', port=self.server.port
+        )
+        message = message_from_bytes(self.server.messages[-1]['data'])
+        return [part.get_payload(decode=True) for part in message.walk() if part.get_filename()]
+
+    def test_attachments_are_encoded_once(self):
+        content = os.urandom(1000)
+        attachment = self.make_file('report.pdf', content)
+
+        self.assertEqual(self.send(attachment), [content])
+        self.assertEqual(self.send(attachment), [content])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_changed_files_are_encoded_again(self):
+        attachment = self.make_file('report.pdf', b'old')
+        self.send(attachment)
+        os.utime(attachment, (0, 0))
+        self.make_file('report.pdf', b'new')
+        os.utime(attachment, (1, 1))
+
+        self.assertEqual(self.send(attachment), [b'new'])
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_least_recently_used_are_evicted(self):
+        first, second, third = [self.make_file('%d.bin' % i, os.urandom(1000)) for i in range(3)]
+        self.send(first, second)
+        self.send(first)
+        self.send(third)
+        self.send(first, second)
+
+        self.assertLessEqual(self.cache.size, 3000)
+        # the second was evicted by the third, the first was used since
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 4))
+
+
+class MailTemplateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def test_mails_are_rendered_from_template(self):
+        here = os.path.abspath(os.path.dirname(__file__))
+        template = MailTemplate(
+            '[Mail Test] Report for $name',
+            message='Hello $name,\n.see ${what} attached, it costs $$5 ' + 'and more ' * 20 + '\n',
+            html_message='<p>Hello $name</p>',
+            sender=('App', 'notifications@example.com'),
+            attachments=[here + '/LICENSE'],
+            custom_headers={'X-Mailer': 'SendMail'}
+        )
+
+        results = send_merge(
+            template,
+            [
+                {'to': 'you@example.com', 'context': {'name': 'Jöe', 'what': 'the report'}},
+                {'to': 'him@example.com', 'context': {'name': 'Him'}},
+                {'to': 'her@example.com', 'cc': 'you@example.com', 'context': {'name': 'Her', 'what': 'this'},
+                 'attachments': [here + '/README.rst']},
+            ],
+            host='127.0.0.1',
+            port=self.server.port
+        )
+
+        self.assertTrue(results[0].ok)
+        self.assertIsInstance(results[1].error, KeyError)
+        self.assertEqual(results[2].accepted, ['her@example.com', 'you@example.com'])
+        self.assertEqual(self.server.connections, 1)
+
+        first, third = [message_from_bytes(message['data']) for message in self.server.messages]
+        self.assertEqual(first['Subject'], '=?utf-8?q?=5BMail_Test=5D_Report_for_J=C3=B6e?=')
+        self.assertEqual(first['X-Mailer'], 'SendMail')
+        self.assertEqual(third['Cc'], 'you@example.com')
+
+        plain, html = first.get_payload(0).get_payload()
+        self.assertEqual(
+            plain.get_payload(decode=True).decode('utf-8'),
+            'Hello Jöe,\r\n.see the report attached, it costs $5 ' + 'and more ' * 20 + '\r\n'
+        )
+        self.assertEqual(html.get_payload(decode=True).decode('utf-8'), '<p>Hello Jöe</p>')
+        self.assertEqual(
+            [part.get_filename() for part in third.walk() if part.get_filename()],
+            ['LICENSE', 'README.rst']
+        )
+        with open(here + '/README.rst', 'rb') as f:
+            self.assertEqual(third.get_payload(2).get_payload(decode=True), f.read())
+
+
+class OutboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSMTPServer(refuse=['nobody@example.com']).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_outbox(self, **kwargs):
+        outbox = Outbox(self.directory, backoff=0.01, poll_interval=0.01, host='127.0.0.1', **kwargs)
+        self.addCleanup(outbox.stop)
+        return outbox
+
+    def enqueue(self, outbox, to='you@example.com'):
+        return send_mail('[Mail Test] queued', message=PLAINTEXT_EMAIL, to=to, outbox=outbox)
+
+    def test_queued_mails_are_delivered_in_background(self):
+        outbox = self.make_outbox(port=self.server.port)
+        for _ in range(5):
+            self.enqueue(outbox)
+        self.assertEqual(len(outbox), 5)
+        self.assertEqual(len(self.server.messages), 0)
+
+        outbox.start(workers=2)
+
+        self.assertTrue(outbox.flush(timeout=5))
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.messages[0]['rcpts'], ['you@example.com'])
+        self.assertEqual(message_from_bytes(self.server.messages[0]['data'])['Subject'], '[Mail Test] queued')
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_failing_mails_are_retried_then_dead_lettered(self):
+        with FakeSMTPServer() as gone:
+            port = gone.port
+        outbox = self.make_outbox(port=port, max_attempts=3)
+        mail_id = self.enqueue(outbox)
+
+        while outbox.deliver_due() or len(outbox):
+            time.sleep(0.01)
+
+        self.assertEqual(outbox.dead, [mail_id])
+        with open(os.path.join(self.directory, 'dead', mail_id + '.error')) as f:
+            self.assertIn('refused', f.read())
+
+    def test_refused_mails_are_dead_lettered_at_once(self):
+        outbox = self.make_outbox(port=self.server.port)
+        mail_id = self.enqueue(outbox, to='nobody@example.com')
+
+        self.assertEqual(outbox.deliver_due(), 1)
+        self.assertEqual(outbox.dead, [mail_id])
+
+    def test_temporarily_refused_mails_are_retried(self):
+        self.server.greylist.add('you@example.com')
+        outbox = self.make_outbox(port=self.server.port)
+        self.enqueue(outbox)
+
+        self.assertEqual(outbox.deliver_due(), 1)
+        self.assertEqual(outbox.dead, [])
+        self.assertEqual(len(outbox), 1)
+
+        self.server.greylist.clear()
+        time.sleep(0.05)  # the backoff before the next attempt
+        self.assertEqual(outbox.deliver_due(), 1)
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(len(self.server.messages), 1)
+
+    def test_queue_is_listed_once_per_batch_of_claims(self):
+        outbox = self.make_outbox(port=self.server.port)
+        for _ in range(5):
+            self.enqueue(outbox)
+
+        listdir = os.listdir
+        listings = []
+        os.listdir = lambda path: listings.append(path) or listdir(path)
+        self.addCleanup(setattr, os, 'listdir', listdir)
+
+        self.assertEqual(outbox.deliver_due(), 5)
+        # once for the mails, once more to find the queue empty
+        self.assertEqual(listings.count(os.path.join(self.directory, 'queue', '')), 2)
+        self.assertEqual(len(self.server.messages), 5)
+
+    def test_mails_left_in_flight_are_recovered(self):
+        outbox = self.make_outbox(port=self.server.port)
+        self.enqueue(outbox)
+        # as if a worker had crashed mid delivery
+        name = outbox._claim()
+        self.assertEqual(outbox.deliver_due(), 0)
+
+        outbox = self.make_outbox(port=self.server.port)
+        outbox.start()
+
+        self.assertTrue(outbox.flush(timeout=5))
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'inflight', name)))
+
+    def test_recovery_counts_the_interrupted_attempt_and_cleans_up(self):
+        outbox = self.make_outbox(port=self.server.port, max_attempts=2)
+        mail_id = self.enqueue(outbox)
+        with open(os.path.join(self.directory, 'tmp', 'half_written.eml'), 'wb') as f:
+            f.write(b'{"from": ')
+
+        outbox._claim()
+        outbox.recover()
+        # it may still be being written by another process
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'tmp')), ['half_written.eml'])
+        self.assertEqual(outbox.dead, [])
+
+        time.sleep(0.05)  # the backoff before the next attempt
+        outbox._claim()
+        outbox.recover(tmp_grace=0)
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'tmp')), [])
+        self.assertEqual(outbox.dead, [mail_id])
+
+    def test_fsync_flushes_the_queue_directory(self):
+        outbox = self.make_outbox(port=self.server.port, fsync=True)
+        self.enqueue(outbox)
+        self.enqueue(outbox)
+
+        self.assertEqual(outbox._queue_sync.syncs, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
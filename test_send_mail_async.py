@@ -0,0 +1,156 @@
+# coding: utf-8
+# vim: fenc=utf-8 ft=python ts=4 sts=4 sw=4 ai et
+import asyncio
+import email
+import smtplib
+import threading
+import unittest
+from unittest import mock
+
+from send_mail import AttachmentCompression, _build_mail
+from send_mail_async import async_send_mail, async_send_many
+from test_send_mail import PLAINTEXT_EMAIL, EMAIL_TEMPLATE, FakeSMTPServer, make_ssl_contexts
+
+
+class AsyncMailTestCase(unittest.TestCase):
+
+    def start_server(self, **kwargs):
+        server = FakeSMTPServer(**kwargs).__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        return server
+
+    def send(self, server, **kwargs):
+        return asyncio.run(async_send_mail(
+            '[Mail Test] async',
+            message=PLAINTEXT_EMAIL,
+            html_message=EMAIL_TEMPLATE,
+            to=[('To Example', 'to@example.com'), 'you@example.com'],
+            sender=('App', 'notifications@example.com'),
+            host='127.0.0.1',
+            port=server.port,
+            username='user',
+            password='secret',
+            timeout=5,
+            **kwargs
+        ))
+
+    def test_mail_is_sent(self):
+        server = self.start_server(refuse=['you@example.com'])
+        result = self.send(server)
+
+        self.assertEqual(result.accepted, ['to@example.com'])
+        self.assertEqual(list(result.refused), ['you@example.com'])
+        self.assertEqual(server.logins, 1)
+        self.assertEqual(server.messages[0]['from'], 'notifications@example.com')
+        self.assertIn(b'Subject: [Mail Test] async', server.messages[0]['data'])
+
+    def test_mail_is_sent_over_starttls(self):
+        server_context, client_context = make_ssl_contexts(self)
+        server = self.start_server(ssl_context=server_context)
+        self.send(server, use_tls=True, ssl_context=client_context)
+
+        self.assertEqual(server.tls_sessions, 1)
+        self.assertEqual(len(server.messages), 1)
+
+    def test_mail_is_sent_over_ssl(self):
+        server_context, client_context = make_ssl_contexts(self)
+        server = self.start_server(ssl_context=server_context, implicit_tls=True)
+        self.send(server, use_ssl=True, ssl_context=client_context)
+
+        self.assertEqual(server.tls_sessions, 1)
+        self.assertEqual(len(server.messages), 1)
+
+    def test_all_refused_raises(self):
+        server = self.start_server(refuse=['to@example.com', 'you@example.com'])
+
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.send(server)
+
+    def test_dropped_connection_is_reported(self):
+        server = self.start_server(hang_up_on=['MAIL'])
+
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.send(server)
+
+    def test_compression_does_not_block_the_loop(self):
+        server = self.start_server()
+        released = threading.Event()
+
+        class GatedCompression(AttachmentCompression):
+            def _compress(self, file_name, source):
+                self.waited = released.wait(5)
+                return AttachmentCompression._compress(self, file_name, source)
+
+        compression = GatedCompression(min_size=0)
+
+        async def send():
+            sending = asyncio.ensure_future(async_send_mail(
+                '[Mail Test] compressed', message=PLAINTEXT_EMAIL, to='you@example.com',
+                attachments=[('export.csv', b'a,b\n1,2\n' * 1000)], compress_attachments=compression,
+                host='127.0.0.1', port=server.port, timeout=5
+            ))
+            # long enough for the session to be started, where serializing
+            # the mail would block the loop waiting for the compression
+            await asyncio.sleep(0.5)
+            released.set()
+            return await sending
+
+        asyncio.run(send())
+        compression.close()
+
+        self.assertTrue(compression.waited)
+        mail = email.message_from_bytes(server.messages[0]['data'])
+        self.assertEqual([part.get_filename() for part in mail.walk() if part.get_filename()], ['export.csv.gz'])
+
+    def test_unsupported_keywords_are_refused(self):
+        server = self.start_server()
+
+        for keyword in ('pool', 'transport', 'outbox', 'max_recipients'):
+            with self.assertRaises(ValueError):
+                self.send(server, **{keyword: 10})
+            with self.assertRaises(ValueError):
+                asyncio.run(async_send_many([], **{keyword: 10}))
+
+        self.assertEqual(server.connections, 0)
+
+    def test_batch_builds_mails_within_concurrency_limit(self):
+        server = self.start_server()
+        held, peak = [0], [0]
+
+        def build_mail(*args, **kwargs):
+            held[0] += 1
+            peak[0] = max(peak[0], held[0])
+            return _build_mail(*args, **kwargs)
+
+        def close_attachments(mail):
+            held[0] -= 1
+
+        messages = [{'subject': 'Mail %d' % i, 'message': PLAINTEXT_EMAIL, 'to': 'you@example.com'}
+                    for i in range(10)]
+        with mock.patch('send_mail_async._build_mail', build_mail), \
+                mock.patch('send_mail_async._close_attachments', close_attachments):
+            results = asyncio.run(async_send_many(messages, concurrency=2, host='127.0.0.1', port=server.port))
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(peak[0], 2)
+
+    def test_batch_respects_concurrency_limit(self):
+        server = self.start_server()
+        messages = [
+            {'subject': 'Mail %d' % i, 'message': PLAINTEXT_EMAIL, 'to': 'you@example.com'}
+            for i in range(20)
+        ]
+        messages.append({'subject': 'Broken', 'message': PLAINTEXT_EMAIL, 'to': 'not an address'})
+
+        results = asyncio.run(async_send_many(messages, concurrency=4, host='127.0.0.1', port=server.port))
+
+        self.assertEqual(len(results), 21)
+        self.assertTrue(all(result.ok for result in results[:20]))
+        self.assertIsNotNone(results[20].error)
+        self.assertEqual(len(server.messages), 20)
+        self.assertLessEqual(server.peak_connections, 4)
+        self.assertGreater(server.peak_connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()